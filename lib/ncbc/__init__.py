@@ -6,4 +6,34 @@ from .clean_commands import *
 
 from .utils import *
 
-from .anchor_model import *
\ No newline at end of file
+from .anchor_model import *
+
+from .corpus import *
+
+from .kernels import *
+
+from .topic_slots import *
+
+from .sufficient_statistics import *
+
+from .count_backends import *
+
+from .chains import *
+
+from .traces import *
+
+from .checkpoint import *
+
+from .random_stream import *
+
+from .progress import *
+
+from .instrumentation import *
+
+from .convergence import *
+
+from .adaptation import *
+
+from .coclustering import *
+
+from .membership import *
@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+import numpy as np
+
+class move_scheduler:
+
+    # Adaptive move-selection probabilities of MCMC. During the burnin, the CPU time of each call of a move and the number of changes of the state
+    # (the labels changed, plus one for an accepted metropolis-hastings proposal) are recorded, and every adapt_every calls the probabilities are set
+    # proportional to the number of changes per CPU-second of each move, with a lower bound min_prob so that every move keeps a positive probability.
+    # The probabilities are frozen after the burnin, so the chain used for the samples is a time-homogeneous Markov chain.
+    # The CPU times depend on the machine and its load, so with rate='cpu' the moves (and the chain) are not reproducible for a given seed;
+    # with rate='calls' the probabilities are proportional to the changes per call of each move, and the chain only depends on the seed.
+    # Required input: moves - names of the moves; probs - initial probabilities
+    # Optional input: adapt_every - number of calls between updates; min_prob - lower bound on the probabilities; min_calls - calls of a move required before its rate is used;
+    #                 rate - 'cpu' (changes per CPU-second) or 'calls' (changes per call)
+
+    def __init__(self, moves, probs, adapt_every=100, min_prob=0.01, min_calls=5, rate='cpu'):
+        if not isinstance(adapt_every, int) or adapt_every < 1:
+            raise ValueError('adapt_every must be a positive integer.')
+        if rate not in ['cpu', 'calls']:
+            raise ValueError('rate must be cpu or calls.')
+        if not 0 <= min_prob * len(moves) < 1:
+            raise ValueError('min_prob must be non-negative and smaller than 1 / (number of moves).')
+        self.moves = list(moves)
+        self.index = {move: k for k, move in enumerate(self.moves)}
+        self.probs = np.array(probs, dtype=float) / np.sum(probs)
+        self.adapt_every = adapt_every
+        self.min_prob = min_prob
+        self.min_calls = min_calls
+        self.rate = rate
+        self.calls = np.zeros(len(self.moves), dtype=int)
+        self.seconds = np.zeros(len(self.moves))
+        self.changes = np.zeros(len(self.moves), dtype=int)
+
+    ## Cumulative probabilities of the moves (for random_stream.categorical_cdf)
+    @property
+    def cdf(self):
+        return np.cumsum(self.probs)
+
+    ## Record a call of a move (seconds: CPU time; changes: number of changes of the state)
+    def record(self, move, seconds, changes):
+        k = self.index[move]
+        self.calls[k] += 1
+        self.seconds[k] += seconds
+        self.changes[k] += changes
+
+    ## Whether the probabilities are updated after the last call
+    def due(self):
+        return np.sum(self.calls) % self.adapt_every == 0
+
+    ## Update the probabilities from the changes per CPU-second (or per call) of the moves
+    def adapt(self):
+        # Moves with too few calls keep their current share of the probability
+        cost = self.seconds if self.rate == 'cpu' else self.calls
+        measured = (self.calls >= self.min_calls) & (cost > 0)
+        if np.any(measured):
+            rates = self.changes[measured] / cost[measured]
+            share = np.sum(self.probs[measured])
+            if np.sum(rates) > 0:
+                self.probs[measured] = share * rates / np.sum(rates)
+        # Lower bound on the probabilities
+        self.probs = np.maximum(self.probs / np.sum(self.probs), self.min_prob)
+        self.probs /= np.sum(self.probs)
+        return self.cdf
+
+    ## Summary of the adaptation for each move
+    def summary(self):
+        return {move: {'prob': float(self.probs[k]), 'calls': int(self.calls[k]), 'seconds': float(self.seconds[k]), 'changes': int(self.changes[k])}
+                    for move, k in self.index.items()}
+
+    ## State as a dictionary of arrays (for checkpoints)
+    def get_state(self):
+        return {'probs': np.copy(self.probs), 'calls': np.copy(self.calls), 'seconds': np.copy(self.seconds), 'changes': np.copy(self.changes)}
+
+    ## Restore the output of get_state
+    def set_state(self, state):
+        for name in ['probs', 'calls', 'seconds', 'changes']:
+            setattr(self, name, np.copy(state[name]))
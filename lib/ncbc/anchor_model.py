@@ -1,12 +1,15 @@
 #! /usr/bin/env python3
 import numpy as np
 from collections import Counter
-from scipy.special import logsumexp, loggamma
-from scipy.sparse import coo_matrix
+from scipy.special import loggamma
+from scipy.sparse import coo_matrix, csr_matrix
 from scipy.sparse.linalg import svds
 from sklearn.cluster import KMeans
-from .utils import logB
-from IPython.display import display, clear_output
+from .utils import logB, lookup_log, lookup_logB
+from .sufficient_statistics import count_matrix
+from .count_backends import count_backends
+from .random_stream import random_stream
+from .progress import default_monitor
 
 class anchor_model:
     
@@ -15,7 +18,7 @@ class anchor_model:
     # "NESTED DIRICHLET MODELS FOR UNSUPERVISED ATTACK PATTERN DETECTION IN HONEYPOT DATA"
     # Required input: W_a - dictionary of dictionaries containing the anchor words (as consecutive integers starting at 0)
     #                 W_c - dictionary of dictionaries containing the chain words (as consecutive integers starting at 0)
-    def __init__(self, W_a, W_c, K, H, V=0, gamma=1.0, chi=1.0, tau=1.0, eta=1.0, numpyfy=False):
+    def __init__(self, W_a, W_c, K, H, V=0, gamma=1.0, chi=1.0, tau=1.0, eta=1.0, numpyfy=False, count_backend='dense', count_dtype=None, seed=None):
         # Documents & sentences (sessions & commands) in python dictionary form
         self.w_a = W_a
         if not numpyfy:
@@ -88,6 +91,21 @@ class anchor_model:
         if not isinstance(H, int) or H < 2:
             raise ValueError('H must be an integer value larger or equal to 2.') 
         self.H = H
+        # Anchor word of each command and counts of the chain words of the commands of each anchor word (sparse V x V matrix, computed once
+        # and used by init_counts, spectral_init and resample_chain_topics instead of scanning the corpus)
+        self.anchors = np.concatenate([np.array(self.w_a[d], dtype=int) for d in range(self.D)]) if self.D > 0 else np.zeros(0, dtype=int)
+        chains = [np.array(self.w_c[d][j], dtype=int) for d in range(self.D) for j in range(self.N[d])]
+        rows = np.repeat(self.anchors, [len(chain) for chain in chains])
+        cols = np.concatenate(chains) if len(chains) > 0 else np.zeros(0, dtype=int)
+        self.anchor_chain = csr_matrix((np.ones(len(rows), dtype=int), (rows, cols)), shape=(self.V, self.V))
+        self.anchor_chain.sum_duplicates()
+        # Storage of the count matrices W_a and W_c (see count_backends)
+        if count_backend not in count_backends:
+            raise ValueError('count_backend must be one of ' + ', '.join(count_backends) + '.')
+        self.count_backend = count_backend
+        self.count_dtype = count_dtype
+        # Random number generator of the model (seed: integer, np.random.SeedSequence or None)
+        self.rng = random_stream(seed)
         # Initialise dictionaries
         self.t = np.zeros(self.D, dtype=int)
         self.u = np.zeros(self.V, dtype=int)
@@ -95,12 +113,28 @@ class anchor_model:
     ## Calculate marginal posterior
     def marginal_loglikelihood(self):
         ll = 0
-        ll += logB(self.gamma + self.T) - logB(self.gamma * np.ones(self.K))
-        ll += logB(self.chi + self.U) - logB(self.chi * np.ones(self.H))
-        ll += np.sum([logB(self.tau + self.W_a[k]) for k in range(self.K)]) - self.K * logB(self.tau * np.ones(self.V))
-        ll += np.sum([logB(self.eta + self.W_c[h]) for h in range(self.H)]) - self.H * logB(self.eta * np.ones(self.V))
+        ll += lookup_logB(self.gamma, self.T) - logB(self.gamma * np.ones(self.K))
+        ll += lookup_logB(self.chi, self.U) - logB(self.chi * np.ones(self.H))
+        ll += self.counts_a.loglik() + self.counts_c.loglik()
         return ll
 
+    ## Count matrices of the anchor words and of the chain words (updated only through the methods of counts_a and counts_c)
+    @property
+    def W_a(self):
+        return self.counts_a.counts
+
+    @W_a.setter
+    def W_a(self, value):
+        self.counts_a = count_matrix(value, prior=self.tau, backend=self.count_backend, dtype=self.count_dtype)
+
+    @property
+    def W_c(self):
+        return self.counts_c.counts
+
+    @W_c.setter
+    def W_c(self, value):
+        self.counts_c = count_matrix(value, prior=self.eta, backend=self.count_backend, dtype=self.count_dtype)
+
     ## Initialise counts given initial values of t, s and z
     def init_counts(self):
         # Session-level topics
@@ -108,8 +142,7 @@ class anchor_model:
         # Chain-level topics
         self.U = np.zeros(self.H, dtype=int)
         # Obtain W_a and W_c
-        self.W_a = np.zeros(shape=(self.K, self.V), dtype=int)   
-        self.W_c = np.zeros(shape=(self.H, self.V), dtype=int)          
+        W_a = np.zeros(shape=(self.K, self.V), dtype=int)   
         # Initialise quantities 
         Q_t = Counter(self.t)
         Q_u = Counter(self.u)
@@ -117,14 +150,11 @@ class anchor_model:
             self.T[topic] += Q_t[topic]
         for topic in Q_u:
             self.U[topic] += Q_u[topic]
-        # Obtain W_a and W_c
-        for doc in self.w_a:
-            td = self.t[doc]
-            for j in range(self.N[doc]):
-                anchor = self.w_a[doc][j]
-                self.W_a[td, anchor] += 1
-                for w in self.w_c[doc][j]:
-                    self.W_c[self.u[anchor], w] += 1
+        # Obtain W_a and W_c (W_c is the sum of the rows of the anchor-to-chain counts of the anchor words in each chain-level topic)
+        np.add.at(W_a, (np.repeat(self.t, self.N), self.anchors), 1)
+        U_indicators = csr_matrix((np.ones(self.V, dtype=int), (self.u, np.arange(self.V))), shape=(self.H, self.V))
+        self.W_a = W_a
+        self.W_c = (U_indicators @ self.anchor_chain).toarray()
 
     ## Initialise from other topic model object
     def init_from_other(self, other):
@@ -179,8 +209,8 @@ class anchor_model:
             if not isinstance(H_init, int) or H_init < 1:
                 raise ValueError('H_init must be an integer value larger or equal to 1.')
         # Random initialisation
-        self.t = np.random.choice(K_init, size=self.D)
-        self.u = np.random.choice(H_init, size=self.V)
+        self.t = self.rng.generator.integers(K_init, size=self.D)
+        self.u = self.rng.generator.integers(H_init, size=self.V)
         ## Initialise counts
         self.init_counts()
 
@@ -214,23 +244,8 @@ class anchor_model:
         U, S, _ = svds(cooccurrence_matrix.asfptype(), k=K_init)
         kmod = KMeans(n_clusters=K_init, random_state=random_state).fit(U[:,::-1] * (S[::-1] ** .5))
         self.t = kmod.labels_
-        # Build co-occurrence matrix for chain words
-        cooccurrence_matrix = {}
-        for v in range(self.V):
-            cooccurrence_matrix[v] = Counter()
-        for d in self.w_c:
-            for j in range(self.N[d]):
-                cooccurrence_matrix[self.w_a[d][j]] += Counter(self.w_c[d][j])
-        # Obtain matrix
-        vals = []; rows = []; cols = []
-        for key in cooccurrence_matrix:
-            vals += list(cooccurrence_matrix[key].values())
-            rows += [key] * len(cooccurrence_matrix[key])
-            cols += list(cooccurrence_matrix[key].keys())
-        # Co-occurrence matrix
-        cooccurrence_matrix = coo_matrix((vals, (rows, cols)), shape=(self.V, self.V))
-        ## Spectral decomposition
-        U, S, _ = svds(cooccurrence_matrix.asfptype(), k=H_init)
+        ## Spectral decomposition of the co-occurrence matrix for chain words (anchor-to-chain counts)
+        U, S, _ = svds(self.anchor_chain.asfptype(), k=H_init)
         kmod = KMeans(n_clusters=K_init, random_state=random_state).fit(U[:,::-1] * (S[::-1] ** .5))
         self.u = kmod.labels_     
         # Initialise counts
@@ -240,66 +255,54 @@ class anchor_model:
     def resample_anchor_topics(self, size=1, indices=None):
         # Optional input: subset - list of integers in {0,1,...,D-1}
         if indices is None:
-            indices = np.random.choice(self.D, size=size)
+            indices = self.rng.generator.integers(self.D, size=size)
         # Resample each document
         for d in indices:
             td_old = self.t[d]
             # Remove counts
             self.T[td_old] -= 1
-            Wd = Counter(self.w_a[d])
-            for v in Wd:
-                self.W_a[td_old,v] -= Wd[v]
+            Wv, Wn = np.unique(self.w_a[d], return_counts=True)
+            self.counts_a.add(td_old, Wv, -Wn)
             # Calculate allocation probabilities
-            probs = np.log(self.gamma + self.T)
-            for v in Wd:
-                probs += np.sum(np.log(np.add.outer(self.tau + self.W_a[:,v], np.arange(Wd[v]))), axis=1)
-            probs -= np.sum(np.log(np.add.outer(np.sum(self.tau + self.W_a, axis=1), np.arange(np.sum(list(Wd.values()))))), axis=1)
-            # Transform the probabilities
-            probs = np.exp(probs - logsumexp(probs))
-            # Resample session-level topic
-            td_new = np.random.choice(len(probs), p=probs)
+            probs = lookup_log(self.gamma, self.T)
+            probs += self.counts_a.logpredictive(Wv, Wn)
+            # Resample session-level topic (inverse CDF on the unnormalised weights)
+            td_new = self.rng.log_categorical(probs)
             self.t[d] = td_new
             # Update counts
             self.T[td_new] += 1
-            for v in Wd:
-                self.W_a[td_new,v] += Wd[v]
+            self.counts_a.add(td_new, Wv, Wn)
 
     ## Resample chain-level topics
     def resample_chain_topics(self, size=1, indices=None):
         if indices is None:
-            indices = np.random.choice(self.V, size=size)
+            indices = self.rng.generator.integers(self.V, size=size)
         for v in indices:
             uv_old = self.u[v]
             # Remove counts
             self.U[uv_old] -= 1
-            Wv = Counter()
-            for d in self.w_c:
-                for j in range(self.N[d]):
-                    if self.w_a[d][j] == v:
-                        Wv += Counter(self.w_c[d][j])
-            for vv in Wv:
-                self.W_c[uv_old,vv] -= Wv[vv]
+            # Chain words of the commands with anchor word v (row of the anchor-to-chain counts)
+            Wvv = self.anchor_chain.indices[self.anchor_chain.indptr[v]:self.anchor_chain.indptr[v+1]]
+            Wvn = self.anchor_chain.data[self.anchor_chain.indptr[v]:self.anchor_chain.indptr[v+1]]
+            self.counts_c.add(uv_old, Wvv, -Wvn)
             # Calculate allocation probabilities
-            probs = np.log(self.chi + self.U[uv_old])
-            for vv in Wv:
-                probs += np.sum(np.log(np.add.outer(self.eta + self.W_c[:,vv], np.arange(Wv[vv]))), axis=1)
-            probs -= np.sum(np.log(np.add.outer(np.sum(self.eta + self.W_c, axis=1), np.arange(np.sum(list(Wv.values()))))), axis=1)
-            # Transform the probabilities
-            probs = np.exp(probs - logsumexp(probs))
-            # Resample command-level topic
-            u_new = np.random.choice(len(probs), p=probs)
+            probs = lookup_log(self.chi, self.U)
+            probs += self.counts_c.logpredictive(Wvv, Wvn)
+            # Resample command-level topic (inverse CDF on the unnormalised weights)
+            u_new = self.rng.log_categorical(probs)
             self.u[v] = u_new
             # Update counts
             self.U[u_new] += 1
-            for vv in Wv:
-                self.W_c[u_new,vv] += Wv[vv]
+            self.counts_c.add(u_new, Wvv, Wvn)
 
     ## Runs MCMC chain
-    def MCMC(self, iterations, burnin=0, size=1, verbose=True, calculate_ll=False, jupy_out=False, return_t=True, return_u=True, thinning=1):
+    def MCMC(self, iterations, burnin=0, size=1, verbose=True, calculate_ll=False, jupy_out=False, return_t=True, return_u=True, thinning=1, progress=None):
+        # Optional input: progress - progress_monitor for the progress and metrics reports (if None and verbose is True, reports are printed or displayed if jupy_out is True)
         # Moves
         moves = ['t','u']
         moves_probs = [1,1]
         moves_probs /= np.sum(moves_probs)
+        moves_cdf = np.cumsum(moves_probs)
         ## Marginal posterior
         if calculate_ll:
             ll = []
@@ -309,10 +312,13 @@ class anchor_model:
             t_out = np.zeros((Q,self.D),dtype=int)
         if return_u:
             u_out = np.zeros((Q,self.V),dtype=int)
+        monitor = default_monitor(progress, verbose, jupy_out)
+        if monitor is not None:
+            monitor.start(iterations, burnin)
         ## Run MCMC
         for it in range(iterations+burnin):
             # Sample move
-            move = np.random.choice(moves, p=moves_probs)
+            move = moves[self.rng.categorical_cdf(moves_cdf)]
             # Do move
             if move == 't':
                 self.resample_anchor_topics(size=size)
@@ -320,26 +326,9 @@ class anchor_model:
                 self.resample_chain_topics(size=size)
             if calculate_ll:
                 ll += [self.marginal_loglikelihood()]
-            # Print progression
-            if verbose:
-                if it < burnin:
-                    if jupy_out:
-                        clear_output(wait=True)
-                        display('Burnin: ' + str(it+1) + ' / ' + str(burnin)) 
-                    else:
-                        print('\rBurnin: ', str(it+1), ' / ', str(burnin), sep='', end=' ', flush=True)
-                elif it == burnin and burnin > 0:
-                    if jupy_out:
-                        clear_output(wait=True)
-                        display('Progression: ' + str(it-burnin+1) + ' / ' + str(iterations)) 
-                    else:
-                        print('\nProgression: ', str(it-burnin+1), ' / ', str(iterations), sep='', end=' ', flush=True)
-                else:
-                    if jupy_out:
-                        clear_output(wait=True)
-                        display('Progression: ' + str(it-burnin+1) + ' / ' + str(iterations))         
-                    else:
-                        print('\rProgression: ', str(it-burnin+1), ' / ', str(iterations), sep='', end=' ', flush=True)
+            # Progress report (rate-limited), with the number of topics resampled by the move
+            if monitor is not None and monitor.due(it, size):
+                monitor.report(it, loglik=ll[-1] if calculate_ll else None)
             ## Store output
             if it >= burnin and (it - burnin) % thinning == 0:
                 q = (it - burnin) // thinning
@@ -347,6 +336,10 @@ class anchor_model:
                     t_out[q] = np.copy(self.t)
                 if return_u:
                     u_out[q] = np.copy(self.u)
+        if monitor is not None:
+            monitor.finish(iterations + burnin - 1, loglik=ll[-1] if calculate_ll and len(ll) > 0 else None)
+            if progress is None:
+                monitor.close()
         ## Output
         out = {}
         if calculate_ll:
@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+import os
+import numpy as np
+import multiprocessing
+from .corpus import packed_corpus, shared_corpus, attach_corpus
+from .topic_model import topic_model
+from .traces import packed_indicators
+from .convergence import convergence_monitor, convergence_quantities, summary_size, shared_summaries_size
+
+# Independent MCMC chains of the topic model run in parallel on a process pool.
+# The packed corpus is stored once in shared memory and attached (without copies) by the workers,
+# and each chain has its own random generator, seeded with a stream spawned from a single seed with np.random.SeedSequence.
+
+## Corpus attached by the worker processes and shared summaries of the convergence diagnostics (set by the initializer of the pool)
+worker_corpus = None
+worker_blocks = None
+worker_diagnostics = None
+
+## Attach the shared corpus in a worker process
+def init_worker(spec, diagnostics=None):
+    global worker_corpus, worker_blocks, worker_diagnostics
+    worker_corpus, worker_blocks = attach_corpus(spec)
+    worker_diagnostics = diagnostics
+
+## Run a single chain in a worker process
+def run_chain(chain, seed, model_args, init, init_args, mcmc_args, corpus=None):
+    """
+    Initialise a topic model on the shared corpus and run one MCMC chain.
+    Inputs: chain: Index of the chain; seed: np.random.SeedSequence of the chain; model_args: Arguments of topic_model (except W and seed);
+            init: Name of the initialisation method ('random', 'spectral', 'gensim' or 'custom'); init_args: Arguments of the initialisation method;
+            mcmc_args: Arguments of topic_model.MCMC; corpus: Packed corpus (the corpus attached by the worker if not provided)
+    Output: Index of the chain and output of MCMC
+    """
+    # Traces written to disk go to a separate subdirectory for each chain
+    if isinstance(mcmc_args.get('trace'), str):
+        mcmc_args = dict(mcmc_args, trace=os.path.join(mcmc_args['trace'], 'chain' + str(chain)))
+    # Each chain writes its own checkpoint file (e.g. checkpoint_chain0.npz)
+    if mcmc_args.get('checkpoint') is not None:
+        root, ext = os.path.splitext(mcmc_args['checkpoint'])
+        mcmc_args = dict(mcmc_args, checkpoint=root + '_chain' + str(chain) + ext)
+    # The convergence diagnostics of chains running in parallel are pooled through the shared summaries
+    if mcmc_args.get('convergence') is not None and corpus is None and worker_diagnostics is not None:
+        n_chains = (len(worker_diagnostics) - 1) // (len(convergence_quantities) * summary_size)
+        mcmc_args = dict(mcmc_args, convergence=convergence_monitor(**mcmc_args['convergence'], shared=(worker_diagnostics, chain, n_chains)))
+    # Independent random stream for each chain (the seed spawned for the chain by run_chains)
+    m = topic_model(W=worker_corpus if corpus is None else corpus, **dict(model_args, seed=seed))
+    getattr(m, init + '_init')(**init_args)
+    return chain, m.MCMC(**mcmc_args)
+
+## Gather the outputs of the chains into a single output
+def gather_chains(outputs):
+    """
+    Combine the outputs of MCMC for several chains, key by key.
+    Input: outputs: List of outputs of MCMC (one for each chain)
+    Output: Dictionary with the same keys: arrays (or lists) with the same shape in all chains are stacked along a new first axis (one entry for each chain),
+            dictionaries are gathered recursively, bit-packed traces of z are stacked, and the other values are returned as lists
+    """
+    out = {}
+    for key in outputs[0]:
+        values = [o[key] for o in outputs]
+        if all(isinstance(v, dict) for v in values):
+            out[key] = gather_chains(values)
+        elif all(isinstance(v, packed_indicators) for v in values) and len(set(v.packed.shape for v in values)) == 1:
+            # Bit-packed traces of z are stacked before unpacking (the offsets of the corpus are read from the first chain)
+            out[key] = packed_indicators(np.stack([v.packed for v in values]), values[0])
+        elif all(isinstance(v, (np.ndarray, list)) for v in values) and len(set(np.shape(v) for v in values)) == 1:
+            out[key] = np.stack([np.asarray(v) for v in values])
+        else:
+            out[key] = values
+    return out
+
+## Run independent MCMC chains in parallel
+def run_chains(W, n_chains, seed=None, processes=None, model_args={}, init='random', init_args={}, mcmc_args={}):
+    """
+    Run independent MCMC chains of the topic model in parallel, with the corpus in shared memory.
+    Inputs: W: Dictionary of dictionaries containing the words, or packed_corpus; n_chains: Number of chains;
+            seed: Seed of the chains (each chain uses an independent stream spawned from it, so the results are reproducible for a given seed);
+            processes: Number of worker processes (default: min(n_chains, number of CPUs));
+            model_args: Arguments of topic_model (except W and seed); init: Name of the initialisation method ('random', 'spectral', 'gensim' or 'custom');
+            init_args: Arguments of the initialisation method; mcmc_args: Arguments of topic_model.MCMC
+            (with convergence in mcmc_args, the convergence diagnostics are pooled across the chains if processes is at least n_chains)
+    Output: Outputs of MCMC gathered by gather_chains (first axis: chain)
+    """
+    if not isinstance(n_chains, int) or n_chains < 1:
+        raise ValueError('n_chains must be a positive integer.')
+    if init not in ['random', 'spectral', 'gensim', 'custom']:
+        raise ValueError('init must be random, spectral, gensim or custom.')
+    seeds = np.random.SeedSequence(seed).spawn(n_chains)
+    if processes is None:
+        processes = min(n_chains, multiprocessing.cpu_count())
+    jobs = [(chain, seeds[chain], model_args, init, init_args, mcmc_args) for chain in range(n_chains)]
+    if processes == 1:
+        corpus = packed_corpus(W)
+        results = [run_chain(*job, corpus=corpus) for job in jobs]
+    else:
+        shared = shared_corpus(W)
+        diagnostics = None
+        # The diagnostics are pooled only if all the chains run at the same time
+        if mcmc_args.get('convergence') is not None and processes >= n_chains:
+            diagnostics = multiprocessing.RawArray('d', shared_summaries_size(n_chains))
+        try:
+            with multiprocessing.Pool(processes, initializer=init_worker, initargs=(shared.spec, diagnostics)) as pool:
+                results = pool.starmap(run_chain, jobs)
+        finally:
+            shared.unlink()
+    results = sorted(results, key=lambda x: x[0])
+    return gather_chains([out for _, out in results])
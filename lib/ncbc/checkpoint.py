@@ -0,0 +1,81 @@
+#! /usr/bin/env python3
+import os
+import json
+import queue
+import threading
+import numpy as np
+
+# Checkpoints of the state of a sampler, stored as a single uncompressed .npz archive of arrays (no pickling).
+# The archive is first written to a temporary file in the same directory and then renamed, so a checkpoint is either complete or absent.
+# Non-array entries (e.g. the arguments of MCMC) are stored as JSON strings.
+
+## Write a checkpoint atomically
+def save_checkpoint(path, state):
+    """
+    Write the state of a sampler to a checkpoint file, replacing the previous checkpoint only when the new one is complete.
+    Inputs: path: Checkpoint file; state: Dictionary of arrays (and scalars)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **state)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+## Read a checkpoint
+def load_checkpoint(path):
+    """
+    Read the state of a sampler from a checkpoint file.
+    Input: path: Checkpoint file
+    Output: Dictionary of arrays
+    """
+    with np.load(path, allow_pickle=False) as f:
+        return {key: f[key] for key in f.files}
+
+## Encode a JSON-serialisable object as an array (for storage in a checkpoint)
+def json_array(x):
+    return np.array(json.dumps(x))
+
+## Decode an array created by json_array
+def from_json_array(x):
+    return json.loads(str(x))
+
+class checkpoint_writer:
+
+    # Background writer of checkpoints: the states are written by a separate thread, so sampling continues during the writes.
+    # At most one write is pending: if a new state is submitted while a write is still pending, write waits for it.
+    # The arrays of the state must not be modified after submission (the sampler submits copies).
+    # Required input: path - checkpoint file
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    ## Write the submitted states until None is received
+    def run(self):
+        while True:
+            state = self.pending.get()
+            if state is None:
+                break
+            try:
+                save_checkpoint(self.path, state)
+            except Exception as e:
+                self.error = e
+
+    ## Submit a state for writing
+    def write(self, state):
+        if self.error is not None:
+            raise self.error
+        self.pending.put(state)
+
+    ## Wait for the pending write and stop the thread
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,88 @@
+#! /usr/bin/env python3
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.cluster import AgglomerativeClustering
+
+class coclustering_counts:
+
+    # Online posterior similarity matrix of a clustering (e.g. t or s) accumulated during MCMC, so that the samples do not need to be stored.
+    # The counts of the pairs of items allocated to the same topic are kept in a sparse matrix (only the pairs that co-cluster in some sample are stored).
+    # The samples are buffered and added in batches: if M is the sparse indicator matrix of the topics of the buffered samples (one column per topic
+    # of each sample), the pair counts of the batch are M M^T. The counts do not depend on the labels of the topics (label switching).
+    # Memory: one entry is stored for each pair of items allocated to the same topic in some sample, so with n items in K topics of similar size
+    # the matrix has about n^2 / K non-zero entries (e.g. 10^5 sessions in 10 topics give 10^9 entries, about 12GB with the int64 counts and int32 indices).
+    # The accumulator suits corpora where this is acceptable. The point estimate (estimate) runs AgglomerativeClustering on the dense n x n distance matrix
+    # (8 n^2 bytes, e.g. 80GB for 10^5 sessions), as estimate_t and estimate_s do with the stored samples.
+    # Required input: n - number of items; Optional input: batch_size - number of samples in the buffer
+
+    def __init__(self, n, batch_size=64):
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError('batch_size must be a positive integer.')
+        self.n = n
+        self.batch_size = batch_size
+        self.counts = csr_matrix((n, n), dtype=np.int64)
+        self.samples = 0
+        self.buffer = []
+
+    ## Add a sample of the labels of the items
+    def add(self, labels):
+        if len(labels) != self.n:
+            raise ValueError('The number of labels must be equal to the number of items.')
+        self.buffer.append(np.array(labels))
+        self.samples += 1
+        if len(self.buffer) == self.batch_size:
+            self.flush()
+
+    ## Add the pair counts of the buffered samples
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        cols = []; offset = 0
+        for labels in self.buffer:
+            _, inverse = np.unique(labels, return_inverse=True)
+            cols.append(offset + inverse)
+            offset += np.max(inverse) + 1
+        rows = np.tile(np.arange(self.n), len(self.buffer))
+        M = csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, np.concatenate(cols))), shape=(self.n, offset))
+        self.counts = self.counts + M @ M.T
+        self.buffer = []
+
+    ## Add the counts of another accumulator (e.g. of another chain)
+    def merge(self, other):
+        if other.n != self.n:
+            raise ValueError('The accumulators must have the same number of items.')
+        self.flush(); other.flush()
+        self.counts = self.counts + other.counts
+        self.samples += other.samples
+
+    ## Posterior similarity matrix (sparse)
+    def psm(self):
+        """
+        Estimate the posterior probability that each pair of items is allocated to the same topic.
+        Output: Sparse n x n matrix (csr) with the proportion of samples in which each pair co-clusters
+        """
+        if self.samples == 0:
+            raise ValueError('No samples have been added.')
+        self.flush()
+        return self.counts.astype(float) / self.samples
+
+    ## Point estimate of the clustering
+    def estimate(self, K, linkage='average'):
+        """
+        Estimate the clustering using hierarchical clustering on the posterior similarity matrix.
+        Inputs: K: Number of clusters; linkage: Linkage criterion of AgglomerativeClustering
+        Output: Vector of cluster labels of the items
+        """
+        cluster_model = AgglomerativeClustering(n_clusters=K, metric='precomputed', linkage=linkage)
+        return cluster_model.fit_predict(1 - self.psm().toarray())
+
+    ## State as a dictionary of arrays (for checkpoints)
+    def get_state(self):
+        self.flush()
+        return {'data': np.copy(self.counts.data), 'indices': np.copy(self.counts.indices), 'indptr': np.copy(self.counts.indptr), 'samples': np.array(self.samples)}
+
+    ## Restore the output of get_state
+    def set_state(self, state):
+        self.counts = csr_matrix((state['data'], state['indices'], state['indptr']), shape=(self.n, self.n))
+        self.samples = int(state['samples'])
+        self.buffer = []
@@ -0,0 +1,225 @@
+#! /usr/bin/env python3
+import time
+import numpy as np
+
+# Online convergence diagnostics of MCMC chains, computed without storing the traces.
+# Each monitored quantity (running log-likelihood, number of occupied topics) is summarised by running_batches: exact means and variances
+# of consecutive batches, whose number is bounded by merging adjacent batches (the batch size doubles), so the cost of each value is O(1).
+# The effective sample size is the batch means estimate, and the split-R-hat compares the two halves of the chain (and of the other chains, if shared).
+
+## Quantities monitored by the samplers (in the order of the shared summaries)
+convergence_quantities = ['loglik', 'K', 'H']
+
+## Number of entries of the shared summary of a quantity: n, mean and variance of the two halves, and effective sample size
+summary_size = 7
+
+## Size of the shared array of summaries for n_chains chains (the last entry is set to 1 when the pooled diagnostics meet the thresholds)
+def shared_summaries_size(n_chains):
+    return n_chains * len(convergence_quantities) * summary_size + 1
+
+## Combine the count, mean and sum of squared deviations of two samples (Chan et al.)
+def combine_moments(n1, mean1, m21, n2, mean2, m22):
+    n = n1 + n2
+    if n == 0:
+        return 0, 0.0, 0.0
+    delta = mean2 - mean1
+    return n, mean1 + delta * n2 / n, m21 + m22 + delta ** 2 * n1 * n2 / n
+
+## Split-R-hat from the lengths, means and variances of a set of sequences
+def split_rhat(n, means, variances):
+    """
+    Potential scale reduction factor of a set of sequences (e.g. the two halves of each chain).
+    Inputs: n: Lengths of the sequences; means, variances: Means and variances of the sequences
+    Output: R-hat (1 if all the sequences are constant and equal, inf if they are constant and different, nan if there are fewer than 2 sequences)
+    """
+    n = np.asarray(n, dtype=float); means = np.asarray(means, dtype=float); variances = np.asarray(variances, dtype=float)
+    if len(n) < 2 or np.min(n) < 2:
+        return np.nan
+    length = np.mean(n)
+    W = np.mean(variances)
+    B = length * np.var(means, ddof=1)
+    if W == 0:
+        return 1.0 if B == 0 else np.inf
+    return float(np.sqrt(((length - 1) / length * W + B / length) / W))
+
+class running_batches:
+
+    # Online batch summary of a scalar sequence: count, mean and sum of squared deviations of consecutive batches of batch_size values.
+    # When max_batches batches are full, adjacent batches are merged (exactly) and the batch size doubles.
+    # Optional input: max_batches - maximum number of full batches (even, at least 4)
+
+    def __init__(self, max_batches=64):
+        if not isinstance(max_batches, int) or max_batches < 4 or max_batches % 2 != 0:
+            raise ValueError('max_batches must be an even integer larger or equal to 4.')
+        self.max_batches = max_batches
+        self.batch_size = 1
+        self.means = []; self.m2 = []
+        # Batch being filled
+        self.current = [0, 0.0, 0.0]
+
+    ## Number of values in the full batches
+    @property
+    def n(self):
+        return len(self.means) * self.batch_size
+
+    ## Add a value
+    def add(self, x):
+        n, mean, m2 = self.current
+        n += 1
+        delta = x - mean
+        mean += delta / n
+        m2 += delta * (x - mean)
+        if n < self.batch_size:
+            self.current = [n, mean, m2]
+            return
+        self.means.append(mean); self.m2.append(m2)
+        self.current = [0, 0.0, 0.0]
+        if len(self.means) == self.max_batches:
+            merged = [combine_moments(self.batch_size, self.means[b], self.m2[b], self.batch_size, self.means[b+1], self.m2[b+1]) for b in range(0, self.max_batches, 2)]
+            self.means = [m for _, m, _ in merged]; self.m2 = [s for _, _, s in merged]
+            self.batch_size *= 2
+
+    ## Count, mean and variance of the values in a range of full batches
+    def moments(self, batches=slice(None)):
+        n, mean, m2 = 0, 0.0, 0.0
+        for b_mean, b_m2 in zip(self.means[batches], self.m2[batches]):
+            n, mean, m2 = combine_moments(n, mean, m2, self.batch_size, b_mean, b_m2)
+        return n, mean, (m2 / (n - 1) if n > 1 else 0.0)
+
+    ## Batch means estimate of the effective sample size (0 if fewer than 4 batches are full)
+    def ess(self):
+        if len(self.means) < 4:
+            return 0.0
+        n, _, variance = self.moments()
+        batch_variance = np.var(self.means, ddof=1)
+        if batch_variance == 0:
+            return float(n)
+        return float(n * variance / (self.batch_size * batch_variance))
+
+    ## Count, mean and variance of the two halves of the full batches (the first batch is dropped if their number is odd)
+    def halves(self):
+        B = len(self.means) // 2
+        first = len(self.means) - 2 * B
+        return self.moments(slice(first, first + B)), self.moments(slice(first + B, None))
+
+    ## State as a dictionary of lists (for checkpoints)
+    def get_state(self):
+        return {'batch_size': self.batch_size, 'means': list(self.means), 'm2': list(self.m2), 'current': list(self.current)}
+
+    ## Restore the output of get_state
+    def set_state(self, state):
+        self.batch_size = int(state['batch_size'])
+        self.means = [float(x) for x in state['means']]; self.m2 = [float(x) for x in state['m2']]
+        self.current = [int(state['current'][0]), float(state['current'][1]), float(state['current'][2])]
+
+class convergence_monitor:
+
+    # Convergence-based stopping rule of an MCMC chain: the chain stops when every monitored quantity has effective sample size at least min_ess
+    # and split-R-hat at most max_rhat (checked every check_every samples), or when max_seconds seconds have elapsed.
+    # With shared summaries (see chains.run_chains), the diagnostics pool the chains running in parallel: the effective sample sizes are summed
+    # and the split-R-hat uses the two halves of every chain.
+    # Optional input: min_ess, max_rhat - thresholds (None for no threshold); max_seconds - wall-clock budget (None for no budget);
+    #                 check_every - number of samples between checks of the thresholds; max_batches - see running_batches;
+    #                 shared - (array, chain, n_chains): shared array of summaries (see shared_summaries_size), index of the chain and number of chains;
+    #                     the first chain meeting the thresholds sets the flag at the end of the array, and the other chains stop at their next check
+
+    def __init__(self, min_ess=None, max_rhat=None, max_seconds=None, check_every=100, max_batches=64, shared=None):
+        if not isinstance(check_every, int) or check_every < 1:
+            raise ValueError('check_every must be a positive integer.')
+        if min_ess is None and max_rhat is None and max_seconds is None:
+            raise ValueError('At least one of min_ess, max_rhat and max_seconds must be provided.')
+        self.args = {'min_ess': min_ess, 'max_rhat': max_rhat, 'max_seconds': max_seconds, 'check_every': check_every, 'max_batches': max_batches}
+        self.min_ess = min_ess
+        self.max_rhat = max_rhat
+        self.max_seconds = max_seconds
+        self.check_every = check_every
+        self.max_batches = max_batches
+        self.shared = shared
+        self.start()
+
+    ## Start monitoring the given quantities
+    def start(self, names=convergence_quantities, elapsed=0.0):
+        self.names = list(names)
+        self.batches = {name: running_batches(self.max_batches) for name in self.names}
+        self.samples = 0
+        self.start_time = time.perf_counter() - elapsed
+        self.stopped = None
+        self.last = {}
+        self.waiting = 0
+
+    ## Seconds elapsed since the start
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    ## Add a sample of the monitored quantities
+    def add(self, values):
+        for name in self.names:
+            self.batches[name].add(values[name])
+        self.samples += 1
+
+    ## Publish the summaries of the chain in the shared array
+    def publish(self):
+        array, chain, _ = self.shared
+        for q, name in enumerate(convergence_quantities):
+            if name in self.batches:
+                (n1, mean1, var1), (n2, mean2, var2) = self.batches[name].halves()
+                offset = (chain * len(convergence_quantities) + q) * summary_size
+                array[offset:offset + summary_size] = [n1, mean1, var1, n2, mean2, var2, self.batches[name].ess()]
+
+    ## Effective sample size and split-R-hat of each quantity (pooled across the chains if shared)
+    def diagnostics(self):
+        if self.shared is not None:
+            self.publish()
+            array, _, n_chains = self.shared
+            summaries = np.array(array[:-1]).reshape(n_chains, len(convergence_quantities), summary_size)
+            # Chains that have not published a summary of their first quantity yet
+            self.waiting = int(np.sum(summaries[:, convergence_quantities.index(self.names[0]), 0] == 0))
+        out = {}
+        for name in self.names:
+            if self.shared is None:
+                (n1, mean1, var1), (n2, mean2, var2) = self.batches[name].halves()
+                rows = np.array([[n1, mean1, var1, n2, mean2, var2, self.batches[name].ess()]])
+            else:
+                rows = summaries[:, convergence_quantities.index(name)]
+                # Chains without full batches are not included
+                rows = rows[rows[:, 0] > 0]
+            n = np.append(rows[:, 0], rows[:, 3]); means = np.append(rows[:, 1], rows[:, 4]); variances = np.append(rows[:, 2], rows[:, 5])
+            out[name] = {'ess': float(np.sum(rows[:, 6])), 'rhat': split_rhat(n, means, variances)}
+        return out
+
+    ## Reason to stop after the last sample ('converged', 'time_budget' or None to continue)
+    def check(self):
+        if self.max_seconds is not None and self.elapsed >= self.max_seconds:
+            self.stopped = 'time_budget'
+        elif self.samples > 0 and self.samples % self.check_every == 0 and (self.min_ess is not None or self.max_rhat is not None):
+            if self.shared is not None and self.shared[0][-1] == 1:
+                # Another chain found that the pooled diagnostics meet the thresholds
+                self.stopped = 'converged'
+                return self.stopped
+            self.last = self.diagnostics()
+            if self.shared is not None and self.waiting > 0:
+                # Wait until all the chains have published their summaries
+                return None
+            if all((self.min_ess is None or d['ess'] >= self.min_ess) and (self.max_rhat is None or d['rhat'] <= self.max_rhat) for d in self.last.values()):
+                self.stopped = 'converged'
+                if self.shared is not None:
+                    self.shared[0][-1] = 1
+        return self.stopped
+
+    ## Summary of the diagnostics and of the reason of the stop ('iterations' if the chain ran all the iterations)
+    def summary(self):
+        diagnostics = self.diagnostics()
+        return {'stopped': 'iterations' if self.stopped is None else self.stopped, 'samples': self.samples, 'elapsed': self.elapsed,
+                    'ess': {name: d['ess'] for name, d in diagnostics.items()}, 'rhat': {name: d['rhat'] for name, d in diagnostics.items()}}
+
+    ## State as a JSON-serialisable dictionary (for checkpoints)
+    def get_state(self):
+        return {'names': self.names, 'samples': self.samples, 'elapsed': self.elapsed, 'batches': {name: b.get_state() for name, b in self.batches.items()}}
+
+    ## Restore the output of get_state
+    def set_state(self, state):
+        self.start(state['names'], elapsed=state['elapsed'])
+        self.samples = int(state['samples'])
+        for name in self.names:
+            self.batches[name].set_state(state['batches'][name])
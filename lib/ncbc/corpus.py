@@ -0,0 +1,236 @@
+#! /usr/bin/env python3
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+
+class packed_corpus:
+
+    # Packed (CSR-like) representation of a corpus of sessions and commands.
+    # The words of all the commands are stored in one contiguous array, and two offset arrays locate commands and sessions:
+    # - the words of command c are tokens[command_offsets[c]:command_offsets[c+1]]
+    # - the commands of session d are the indices session_offsets[d], ..., session_offsets[d+1]-1
+    # Commands are numbered consecutively across sessions, so the words of a session also form a contiguous block.
+    # Required input: W - dictionary of dictionaries containing the words (as consecutive integers starting at 0)
+
+    def __init__(self, W):
+        if isinstance(W, packed_corpus):
+            # The arrays are shared with W
+            for name in shared_arrays:
+                setattr(self, name, getattr(W, name))
+            self.init_indices(shared=True)
+        else:
+            if not isinstance(W, dict):
+                raise TypeError('W must be a dictionary of dictionaries or a packed_corpus.')
+            # Number of commands in each session and number of words in each command
+            N = np.array([len(W[d]) for d in W], dtype=int)
+            M = np.array([len(W[d][j]) for d in W for j in W[d]], dtype=int)
+            self.session_offsets = np.append(0, np.cumsum(N))
+            self.command_offsets = np.append(0, np.cumsum(M))
+            # Contiguous array of words
+            self.tokens = np.zeros(self.command_offsets[-1], dtype=int)
+            c = 0
+            for d in W:
+                for j in W[d]:
+                    self.tokens[self.command_offsets[c]:self.command_offsets[c+1]] = W[d][j]
+                    c += 1
+            self.init_indices()
+
+    ## Obtain sizes and inverse indices from the offsets
+    def init_indices(self, shared=False):
+        # Optional input: shared - if True, the inverse indices are already set (shared with another corpus or attached from shared memory)
+        # Number of sessions, commands and tokens
+        self.D = len(self.session_offsets) - 1
+        self.n_commands = int(self.session_offsets[-1])
+        self.n_tokens = int(self.command_offsets[-1])
+        # Number of commands in each session and number of words in each command
+        self.N = np.diff(self.session_offsets)
+        self.M = np.diff(self.command_offsets)
+        # Session of each command, command and session of each token
+        if not shared:
+            self.command_session = np.repeat(np.arange(self.D), self.N)
+            self.token_command = np.repeat(np.arange(self.n_commands), self.M)
+            self.token_session = self.command_session[self.token_command]
+        # Observed vocabulary size
+        self.V = int(np.max(self.tokens)) + 1 if self.n_tokens > 0 else 0
+
+    ## Range of command indices for session d
+    def session_commands(self, d):
+        return slice(self.session_offsets[d], self.session_offsets[d+1])
+
+    ## Range of token indices for session d
+    def session_tokens(self, d):
+        return slice(self.command_offsets[self.session_offsets[d]], self.command_offsets[self.session_offsets[d+1]])
+
+    ## Range of token indices for command c (global command index)
+    def command_tokens(self, c):
+        return slice(self.command_offsets[c], self.command_offsets[c+1])
+
+    ## Token indices of a list of sessions (concatenated, in the order of the sessions)
+    def sessions_tokens(self, sessions):
+        sessions = np.asarray(sessions, dtype=int)
+        return concatenate_ranges(self.command_offsets[self.session_offsets[sessions]], self.command_offsets[self.session_offsets[sessions + 1]])
+
+    ## Token indices of a list of commands (global command indices, concatenated in the order of the commands)
+    def commands_tokens(self, commands):
+        commands = np.asarray(commands, dtype=int)
+        return concatenate_ranges(self.command_offsets[commands], self.command_offsets[commands + 1])
+
+    ## Global index of command j in session d
+    def command_index(self, d, j):
+        return self.session_offsets[d] + j
+
+    ## Dictionary view (d -> array) of a flat array aligned to the commands
+    def split_commands(self, x):
+        return {d: x[self.session_offsets[d]:self.session_offsets[d+1]] for d in range(self.D)}
+
+    ## Dictionary of dictionaries view (d -> j -> array) of a flat array aligned to the tokens
+    def split_tokens(self, x):
+        out = {}
+        for d in range(self.D):
+            out[d] = {}
+            for j in range(self.N[d]):
+                c = self.session_offsets[d] + j
+                out[d][j] = x[self.command_offsets[c]:self.command_offsets[c+1]]
+        return out
+
+    ## Flat array aligned to the commands from a dictionary (d -> array)
+    def pack_commands(self, x, dtype=int):
+        if isinstance(x, np.ndarray):
+            if x.shape != (self.n_commands,):
+                raise ValueError('The flat array must have one entry per command.')
+            return np.array(x, dtype=dtype)
+        out = np.zeros(self.n_commands, dtype=dtype)
+        for d in range(self.D):
+            if len(x[d]) != self.N[d]:
+                raise ValueError('The number of entries for session ' + str(d) + ' does not match the number of commands.')
+            out[self.session_offsets[d]:self.session_offsets[d+1]] = x[d]
+        return out
+
+    ## Flat array aligned to the tokens from a dictionary of dictionaries (d -> j -> array)
+    def pack_tokens(self, x, dtype=int):
+        if isinstance(x, np.ndarray):
+            if x.shape != (self.n_tokens,):
+                raise ValueError('The flat array must have one entry per token.')
+            return np.array(x, dtype=dtype)
+        out = np.zeros(self.n_tokens, dtype=dtype)
+        for d in range(self.D):
+            for j in range(self.N[d]):
+                c = self.session_offsets[d] + j
+                if len(x[d][j]) != self.M[c]:
+                    raise ValueError('The number of entries for command ' + str(j) + ' in session ' + str(d) + ' does not match the number of words.')
+                out[self.command_offsets[c]:self.command_offsets[c+1]] = x[d][j]
+        return out
+
+## Concatenation of the integer ranges start[i], ..., stop[i]-1
+def concatenate_ranges(start, stop):
+    lengths = np.asarray(stop) - np.asarray(start)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(np.asarray(start) - offsets, lengths) + np.arange(np.sum(lengths))
+
+## Arrays of a packed corpus stored in shared memory (the offsets, the tokens and the inverse indices)
+shared_arrays = ['tokens', 'session_offsets', 'command_offsets', 'command_session', 'token_command', 'token_session']
+
+class shared_corpus:
+
+    # Copy of the arrays of a packed corpus in shared memory blocks, so that other processes can attach the corpus without copying it.
+    # The blocks are created by the owner and described by spec (block name, shape and type of each array), which is passed to attach_corpus.
+    # The owner must call unlink when the corpus is no longer needed.
+    # Required input: corpus - packed_corpus or dictionary of dictionaries containing the words
+
+    def __init__(self, corpus):
+        corpus = packed_corpus(corpus)
+        self.blocks = {}
+        self.spec = {}
+        for name in shared_arrays:
+            x = np.ascontiguousarray(getattr(corpus, name))
+            self.blocks[name] = SharedMemory(create=True, size=max(x.nbytes, 1))
+            np.ndarray(x.shape, dtype=x.dtype, buffer=self.blocks[name].buf)[:] = x
+            self.spec[name] = (self.blocks[name].name, x.shape, x.dtype.str)
+
+    ## Release and remove the shared memory blocks
+    def unlink(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+## Attach a packed corpus stored in shared memory
+def attach_corpus(spec):
+    """
+    Build a packed corpus whose arrays are read-only views on the shared memory blocks of a shared_corpus.
+    Input: spec: Description of the shared arrays (shared_corpus.spec)
+    Output: packed_corpus and dictionary of the attached blocks (to be closed when the corpus is no longer needed)
+    """
+    blocks = {}
+    corpus = packed_corpus.__new__(packed_corpus)
+    for name in shared_arrays:
+        block_name, shape, dtype = spec[name]
+        blocks[name] = SharedMemory(name=block_name)
+        x = np.ndarray(shape, dtype=dtype, buffer=blocks[name].buf)
+        x.flags.writeable = False
+        setattr(corpus, name, x)
+    corpus.init_indices(shared=True)
+    return corpus, blocks
+
+class bag_of_words:
+
+    # Sparse word counts for each unit (command or session) of a packed corpus.
+    # Each entry is a distinct (unit, word) pair: the entries of unit u are words[offsets[u]:offsets[u+1]],
+    # with total counts in counts and counts of the primary words (z=1) in counts1.
+    # The primary counts are updated incrementally when indicators are flipped.
+    # Required input: corpus - packed_corpus; level - 'command' or 'session'
+
+    def __init__(self, corpus, level='command'):
+        if level not in ['command', 'session']:
+            raise ValueError('level must be command or session.')
+        self.level = level
+        # Unit of each token
+        units = corpus.token_command if level == 'command' else corpus.token_session
+        self.n_units = corpus.n_commands if level == 'command' else corpus.D
+        # Distinct (unit, word) pairs, in increasing order of unit and word
+        V = max(corpus.V, 1)
+        keys, self.token_entry, self.counts = np.unique(units * V + corpus.tokens, return_inverse=True, return_counts=True)
+        self.token_entry = self.token_entry.reshape(-1)
+        self.words = keys % V
+        self.entry_unit = keys // V
+        self.offsets = np.searchsorted(self.entry_unit, np.arange(self.n_units + 1))
+        # Number of tokens in each unit
+        self.M = np.bincount(units, minlength=self.n_units)
+        self.token_unit = units
+        # Primary counts (all words are primary until indicators are provided)
+        self.counts1 = np.copy(self.counts)
+        self.Z = np.copy(self.M)
+
+    ## Set the primary counts from a flat array of indicators aligned to the tokens
+    def set_indicators(self, z):
+        self.counts1 = np.bincount(self.token_entry, weights=z, minlength=len(self.counts)).astype(int)
+        self.Z = np.bincount(self.token_unit, weights=z, minlength=self.n_units).astype(int)
+
+    ## Update the primary counts after the indicators of the tokens in index changed by delta (+1 or -1)
+    def flip(self, index, delta):
+        np.add.at(self.counts1, self.token_entry[index], delta)
+        np.add.at(self.Z, self.token_unit[index], delta)
+
+    ## Distinct words and counts of unit u (primary words only if primary=True, all words otherwise)
+    def get(self, u, primary=True):
+        entries = slice(self.offsets[u], self.offsets[u+1])
+        if primary:
+            ns = self.counts1[entries]
+            return self.words[entries][ns > 0], ns[ns > 0]
+        else:
+            return self.words[entries], self.counts[entries]
+
+    ## Distinct words and counts of a list of units, concatenated: the bag of units[r] is words[offsets[r]:offsets[r+1]] (primary words only if primary=True)
+    def gather(self, units, primary=True):
+        units = np.asarray(units, dtype=int)
+        start = self.offsets[units]; stop = self.offsets[units + 1]
+        entries = concatenate_ranges(start, stop)
+        ns = self.counts1[entries] if primary else self.counts[entries]
+        keep = ns > 0
+        lengths = np.bincount(np.repeat(np.arange(len(units)), stop - start)[keep], minlength=len(units))
+        return np.append(0, np.cumsum(lengths)), self.words[entries][keep], ns[keep]
+
+    ## Distinct words and counts of the secondary words (z=0) of unit u
+    def get_secondary(self, u):
+        entries = slice(self.offsets[u], self.offsets[u+1])
+        ns = self.counts[entries] - self.counts1[entries]
+        return self.words[entries][ns > 0], ns[ns > 0]
@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+import numpy as np
+import warnings
+
+# Storage backends for the count matrices of the samplers (topic-word counts W and topic-command counts S).
+# All the backends share the same interface, used by count_matrix:
+# - reads: get(rows, cols) for single entries, rows(rows) for dense rows, columns(cols, rows) for dense column gathers, entries(row) for the non-zero entries of a row
+# - updates: add(row, cols, ns), add_at(rows, cols, ns), set_rows(rows, values), set_cols(cols, values)
+# - reshaping: pad(n_rows, n_cols), permute_rows(perm), permute_cols(perm)
+# The available backends are listed in count_backends and created with make_counts.
+
+class dense_counts:
+
+    # Dense count matrix stored in a numpy array, in row-major (order='C') or column-major (order='F') layout.
+    # The column-major layout makes the column gathers counts[:,vs] of the predictive terms contiguous.
+    # Required input: counts - 2D array of counts; Optional input: dtype - integer type of the counts, order - memory layout
+
+    def __init__(self, counts, dtype=None, order='C'):
+        self.counts = np.array(counts, dtype=dtype, order=order)
+        self.order = order
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    @property
+    def dtype(self):
+        return self.counts.dtype
+
+    ## Dense array of counts (the array used for storage, not a copy)
+    def to_array(self):
+        return self.counts
+
+    def get(self, rows, cols):
+        return self.counts[rows, cols]
+
+    def rows(self, rows):
+        return self.counts[rows]
+
+    def columns(self, cols, rows=slice(None)):
+        if isinstance(rows, slice):
+            return self.counts[rows, cols]
+        return self.counts[np.ix_(np.atleast_1d(rows), cols)]
+
+    def entries(self, row):
+        cols = np.flatnonzero(self.counts[row])
+        return cols, self.counts[row, cols]
+
+    def add(self, row, cols, ns):
+        self.counts[row, cols] += ns
+
+    def add_at(self, rows, cols, ns=1):
+        np.add.at(self.counts, (rows, cols), ns)
+
+    def set_rows(self, rows, values):
+        self.counts[rows] = values
+
+    def set_cols(self, cols, values):
+        self.counts[:,cols] = np.transpose(values)
+
+    def pad(self, n_rows, n_cols):
+        self.counts = np.asarray(np.pad(self.counts, ((0, n_rows - self.shape[0]), (0, n_cols - self.shape[1]))), order=self.order)
+
+    def permute_rows(self, perm):
+        self.counts = np.asarray(self.counts[perm], order=self.order)
+
+    def permute_cols(self, perm):
+        self.counts = np.asarray(self.counts[:,perm], order=self.order)
+
+class sparse_counts:
+
+    # Sparse count matrix stored as one hash table (dictionary column -> count) for each row, with only the non-zero counts.
+    # The memory scales with the number of non-zero counts rather than with the number of columns, at about sparse_entry_bytes per non-zero count
+    # (a dictionary slot and the keys), against the item size of dtype per entry for the dense backends: the sparse backend only saves memory below
+    # the density sparse_break_even(dtype) of non-zero counts (10% for 64-bit and 5% for 32-bit counts), and make_counts warns above it.
+    # The reads and updates loop over the entries in python, so it is always slower than the dense backends: it is meant for large vocabularies
+    # whose dense counts do not fit in memory.
+    # Required input: counts - 2D array of counts; Optional input: dtype - type of the dense arrays returned by the reads (default: type of counts)
+
+    def __init__(self, counts, dtype=None):
+        counts = np.asarray(counts)
+        self.dtype = counts.dtype if dtype is None else np.dtype(dtype)
+        self.n_cols = counts.shape[1]
+        self.table = [{} for _ in range(counts.shape[0])]
+        for r, c in zip(*np.nonzero(counts)):
+            self.table[r][int(c)] = counts[r, c].astype(self.dtype).item()
+
+    @property
+    def shape(self):
+        return (len(self.table), self.n_cols)
+
+    ## Dense array of counts (a new array)
+    def to_array(self):
+        return self.rows(slice(None))
+
+    def get(self, rows, cols):
+        rows, cols = np.broadcast_arrays(rows, cols)
+        out = np.array([self.table[r].get(int(c), 0) for r, c in zip(rows.ravel(), cols.ravel())], dtype=self.dtype)
+        return out.reshape(rows.shape) if rows.ndim > 0 else out[0]
+
+    def rows(self, rows):
+        index = np.arange(len(self.table))[rows]
+        out = np.zeros((np.size(index), self.n_cols), dtype=self.dtype)
+        for i, r in enumerate(np.atleast_1d(index)):
+            if len(self.table[r]) > 0:
+                out[i, list(self.table[r].keys())] = list(self.table[r].values())
+        return out if np.ndim(index) > 0 else out[0]
+
+    def columns(self, cols, rows=slice(None)):
+        index = np.atleast_1d(np.arange(len(self.table))[rows])
+        cols = [int(c) for c in cols]
+        return np.array([[self.table[r].get(c, 0) for c in cols] for r in index], dtype=self.dtype).reshape(len(index), len(cols))
+
+    def entries(self, row):
+        cols = np.array(sorted(self.table[row]), dtype=int)
+        return cols, np.array([self.table[row][c] for c in cols], dtype=self.dtype)
+
+    def add(self, row, cols, ns):
+        entries = self.table[row]
+        for c, n in zip(np.atleast_1d(cols), np.broadcast_to(ns, np.shape(np.atleast_1d(cols)))):
+            c = int(c)
+            value = entries.get(c, 0) + n.item()
+            if value == 0:
+                entries.pop(c, None)
+            else:
+                entries[c] = value
+
+    def add_at(self, rows, cols, ns=1):
+        rows, cols, ns = np.broadcast_arrays(rows, cols, ns)
+        for r, c, n in zip(rows.ravel(), cols.ravel(), ns.ravel()):
+            self.add(r, c, n)
+
+    def set_rows(self, rows, values):
+        for r, row in zip(np.atleast_1d(np.arange(len(self.table))[rows]), np.atleast_2d(values)):
+            cols = np.flatnonzero(row)
+            self.table[r] = dict(zip(cols.tolist(), np.asarray(row, dtype=self.dtype)[cols].tolist()))
+
+    def set_cols(self, cols, values):
+        values = np.atleast_2d(values)
+        for r in range(len(self.table)):
+            for c, n in zip(np.atleast_1d(cols), values[:,r]):
+                c = int(c)
+                if n == 0:
+                    self.table[r].pop(c, None)
+                else:
+                    self.table[r][c] = n.item()
+
+    def pad(self, n_rows, n_cols):
+        self.table += [{} for _ in range(n_rows - len(self.table))]
+        self.n_cols = n_cols
+
+    def permute_rows(self, perm):
+        self.table = [self.table[r] for r in perm]
+
+    def permute_cols(self, perm):
+        # New column of each old column
+        relabel = np.zeros(len(perm), dtype=int)
+        relabel[perm] = np.arange(len(perm))
+        self.table = [{int(relabel[c]): n for c, n in entries.items()} for entries in self.table]
+
+## Approximate memory (bytes) of a non-zero count in sparse_counts
+sparse_entry_bytes = 80
+
+## Density of non-zero counts below which sparse_counts uses less memory than a dense array of the given dtype
+def sparse_break_even(dtype):
+    return np.dtype(dtype).itemsize / sparse_entry_bytes
+
+## Available backends: dense row-major, dense column-major and sparse hash-row
+count_backends = {
+    'dense': lambda counts, dtype: dense_counts(counts, dtype=dtype, order='C'),
+    'dense_col': lambda counts, dtype: dense_counts(counts, dtype=dtype, order='F'),
+    'sparse': lambda counts, dtype: sparse_counts(counts, dtype=dtype)
+}
+
+## Create a count matrix with the given backend
+def make_counts(counts, backend='dense', dtype=None):
+    """
+    Store a count matrix with one of the backends in count_backends.
+    Inputs: counts: 2D array of counts; backend: Name of the backend ('dense', 'dense_col' or 'sparse'); dtype: Signed integer type of the counts (default: type of counts)
+    Output: Backend object storing the counts
+    """
+    if backend not in count_backends:
+        raise ValueError('backend must be one of ' + ', '.join(count_backends) + '.')
+    counts = np.asarray(counts)
+    if dtype is not None:
+        # The counts of a matrix never exceed its total, which is fixed during sampling
+        if not np.issubdtype(dtype, np.integer):
+            raise TypeError('dtype must be an integer type.')
+        # The counts are decremented by adding negative values, which unsigned types do not support
+        if not np.issubdtype(dtype, np.signedinteger):
+            raise ValueError('dtype must be a signed integer type (e.g. np.int16 or np.int32).')
+        if np.sum(counts) > np.iinfo(dtype).max:
+            raise ValueError('The total of the counts does not fit in ' + np.dtype(dtype).name + '.')
+    if backend == 'sparse' and counts.size > 0:
+        density = np.count_nonzero(counts) / counts.size
+        break_even = sparse_break_even(counts.dtype if dtype is None else dtype)
+        if density > break_even:
+            warnings.warn('The density of the counts ({:.1%}) is above the break-even density of the sparse backend ({:.1%}): '.format(density, break_even) +
+                          'a dense backend uses less memory and is faster.')
+    return count_backends[backend](counts, dtype)
@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+import numpy as np
+
+class move_profile:
+
+    # Per-move instrumentation of an MCMC chain: number of calls, latency of each call, acceptance of the metropolis-hastings moves
+    # and number of entries of the count matrices updated by each move.
+    # The latencies are binned in a fixed histogram per move, with bins_per_decade log-spaced bins between min_seconds and max_seconds
+    # (plus one bin on each side for the values outside), so the memory does not grow with the number of calls.
+    # The percentiles are the geometric midpoints of the bins, within a relative error of 10 ** (0.5 / bins_per_decade) - 1 (6% by default),
+    # clipped to the smallest and largest recorded latencies.
+
+    def __init__(self, min_seconds=1e-7, max_seconds=1e3, bins_per_decade=20):
+        self.log_min = np.log10(min_seconds)
+        self.bins_per_decade = bins_per_decade
+        self.n_bins = int(np.ceil((np.log10(max_seconds) - self.log_min) * bins_per_decade))
+        self.histogram = {}
+        self.total_time = {}
+        self.min_time = {}
+        self.max_time = {}
+        self.touched = {}
+        self.proposed = {}
+        self.accepted = {}
+
+    ## Histogram bin of a latency (0 and n_bins + 1 for the values outside [min_seconds, max_seconds))
+    def bin(self, seconds):
+        if seconds <= 0:
+            return 0
+        return int(min(max(np.floor((np.log10(seconds) - self.log_min) * self.bins_per_decade) + 1, 0), self.n_bins + 1))
+
+    ## Latency at a given rank of the histogram of a move
+    def quantile(self, move, q):
+        counts = self.histogram[move]
+        k = int(np.searchsorted(np.cumsum(counts), q / 100 * np.sum(counts), side='left'))
+        value = 10 ** (self.log_min + (k - 0.5) / self.bins_per_decade)
+        return float(min(max(value, self.min_time[move]), self.max_time[move]))
+
+    ## Record a call of a move (seconds: latency; touched: number of updated counts)
+    def record(self, move, seconds, touched=0):
+        if move not in self.histogram:
+            self.histogram[move] = np.zeros(self.n_bins + 2, dtype=int)
+            self.total_time[move] = 0.0
+            self.min_time[move] = seconds
+            self.max_time[move] = seconds
+            self.touched[move] = 0
+        self.histogram[move][self.bin(seconds)] += 1
+        self.total_time[move] += seconds
+        self.min_time[move] = min(self.min_time[move], seconds)
+        self.max_time[move] = max(self.max_time[move], seconds)
+        self.touched[move] += touched
+
+    ## Record the outcome of a metropolis-hastings proposal (accepted is None if the proposal was not made, e.g. a split-merge move on two sessions of a topic with no other session)
+    def record_acceptance(self, move, accepted):
+        if accepted is None:
+            return
+        self.proposed[move] = self.proposed.get(move, 0) + 1
+        self.accepted[move] = self.accepted.get(move, 0) + int(accepted)
+
+    ## Summary of the instrumentation for each move
+    def summary(self, percentiles=[50, 90, 99]):
+        """
+        Summarise the recorded calls.
+        Input: percentiles: Percentiles of the latency to report (approximated from the histogram)
+        Output: Dictionary move -> dictionary with calls, total_time, mean_time and p<q>_time (seconds), counts_touched and counts_per_call,
+                and proposals, accepted and acceptance_rate for the metropolis-hastings moves
+        """
+        out = {}
+        for move in set(self.histogram) | set(self.proposed):
+            entry = {}
+            if move in self.histogram:
+                calls = int(np.sum(self.histogram[move]))
+                entry['calls'] = calls
+                entry['total_time'] = float(self.total_time[move])
+                entry['mean_time'] = self.total_time[move] / calls
+                for q in percentiles:
+                    entry['p' + str(q) + '_time'] = self.quantile(move, q)
+                entry['counts_touched'] = int(self.touched[move])
+                entry['counts_per_call'] = self.touched[move] / calls
+            if move in self.proposed:
+                entry['proposals'] = self.proposed[move]
+                entry['accepted'] = self.accepted[move]
+                entry['acceptance_rate'] = self.accepted[move] / self.proposed[move]
+            out[move] = entry
+        return out
@@ -0,0 +1,64 @@
+#! /usr/bin/env python3
+import numpy as np
+
+# Compiled kernels for the token-level updates of the samplers.
+# Numba is optional: if it is not installed, the kernels run as plain Python functions on the same flat arrays (and MCMC warns when they are used).
+# Uncompiled, indicator_sweep is much slower than compiled but still several times faster per token than resample_indicators, which goes
+# through the count backends, so it is kept as the fallback.
+try:
+    from numba import njit
+    numba_available = True
+except ImportError:
+    numba_available = False
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+## Full sweep of the primary-secondary indicators over a sequence of tokens
+@njit(cache=True)
+def indicator_sweep(order, tokens, token_topic, token_group, z, W, W_totals, Z, M_star, eta, eta_sum, alpha, alpha0, gem,
+                        token_entry, token_unit, counts1, Z_bow, uniforms):
+    """
+    Resample the indicators z of the tokens in order, one at a time, updating all the counts in place.
+    Inputs: order: Token indices to resample; tokens: Word of each token; token_topic: Topic (row of W minus 1) of each token;
+            token_group: Index of Z and M_star for each token (topic if Z is shared, session otherwise); z: Flat indicators;
+            W: Word counts (row 0 for secondary words); W_totals: Row totals of W; Z, M_star: Primary and total counts for each group;
+            eta: V-dimensional prior on the words; eta_sum: Prior added to the row totals of W (sum of eta, or eta for the GEM prior); alpha, alpha0: Priors on the indicators; gem: If True, GEM prior on the words;
+            token_entry, token_unit, counts1, Z_bow: Entries, units and primary counts of the cached bag of words; uniforms: One uniform for each token in order
+    Output: Number of indicators changed and change in the marginal log-likelihood
+    """
+    changes = 0
+    delta_ll = 0.0
+    for m in range(len(order)):
+        n = order[m]
+        v = tokens[n]
+        row = token_topic[n] + 1
+        g = token_group[n]
+        z_old = int(z[n])
+        # Remove counts
+        Z[g] -= z_old
+        W[row * z_old, v] -= 1
+        W_totals[row * z_old] -= 1
+        # Calculate the unnormalised allocation probabilities
+        if gem:
+            w1 = eta[v] if W[row, v] == 0 else W[row, v]
+            w0 = eta[v] if W[0, v] == 0 else W[0, v]
+        else:
+            w1 = eta[v] + W[row, v]
+            w0 = eta[v] + W[0, v]
+        p1 = (alpha + Z[g]) * w1 / (eta_sum + W_totals[row])
+        p0 = (alpha0 + M_star[g] - 1 - Z[g]) * w0 / (eta_sum + W_totals[0])
+        # Resample z
+        z_new = 1 if uniforms[m] * (p0 + p1) < p1 else 0
+        z[n] = z_new
+        if z_new != z_old:
+            delta_ll += np.log(p1 / p0) if z_new == 1 else np.log(p0 / p1)
+            changes += 1
+            counts1[token_entry[n]] += z_new - z_old
+            Z_bow[token_unit[n]] += z_new - z_old
+        # Update counts
+        Z[g] += z_new
+        W[row * z_new, v] += 1
+        W_totals[row * z_new] += 1
+    return changes, delta_ll
@@ -0,0 +1,78 @@
+#! /usr/bin/env python3
+import numpy as np
+
+class membership_index:
+
+    # Inverted index of a vector of labels (e.g. the session-level topics t or the command-level topics s): the items with each label.
+    # The items of label k are stored in the first size[k] entries of buckets[k], and position[i] is the entry of item i in the bucket of its label,
+    # so moving an item to another label is O(1): it is swapped with the last item of its bucket and appended to the new bucket (doubling its length if full).
+    # Required input: labels - vector of non-negative integer labels
+
+    def __init__(self, labels):
+        self.build(labels)
+
+    ## Build the index from a vector of labels
+    def build(self, labels):
+        self.labels = np.array(labels, dtype=int)
+        n_labels = int(np.max(self.labels)) + 1 if len(self.labels) > 0 else 0
+        order = np.argsort(self.labels, kind='stable')
+        self.size = np.bincount(self.labels, minlength=n_labels)
+        offsets = np.append(0, np.cumsum(self.size))
+        self.buckets = [np.copy(order[offsets[k]:offsets[k+1]]) for k in range(n_labels)]
+        self.position = np.zeros(len(self.labels), dtype=int)
+        self.position[order] = np.arange(len(self.labels)) - np.repeat(offsets[:-1], self.size)
+
+    ## Number of labels in the index
+    @property
+    def n_labels(self):
+        return len(self.buckets)
+
+    ## Make room for the labels up to n_labels-1
+    def extend(self, n_labels):
+        if n_labels > self.n_labels:
+            self.buckets += [np.zeros(0, dtype=int) for _ in range(n_labels - self.n_labels)]
+            self.size = np.append(self.size, np.zeros(n_labels - len(self.size), dtype=int))
+
+    ## Move item i to label k
+    def move(self, i, k):
+        old = self.labels[i]
+        if old == k:
+            return
+        # Remove from the bucket of the old label (the last item of the bucket takes its entry)
+        p = self.position[i]
+        last = self.buckets[old][self.size[old] - 1]
+        self.buckets[old][p] = last
+        self.position[last] = p
+        self.size[old] -= 1
+        # Append to the bucket of the new label
+        self.extend(k + 1)
+        if self.size[k] == len(self.buckets[k]):
+            self.buckets[k] = np.append(self.buckets[k], np.zeros(max(len(self.buckets[k]), 1), dtype=int))
+        self.buckets[k][self.size[k]] = i
+        self.position[i] = self.size[k]
+        self.size[k] += 1
+        self.labels[i] = k
+
+    ## Move each item in items to the corresponding label in new_labels
+    def move_many(self, items, new_labels):
+        for i, k in zip(items, new_labels):
+            self.move(i, k)
+
+    ## Items with label k (in increasing order)
+    def members(self, k):
+        if k >= self.n_labels:
+            return np.zeros(0, dtype=int)
+        return np.sort(self.buckets[k][:self.size[k]])
+
+    ## Number of items with label k
+    def count(self, k):
+        return int(self.size[k]) if k < self.n_labels else 0
+
+    ## Relabel the items after a relabelling of the labels (relabel: new label of each old label)
+    def relabel(self, relabel):
+        buckets = [np.zeros(0, dtype=int) for _ in range(max(len(relabel), self.n_labels))]
+        size = np.zeros(len(buckets), dtype=int)
+        for k in range(self.n_labels):
+            buckets[relabel[k]] = self.buckets[k]; size[relabel[k]] = self.size[k]
+        self.buckets = buckets; self.size = size
+        self.labels = relabel[self.labels]
@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+import json
+import time
+from IPython.display import display, clear_output
+
+# Progress and metrics reports of the MCMC samplers.
+# A progress_monitor decides when a report is due (at most every `every` iterations and every `seconds` seconds), builds a record with
+# the iteration, throughput (updates of the variables per second), elapsed time, ETA (from the iterations per second) and the metrics provided
+# by the sampler (e.g. log-likelihood, K and H), and passes it to its sinks.
+# A sink is any object with a write(record) method (and optionally close()): terminal_sink, notebook_sink and jsonl_sink are provided.
+
+## Format a number of seconds as h:mm:ss
+def format_seconds(seconds):
+    seconds = int(round(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+## Format a record as a single line of text
+def format_record(record):
+    if record['phase'] == 'burnin':
+        text = 'Burnin: ' + str(record['iteration']) + ' / ' + str(record['burnin'])
+    else:
+        text = 'Progression: ' + str(record['iteration'] - record['burnin']) + ' / ' + str(record['iterations'])
+    text += ' | {:.1f} updates/s | elapsed {} | ETA {}'.format(record['rate'], format_seconds(record['elapsed']), format_seconds(record['eta']))
+    if record.get('loglik') is not None:
+        text += ' | loglik {:.3f}'.format(record['loglik'])
+    for name in ['K', 'H']:
+        if record.get(name) is not None:
+            text += ' | ' + name + ' ' + str(record[name])
+    return text
+
+class terminal_sink:
+
+    # Sink printing the reports on a single line of the terminal (a new line is started when the burnin ends)
+
+    def __init__(self):
+        self.phase = None
+
+    def write(self, record):
+        if self.phase == 'burnin' and record['phase'] == 'sampling':
+            print('')
+        self.phase = record['phase']
+        print('\r' + format_record(record), end=' ', flush=True)
+
+    def close(self):
+        if self.phase is not None:
+            print('')
+
+class notebook_sink:
+
+    # Sink replacing the output of a notebook cell with the last report
+
+    def write(self, record):
+        clear_output(wait=True)
+        display(format_record(record))
+
+class jsonl_sink:
+
+    # Sink appending each report as a line of JSON to a file (flushed after each line, so that the file can be tailed)
+    # Required input: path - output file; Optional input: mode - 'a' to append to an existing file, 'w' to overwrite it
+
+    def __init__(self, path, mode='a'):
+        if mode not in ['a', 'w']:
+            raise ValueError('mode must be a or w.')
+        self.path = path
+        self.file = open(path, mode)
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class progress_monitor:
+
+    # Rate-limited progress and metrics reports: the sampler calls due(it, updates) on every iteration (a counter and, at most, a clock read),
+    # with the number of variables updated in the iteration (e.g. size for a Gibbs move, all the variables for a sweep), and builds its metrics
+    # only when a report is due.
+    # Optional input: sinks - list of sinks (default: terminal_sink); every - minimum number of iterations between reports;
+    #                 seconds - minimum number of seconds between reports (0 for no time limit)
+
+    def __init__(self, sinks=None, every=1, seconds=0.5):
+        if not isinstance(every, int) or every < 1:
+            raise ValueError('every must be a positive integer.')
+        if seconds < 0:
+            raise ValueError('seconds must be non-negative.')
+        self.sinks = [terminal_sink()] if sinks is None else list(sinks)
+        self.every = every
+        self.seconds = seconds
+        self.start()
+
+    ## Start timing a chain with the given number of iterations (first: first iteration, e.g. when a chain is resumed)
+    def start(self, iterations=0, burnin=0, first=0):
+        self.iterations = iterations
+        self.burnin = burnin
+        self.first = first
+        self.start_time = time.perf_counter()
+        self.last_iteration = first - 1
+        self.last_time = -float('inf')
+        self.updates = 0
+
+    ## Whether a report is due after iteration it (updates: number of variables updated in the iteration)
+    def due(self, it, updates=1):
+        self.updates += updates
+        if it - self.last_iteration < self.every:
+            return False
+        return self.seconds == 0 or time.perf_counter() - self.last_time >= self.seconds
+
+    ## Report the progress after iteration it, with additional metrics (None values are omitted)
+    def report(self, it, **metrics):
+        now = time.perf_counter()
+        elapsed = now - self.start_time
+        done = it + 1 - self.first
+        iteration_rate = done / elapsed if elapsed > 0 else 0.0
+        remaining = self.iterations + self.burnin - it - 1
+        record = {'time': time.time(), 'iteration': it + 1, 'iterations': self.iterations, 'burnin': self.burnin,
+                    'phase': 'burnin' if it < self.burnin else 'sampling', 'elapsed': elapsed, 'updates': self.updates,
+                    'rate': self.updates / elapsed if elapsed > 0 else 0.0, 'eta': remaining / iteration_rate if iteration_rate > 0 else 0.0}
+        record.update({name: value for name, value in metrics.items() if value is not None})
+        for sink in self.sinks:
+            sink.write(record)
+        self.last_iteration = it
+        self.last_time = now
+
+    ## Report the last iteration (if it was not reported already)
+    def finish(self, it, **metrics):
+        if it > self.last_iteration:
+            self.report(it, **metrics)
+
+    ## Close the sinks
+    def close(self):
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+## Monitor used by the samplers
+def default_monitor(progress, verbose, jupy_out):
+    """
+    Select the progress monitor of a sampler.
+    Inputs: progress: progress_monitor provided by the user (or None); verbose: Whether the progress is reported; jupy_out: Whether the reports are displayed in a notebook
+    Output: progress if provided, otherwise a monitor with a terminal (or notebook) sink if verbose is True, and None if the progress is not reported
+    """
+    if progress is not None:
+        return progress
+    if verbose:
+        return progress_monitor(sinks=[notebook_sink() if jupy_out else terminal_sink()])
+    return None
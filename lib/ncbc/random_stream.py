@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+import numpy as np
+
+class random_stream:
+
+    # Random number generator of a sampler, based on its own np.random.Generator (so models and chains running in parallel never share a state).
+    # The single uniforms used by the moves are drawn in blocks of block_size, and the discrete distributions are sampled by inverse CDF on the cumulative sums
+    # of the weights, which avoids the validation and normalisation of Generator.choice on every draw.
+    # The metropolis-hastings acceptance draws use the same uniforms: log(u) < log-ratio (-log(u) is an exponential random variable).
+    # Optional input: seed - seed of the generator (integer, np.random.SeedSequence or None); block_size - number of uniforms drawn at once
+
+    def __init__(self, seed=None, block_size=4096):
+        if not isinstance(block_size, int) or block_size < 1:
+            raise ValueError('block_size must be a positive integer.')
+        self.generator = np.random.default_rng(seed)
+        self.block_size = block_size
+        self.block = np.zeros(0)
+        self.pos = 0
+
+    ## Single uniform in [0,1)
+    def uniform(self):
+        if self.pos == len(self.block):
+            self.block = self.generator.random(self.block_size)
+            self.pos = 0
+        u = self.block[self.pos]
+        self.pos += 1
+        return u
+
+    ## Array of n uniforms in [0,1) (the remaining uniforms of the block are used first)
+    def uniforms(self, n):
+        head = self.block[self.pos:self.pos + n]
+        self.pos += len(head)
+        if len(head) == n:
+            return head
+        return np.append(head, self.generator.random(n - len(head)))
+
+    ## Uniform integer in {0,...,n-1}
+    def integer(self, n):
+        return min(int(self.uniform() * n), n - 1)
+
+    ## Index sampled from the (unnormalised) cumulative sums of the weights
+    def categorical_cdf(self, cdf):
+        return min(int(np.searchsorted(cdf, self.uniform() * cdf[-1], side='right')), len(cdf) - 1)
+
+    ## Index sampled from unnormalised weights
+    def categorical(self, weights):
+        return self.categorical_cdf(np.cumsum(weights))
+
+    ## Index sampled from log-weights (-inf for impossible outcomes)
+    def log_categorical(self, log_weights):
+        return self.categorical_cdf(np.cumsum(np.exp(log_weights - np.max(log_weights))))
+
+    ## Metropolis-hastings acceptance with log-acceptance ratio log_ratio
+    def accept(self, log_ratio):
+        return np.log(self.uniform()) < log_ratio
+
+    ## State of the generator and of the block of uniforms (for checkpoints)
+    def get_state(self):
+        return self.generator.bit_generator.state, np.copy(self.block), self.pos
+
+    ## Restore the output of get_state
+    def set_state(self, bit_state, block, pos):
+        self.generator.bit_generator.state = bit_state
+        self.block = np.copy(block)
+        self.pos = int(pos)
@@ -0,0 +1,191 @@
+#! /usr/bin/env python3
+import numpy as np
+from scipy.special import loggamma
+from .utils import logB, logmarginal_rows, logmarginal_entries, bag_logpredictive, lookup_loggamma
+from .count_backends import make_counts, dense_counts
+
+class count_matrix:
+
+    # Count matrix with row totals, column totals and cached log-marginal likelihood of each row (see utils.logmarginal_rows).
+    # The totals are updated on every add or remove, and the cached terms are recomputed only for the rows changed since the last read,
+    # so the cost of an update scales with the number of entries it changes and not with the number of columns.
+    # The counts are stored with one of the backends of count_backends (dense row-major, dense column-major or sparse hash-row), and read through
+    # get, rows, columns and logpredictive, so the samplers do not depend on the storage.
+    # All the updates must go through the methods of the class: writing directly to the storage leaves the totals and the cache stale.
+    # n_updates counts the entries updated since the creation of the matrix (used by the instrumentation of the moves).
+    # Required input: counts - 2D array of counts; Optional input: prior, gem - prior used for the log-marginal likelihood of the rows;
+    #                 backend - name of the storage backend; dtype - integer type of the stored counts (default: type of counts)
+
+    def __init__(self, counts, prior=1.0, gem=False, backend='dense', dtype=None):
+        counts = np.asarray(counts)
+        if counts.ndim != 2:
+            raise ValueError('counts must be a 2D array.')
+        self.data = make_counts(counts, backend=backend, dtype=dtype)
+        self.backend = backend
+        self.prior = prior
+        self.gem = gem
+        self.totals = np.sum(counts, axis=1)
+        self.col_totals = np.sum(counts, axis=0)
+        # Cached log-marginal likelihood of the rows (computed on the first read)
+        self.row_ll = np.zeros(counts.shape[0])
+        self.dirty = np.ones(counts.shape[0], dtype=bool)
+        self.n_updates = 0
+
+    ## Number of rows and columns
+    @property
+    def shape(self):
+        return self.data.shape
+
+    ## Dense array of the counts (the stored array for the dense backends, a copy for the sparse backend)
+    @property
+    def counts(self):
+        return self.data.to_array()
+
+    ## Entries (rows, cols) of the counts
+    def get(self, rows, cols):
+        return self.data.get(rows, cols)
+
+    ## Dense rows of the counts
+    def rows(self, rows):
+        return self.data.rows(rows)
+
+    ## Dense columns cols of the rows in rows (all rows by default)
+    def columns(self, cols, rows=slice(None)):
+        return self.data.columns(cols, rows)
+
+    ## Log-predictive terms of a bag of words for the rows in rows (all rows by default), see utils.bag_logpredictive
+    def logpredictive(self, vs, ns, rows=slice(None)):
+        return bag_logpredictive(self, vs, ns, self.prior, totals=self.totals[rows], gem=self.gem, columns=self.data.columns(vs, rows))
+
+    ## Add ns to the entries (row, cols) of a single row (cols must be distinct)
+    def add(self, row, cols, ns):
+        self.data.add(row, cols, ns)
+        n = np.sum(ns)
+        self.totals[row] += n
+        self.col_totals[cols] += ns
+        self.dirty[row] = True
+        self.n_updates += np.size(cols)
+
+    ## Add ns to the entries (rows, cols), with repeated entries allowed
+    def add_at(self, rows, cols, ns=1):
+        self.data.add_at(rows, cols, ns)
+        np.add.at(self.totals, rows, ns)
+        np.add.at(self.col_totals, cols, ns)
+        self.dirty[rows] = True
+        self.n_updates += np.broadcast(rows, cols).size
+
+    ## Replace the rows in rows with values
+    def set_rows(self, rows, values):
+        values = np.atleast_2d(values).astype(self.data.dtype)
+        self.col_totals += np.sum(values, axis=0) - np.sum(self.data.rows(rows), axis=0)
+        self.data.set_rows(rows, values)
+        self.totals[rows] = np.sum(values, axis=1)
+        self.dirty[rows] = True
+        self.n_updates += values.size
+
+    ## Replace the columns in cols with values (one row of values for each column)
+    def set_cols(self, cols, values):
+        values = np.atleast_2d(values).astype(self.data.dtype)
+        self.totals += np.sum(values, axis=0) - np.sum(self.data.columns(cols), axis=1)
+        self.data.set_cols(cols, values)
+        self.col_totals[cols] = np.sum(values, axis=1)
+        self.dirty[:] = True
+        self.n_updates += values.size
+
+    ## Pad with empty rows and columns up to the given shape
+    def pad(self, n_rows=None, n_cols=None):
+        n_rows = self.shape[0] if n_rows is None else n_rows
+        n_cols = self.shape[1] if n_cols is None else n_cols
+        extra_rows = n_rows - self.shape[0]
+        extra_cols = n_cols - self.shape[1]
+        self.data.pad(n_rows, n_cols)
+        self.totals = np.append(self.totals, np.zeros(extra_rows, dtype=self.totals.dtype))
+        self.col_totals = np.append(self.col_totals, np.zeros(extra_cols, dtype=self.col_totals.dtype))
+        self.row_ll = np.append(self.row_ll, np.zeros(extra_rows))
+        self.dirty = np.append(self.dirty, np.ones(extra_rows, dtype=bool))
+
+    ## Reorder the rows
+    def permute_rows(self, perm):
+        self.data.permute_rows(perm)
+        self.totals = self.totals[perm]
+        self.row_ll = self.row_ll[perm]
+        self.dirty = self.dirty[perm]
+
+    ## Reorder the columns
+    def permute_cols(self, perm):
+        self.data.permute_cols(perm)
+        self.col_totals = self.col_totals[perm]
+
+    ## Log-marginal likelihood of the rows in rows (all rows if None), recomputing the rows changed since the last read
+    def loglik(self, rows=None):
+        stale = np.where(self.dirty)[0]
+        if len(stale) > 0:
+            if isinstance(self.data, dense_counts):
+                self.row_ll[stale] = logmarginal_rows(self.data.rows(stale), self.prior, gem=self.gem)
+            else:
+                # Sparse storage: the terms are computed from the non-zero entries of each row
+                for r in stale:
+                    self.row_ll[r] = logmarginal_entries(*self.data.entries(r), self.shape[1], self.prior, gem=self.gem)
+            self.dirty[stale] = False
+        return np.sum(self.row_ll if rows is None else self.row_ll[rows])
+
+class sufficient_statistics:
+
+    # Sufficient statistics of the collapsed topic model:
+    # T - number of sessions for each session-level topic; S - count_matrix of the command-level topics for each session-level topic (K x H);
+    # W - count_matrix of the words for each topic (row 0 for the secondary topic); Z, M_star - number of primary words and of words for each topic (or session)
+    # W0 - secondary words (z=0) of each topic (topics x V): row 0 of W split by topic, used by the label switching move (stored without totals)
+    # The priors and the GEM flags are used for the marginal log-likelihood; backend and dtype select the storage of S, W and W0 (see count_backends).
+
+    def __init__(self, T=None, W=None, S=None, Z=None, M_star=None, W0=None, gamma=1.0, tau=1.0, eta=1.0, alpha=1.0, alpha0=1.0, lambda_gem=False, psi_gem=False, phi_gem=False,
+                    backend='dense', dtype=None):
+        self.T = T
+        self.W = None if W is None else count_matrix(W, prior=eta, gem=phi_gem, backend=backend, dtype=dtype)
+        self.S = None if S is None else count_matrix(S, prior=tau, gem=psi_gem, backend=backend, dtype=dtype)
+        self.Z = Z
+        self.M_star = M_star
+        self.W0 = None if W0 is None else make_counts(W0, backend=backend, dtype=dtype)
+        self.gamma = gamma
+        self.alpha = alpha
+        self.alpha0 = alpha0
+        self.lambda_gem = lambda_gem
+
+    ## Marginal log-likelihood of a subset of the statistics (all the statistics if no subset is provided)
+    def loglik(self, t_topics=None, s_topics=None, w_rows=None, z_groups=None):
+        # Optional input: t_topics - entries of T; s_topics - rows of S; w_rows - rows of W; z_groups - entries of Z and M_star
+        full = t_topics is None and s_topics is None and w_rows is None and z_groups is None
+        ll = 0
+        # t | gamma
+        if full:
+            if self.lambda_gem:
+                ll += np.sum(self.T > 0) * np.log(self.gamma) + loggamma(self.gamma) - lookup_loggamma(self.gamma, np.sum(self.T)) + np.sum(lookup_loggamma(0, self.T[self.T > 0]))
+            elif np.ndim(self.gamma) == 0:
+                K = len(self.T)
+                ll += np.sum(lookup_loggamma(self.gamma, self.T)) - lookup_loggamma(self.gamma * K, np.sum(self.T)) - K * loggamma(self.gamma) + loggamma(self.gamma * K)
+            else:
+                ll += logB(self.gamma + self.T) - logB(self.gamma * np.ones(len(self.T)))
+        elif t_topics is not None and len(t_topics) > 0:
+            # The total of T is fixed, so only the entries in t_topics change
+            if self.lambda_gem:
+                T = self.T[t_topics]
+                ll += np.sum(T > 0) * np.log(self.gamma) + np.sum(lookup_loggamma(0, T[T > 0]))
+            elif np.ndim(self.gamma) == 0:
+                ll += np.sum(lookup_loggamma(self.gamma, self.T[t_topics]))
+            else:
+                ll += np.sum(loggamma((self.gamma + self.T)[t_topics]))
+        # s | t, tau
+        if self.S is not None and (full or (s_topics is not None and len(s_topics) > 0)):
+            ll += self.S.loglik(None if full else s_topics)
+        # w | s, t, z, eta
+        if full or (w_rows is not None and len(w_rows) > 0):
+            ll += self.W.loglik(None if full else w_rows)
+        # z | s, t, alpha, alpha0
+        if self.Z is not None and (full or (z_groups is not None and len(z_groups) > 0)):
+            groups = slice(None) if full else z_groups
+            Z = self.Z[groups]; M_star = self.M_star[groups]
+            if np.ndim(self.alpha) == 0 and np.ndim(self.alpha0) == 0:
+                ll += np.sum(lookup_loggamma(self.alpha, Z) + lookup_loggamma(self.alpha0, M_star - Z) - lookup_loggamma(self.alpha + self.alpha0, M_star))
+                ll -= len(Z) * (loggamma(self.alpha) + loggamma(self.alpha0) - loggamma(self.alpha + self.alpha0))
+            else:
+                ll += np.sum(logmarginal_rows(np.transpose([Z, M_star - Z]), np.array([self.alpha, self.alpha0])))
+        return ll
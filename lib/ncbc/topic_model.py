@@ -1,16 +1,34 @@
 #! /usr/bin/env python3
+import time
+import warnings
 import numpy as np
 from collections import Counter
-from scipy.special import logsumexp, loggamma
+from scipy.special import logsumexp
 from gensim.models import LdaModel
 from gensim.corpora import Dictionary
 from scipy.sparse import coo_matrix
 from scipy.sparse.linalg import svds
 from numpy.linalg import svd
 from sklearn.cluster import KMeans
-from .utils import logB
-from IPython.display import display, clear_output
-from functools import reduce
+from .utils import lookup_loggamma, lookup_log, lookup_log_rising, lookup_logB, bounded_logpredictive
+from .corpus import packed_corpus, bag_of_words, concatenate_ranges
+from .kernels import indicator_sweep, numba_available
+from .topic_slots import topic_slots, pad_slots
+from .sufficient_statistics import sufficient_statistics
+from .count_backends import count_backends
+from .traces import trace_sink, trace_reader, packed_indicators
+from .random_stream import random_stream
+from .checkpoint import checkpoint_writer, load_checkpoint, json_array, from_json_array
+from .progress import default_monitor
+from .instrumentation import move_profile
+from .convergence import convergence_monitor
+from .adaptation import move_scheduler
+from .coclustering import coclustering_counts
+from .membership import membership_index
+
+## Names of the moves of MCMC in the instrumentation output
+move_names = {'t': 'resample_session_topics', 's': 'resample_command_topics', 'z': 'resample_indicators', 'split_merge_session': 'split_merge_session',
+                'split_merge_command': 'split_merge_command', 'label_switch_z': 'MH_label_z', 'sweep': 'systematic_sweep'}
 
 class topic_model:
     
@@ -22,26 +40,17 @@ class topic_model:
     def __init__(self, W, K, H=0, V=0, fixed_V = True, secondary_topic = True, 
                     shared_Z = True, command_level_topics = True,
                     gamma=1.0, tau=1.0, eta=1.0, alpha=1.0, alpha0=1.0,
-                    lambda_gem=False, psi_gem=False, phi_gem=False, numpyfy=False):
+                    lambda_gem=False, psi_gem=False, phi_gem=False, numpyfy=False, count_backend='dense', count_dtype=None, seed=None):
         
-        # Documents & sentences (sessions & commands) in python dictionary form
-        if not numpyfy:
-            self.w = W
-        else:
-            self.w = {}
-            for d in W:
-                self.w[d] = {}
-                for s in W[d]:
-                    self.w[d][s] = np.array(W[d][s])
+        # Documents & sentences (sessions & commands) packed into contiguous arrays (numpyfy is kept for compatibility)
+        self.corpus = packed_corpus(W)
+        self._views = {}
         # Number of documents
-        self.D = len(W)
+        self.D = self.corpus.D
         # Length of each document
-        self.N = np.array([len(self.w[d]) for d in self.w])
+        self.N = self.corpus.N
         self.N_cumsum = np.cumsum(self.N)
         self.N_cumsum0 = np.append(0,self.N_cumsum)
-        self.M = {}
-        for d in self.w:
-            self.M[d] = [len(self.w[d][command]) for command in self.w[d]]
         # Determine V is fixed or unbounded - if fixed, determine if it is given as input
         if not isinstance(fixed_V, bool):
             raise TypeError('fixed_V must be True or False.')
@@ -70,14 +79,7 @@ class topic_model:
         if V > 0:
             self.V = V
         else:
-            self.V = 0
-            for d in W:
-                for j in range(self.N[d]):
-                    for i in range(self.M[d][j]):
-                        v = self.w[d][j][i]
-                        if v > self.V:
-                            self.V = v
-            self.V += 1
+            self.V = self.corpus.V
         # Secondary topics
         if not isinstance(secondary_topic, bool):
             raise TypeError('secondary_topic must be True or False.')
@@ -135,106 +137,269 @@ class topic_model:
         if H > 0 and not self.command_level_topics:
             raise ValueError('H can only be specified when command-level topics are used. Proposed solution: initialise H=0.')
         self.H = H
-        # Initialise dictionaries
+        # Initialise topics and indicators (flat arrays aligned to the commands and tokens of the packed corpus)
         self.t = np.zeros(self.D, dtype=int)
         if self.command_level_topics:
-            self.s = {}
+            self.s_flat = np.zeros(self.corpus.n_commands, dtype=int)
         if self.secondary_topic:
-            self.z = {}
+            self.z_flat = np.zeros(self.corpus.n_tokens, dtype=np.uint8)
+        # Cached bags of words (per command for command-level topics, per session otherwise)
+        self.bow = bag_of_words(self.corpus, level='command' if self.command_level_topics else 'session')
         # Multivariate hyperparameters
         self.multivariate_hyperparameters = False
+        # Storage of the count matrices S and W: 'dense' (row-major), 'dense_col' (column-major) or 'sparse' (hash-row), with an optional smaller signed integer type
+        if count_backend not in count_backends:
+            raise ValueError('count_backend must be one of ' + ', '.join(count_backends) + '.')
+        self.count_backend = count_backend
+        self.count_dtype = count_dtype
+        # Sufficient statistics (counts), set when the chain is initialised
+        self.stats = sufficient_statistics()
+        # Running marginal log-likelihood (updated by the moves only if track_ll is True)
+        self.track_ll = False
+        self.loglik = None
+        # Random number generator of the model (seed: integer, np.random.SeedSequence or None)
+        self.rng = random_stream(seed)
+
+    ## Dictionary views on the packed corpus and on the flat arrays s_flat and z_flat
+    ## The views share memory with the flat arrays, so they are always up to date
+    def dict_view(self, name, flat, split):
+        if name not in self._views or self._views[name][0] is not flat:
+            self._views[name] = (flat, split(flat))
+        return self._views[name][1]
+
+    @property
+    def w(self):
+        return self.dict_view('w', self.corpus.tokens, self.corpus.split_tokens)
+
+    @property
+    def M(self):
+        return self.dict_view('M', self.corpus.M, self.corpus.split_commands)
+
+    @property
+    def s(self):
+        if not self.command_level_topics:
+            raise AttributeError('Command-level topics are not used.')
+        return self.dict_view('s', self.s_flat, self.corpus.split_commands)
+
+    @s.setter
+    def s(self, value):
+        self.s_flat = self.corpus.pack_commands(value)
+
+    @property
+    def z(self):
+        if not self.secondary_topic:
+            raise AttributeError('Secondary topics are not used.')
+        return self.dict_view('z', self.z_flat, self.corpus.split_tokens)
+
+    @z.setter
+    def z(self, value):
+        self.z_flat = self.corpus.pack_tokens(value, dtype=np.uint8)
+
+    ## Count arrays, owned by the sufficient statistics (S and W are updated only through the methods of stats.S and stats.W)
+    ## S and W are dense arrays (a copy with the sparse backend): the samplers read them through stats.S and stats.W
+    @property
+    def T(self):
+        return self.stats.T
+
+    @T.setter
+    def T(self, value):
+        self.stats.T = value
+
+    @property
+    def S(self):
+        return self.stats.S.counts
+
+    @property
+    def W(self):
+        return self.stats.W.counts
+
+    @property
+    def Z(self):
+        return self.stats.Z
+
+    @Z.setter
+    def Z(self, value):
+        self.stats.Z = value
+
+    @property
+    def M_star(self):
+        return self.stats.M_star
+
+    @M_star.setter
+    def M_star(self, value):
+        self.stats.M_star = value
+
+    @property
+    def W0(self):
+        return self.stats.W0.to_array()
 
     ## Calculate marginal posterior
-    def marginal_loglikelihood(self):
-        ll = 0
-        if self.lambda_gem:
-            ll += self.K * np.log(self.gamma) + loggamma(self.gamma) - loggamma(self.gamma + self.D) + np.sum(loggamma(self.T))
-        else:
-            ll += logB(self.gamma + self.T) - logB(self.gamma * np.ones(self.K))
-        if self.command_level_topics:
-            if self.psi_gem:
-                ll += np.sum(np.sum(self.S > 0, axis=1) * np.log(self.tau) + loggamma(self.tau) - loggamma(self.tau + self.S.sum(axis=1)))
-                ll += np.nansum(loggamma(self.S) * (self.S > 0))
-            else:
-                ll += np.sum([logB(self.tau + self.S[k]) for k in range(self.K)]) - self.K * logB(self.tau * np.ones(self.H))
-            if self.phi_gem:
-                ll += np.sum(np.sum(self.W > 0, axis=1) * np.log(self.eta) + loggamma(self.eta) - loggamma(self.eta + self.W.sum(axis=1)))
-                ll += np.nansum(loggamma(self.W) * (self.W > 0))
-            else:
-                ll += np.sum([logB(self.eta + self.W[h]) for h in range(self.H + (1 if self.secondary_topic else 0))]) 
-                ll -= (self.H + (1 if self.secondary_topic else 0)) * logB(self.eta * np.ones(self.V))
-        else:
-            if self.phi_gem:
-                ll += np.sum(np.sum(self.W > 0, axis=1) * np.log(self.eta) + loggamma(self.eta) - loggamma(self.eta + self.W.sum(axis=1)))
-                ll += np.nansum(loggamma(self.W) * (self.W > 0))
-            else:
-                ll += np.sum([logB(self.eta + self.W[k]) for k in range(self.K + (1 if self.secondary_topic else 0))])
-                ll -= (self.K + (1 if self.secondary_topic else 0)) * logB(self.eta * np.ones(self.V))
-        if self.secondary_topic:
-            ll += np.sum([logB(np.array([self.alpha + self.Z[k], self.alpha0 + self.M_star[k] - self.Z[k]])) for k in range(self.H if self.command_level_topics else self.K)])
-            ll -= (self.H if self.command_level_topics else self.K) * logB(np.array([self.alpha, self.alpha0]))
-        return ll
+    def marginal_loglikelihood(self, cached=True):
+        # Optional input: cached - if False, the cached terms of the rows of S and W are recomputed from the counts
+        if not cached:
+            self.stats.W.dirty[:] = True
+            if self.command_level_topics:
+                self.stats.S.dirty[:] = True
+        return self.stats.loglik()
+
+    ## Terms of the marginal log-likelihood depending on a subset of the counts (used to update the running log-likelihood after a move)
+    def loglik_terms(self, t_topics=[], s_topics=[], w_rows=[], z_groups=[]):
+        # Optional input: t_topics - entries of T; s_topics - rows of S; w_rows - rows of W; z_groups - entries of Z and M_star
+        return self.stats.loglik(t_topics=t_topics, s_topics=s_topics, w_rows=w_rows, z_groups=z_groups)
 
     ## Initialise counts given initial values of t, s and z
     def init_counts(self):
+        # Number of topics (with GEM priors, the labels are slot ids and can be larger than the number of topics)
+        K = max(self.K, int(np.max(self.t)) + 1) if self.lambda_gem else self.K
+        H = max(self.H, int(np.max(self.s_flat)) + 1) if self.psi_gem else self.H
         # Session-level topics
-        self.T = np.zeros(self.K, dtype=int)
+        T = np.bincount(self.t, minlength=K)
         # Command-level topics
+        S = None
         if self.command_level_topics:
-            self.S = np.zeros((self.K, self.H), dtype=int)
-            self.W = np.zeros(shape=(self.H + (1 if self.secondary_topic else 0), self.V), dtype=int)
+            S = np.zeros((K, H), dtype=int)
+            np.add.at(S, (self.t[self.corpus.command_session], self.s_flat), 1)
+            W = np.zeros(shape=(H + (1 if self.secondary_topic else 0), self.V), dtype=int)
+            topics = self.s_flat[self.corpus.token_command]
         else:
-            self.W = np.zeros(shape=(self.K + (1 if self.secondary_topic else 0), self.V), dtype=int)             
+            W = np.zeros(shape=(K + (1 if self.secondary_topic else 0), self.V), dtype=int)
+            topics = self.t[self.corpus.token_session]
         # Primary-secondary topic indicators
+        Z = None; M_star = None
         if self.secondary_topic:
+            # Split the cached bags of words into primary and secondary words
+            self.bow.set_indicators(self.z_flat)
+            # Primary topics in rows 1,...,H (or K) and secondary topic in row 0
+            np.add.at(W, ((topics + 1) * self.z_flat, self.corpus.tokens), 1)
+            group = topics if self.shared_Z else self.corpus.token_session
+            n_groups = (H if self.command_level_topics else K) if self.shared_Z else self.D
+            M_star = np.bincount(group, minlength=n_groups)
+            Z = np.bincount(group, weights=self.z_flat, minlength=n_groups).astype(int)
+            # Secondary words of each topic
+            W0 = np.zeros(shape=(W.shape[0] - 1, self.V), dtype=int)
+            np.add.at(W0, (topics[self.z_flat == 0], self.corpus.tokens[self.z_flat == 0]), 1)
+        else:
+            np.add.at(W, (topics, self.corpus.tokens), 1)
+            W0 = None
+        self.stats = sufficient_statistics(T=T, W=W, S=S, Z=Z, M_star=M_star, W0=W0, gamma=self.gamma, tau=self.tau, eta=self.eta, alpha=self.alpha, alpha0=self.alpha0,
+                                            lambda_gem=self.lambda_gem, psi_gem=self.psi_gem, phi_gem=self.phi_gem, backend=self.count_backend, dtype=self.count_dtype)
+        self.init_members()
+        # Slots for the topics of the GEM priors: the topics in use are those with non-zero counts
+        if self.lambda_gem:
+            self.t_slots = topic_slots(self.T > 0)
+            self.K = self.t_slots.n_active
+            self.resize_session_topics()
+        if self.psi_gem:
+            self.s_slots = topic_slots(self.stats.S.col_totals > 0)
+            self.H = self.s_slots.n_active
+            self.resize_command_topics()
+
+    ## Move secondary words (distinct words vs with counts ns) from topic old to topic new in W0
+    def move_secondary_words(self, vs, ns, old, new):
+        self.stats.W0.add(old, vs, -ns)
+        self.stats.W0.add(new, vs, ns)
+
+    ## Restricted Gibbs scan of a split-merge proposal (Jain and Neal): the items 2, ..., n-1 are reallocated in turn between the two rows (items 0 and 1 stay in rows 0 and 1)
+    def restricted_scan(self, n, alloc, weights, update, target=None):
+        # Required input: alloc - row of each item (updated in place); weights(r) - log-probabilities of the two rows for item r (removed from the counts);
+        #                 update(r, row, sign) - add (sign=1) or remove (sign=-1) the counts of item r in a row
+        # Optional input: target - rows of the items, evaluated instead of sampled (reverse split of a merge move)
+        # Output: log-probability of the new allocation under the scan
+        log_q = 0
+        for r in range(2, n):
+            update(r, alloc[r], -1)
+            probs = weights(r)
+            alloc[r] = self.rng.log_categorical(probs) if target is None else target[r]
+            log_q += probs[alloc[r]] - np.logaddexp(probs[0], probs[1])
+            update(r, alloc[r], 1)
+        return log_q
+
+    ## Secondary words of topics k and k_ast in W0 after an accepted split (the tokens in index are moved from k to the new topic k_ast) or merge (k_ast is merged into k)
+    def update_secondary_words(self, k, k_ast, split, index):
+        if split:
+            # The new topic k_ast has no words before the split
+            vs, ns = np.unique(self.corpus.tokens[index[self.z_flat[index] == 0]], return_counts=True)
+            self.move_secondary_words(vs, ns, k, k_ast)
+        else:
+            vs, ns = self.stats.W0.entries(k_ast)
+            self.move_secondary_words(vs, ns, k_ast, k)
+
+    ## Inverted indices of the topics: sessions of each session-level topic and commands of each command-level topic (kept current by the moves)
+    def init_members(self):
+        self.t_members = membership_index(self.t)
+        if self.command_level_topics:
+            self.s_members = membership_index(self.s_flat)
+
+    ## Resize the count arrays of the session-level topics to the capacity of the slots (GEM prior on the session-level topics)
+    def resize_session_topics(self):
+        capacity = self.t_slots.capacity
+        self.T = pad_slots(self.T, capacity)
+        if self.command_level_topics:
+            self.stats.S.pad(n_rows=capacity)
+        else:
+            self.stats.W.pad(n_rows=capacity + (1 if self.secondary_topic else 0))
+            if self.secondary_topic:
+                self.stats.W0.pad(capacity, self.V)
+            if self.secondary_topic and self.shared_Z:
+                self.M_star = pad_slots(self.M_star, capacity)
+                self.Z = pad_slots(self.Z, capacity)
+
+    ## Resize the count arrays of the command-level topics to the capacity of the slots (GEM prior on the command-level topics)
+    def resize_command_topics(self):
+        capacity = self.s_slots.capacity
+        self.stats.S.pad(n_cols=capacity)
+        self.stats.W.pad(n_rows=capacity + (1 if self.secondary_topic else 0))
+        if self.secondary_topic:
+            self.stats.W0.pad(capacity, self.V)
+        if self.secondary_topic and self.shared_Z:
+            self.M_star = pad_slots(self.M_star, capacity)
+            self.Z = pad_slots(self.Z, capacity)
+
+    ## Slot for a new session-level topic (the capacity is doubled if all the slots are in use)
+    def new_session_topic(self):
+        if self.t_slots.peek() is None:
+            self.t_slots.grow()
+            self.resize_session_topics()
+        return self.t_slots.peek()
+
+    ## Slot for a new command-level topic (the capacity is doubled if all the slots are in use)
+    def new_command_topic(self):
+        if self.s_slots.peek() is None:
+            self.s_slots.grow()
+            self.resize_command_topics()
+        return self.s_slots.peek()
+
+    ## Relabel the topics of the GEM priors as consecutive integers (used before producing output)
+    def compact_topics(self):
+        offset = 1 if self.secondary_topic else 0
+        # The counts and labels are permuted only if some topic is not in the first slots
+        if self.lambda_gem:
+            perm, relabel = self.t_slots.compact()
+        if self.lambda_gem and perm is not None:
+            self.t[:] = relabel[self.t]
+            self.t_members.relabel(relabel)
+            self.T = self.T[perm]
             if self.command_level_topics:
-                self.M_star = np.zeros(shape=self.H if self.shared_Z else self.D, dtype=int)
-                self.Z = np.zeros(shape=self.H if self.shared_Z else self.D, dtype=int)
-            else:
-                self.M_star = np.zeros(shape=self.K if self.shared_Z else self.D, dtype=int)
-                self.Z = np.zeros(shape=self.K if self.shared_Z else self.D, dtype=int)
-        # Initialise quantities 
-        Q = Counter(self.t)
-        for topic in Q:
-            self.T[topic] += Q[topic]
-        for doc in self.w:
-            td = self.t[doc]
-            if self.command_level_topics:
-                for j in self.w[doc]:
-                    sjd = self.s[doc][j]
-                    self.S[td,sjd] += 1
-                    if self.secondary_topic:
-                        self.M_star[sjd if self.shared_Z else doc] += self.M[doc][j] 
-                        self.Z[sjd if self.shared_Z else doc] += np.sum(self.z[doc][j])
-                        # Primary topics
-                        Wjd = Counter(self.w[doc][j][self.z[doc][j] == 1])
-                        for v in Wjd:
-                            self.W[sjd + 1, v] += Wjd[v]
-                        # Secondary topics
-                        Wjd = Counter(self.w[doc][j][self.z[doc][j] == 0])
-                        for v in Wjd:
-                            self.W[0, v] += Wjd[v]
-                    else:
-                        Wjd = Counter(self.w[doc][j])
-                        for v in Wjd:
-                            self.W[sjd, v] += Wjd[v]
+                self.stats.S.permute_rows(perm)
             else:
-                for j in self.w[doc]:
-                    if self.secondary_topic:
-                        self.M_star[td if self.shared_Z else doc] += self.M[doc][j] 
-                        self.Z[td if self.shared_Z else doc] += np.sum(self.z[doc][j])
-                        # Primary topics
-                        Wjd = Counter(self.w[doc][j][self.z[doc][j] == 1])
-                        for v in Wjd:
-                            self.W[td + 1, v] += Wjd[v]
-                        # Secondary topics
-                        Wjd = Counter(self.w[doc][j][self.z[doc][j] == 0])
-                        for v in Wjd:
-                            self.W[0, v] += Wjd[v]
-                    else:
-                        Wjd = Counter(self.w[doc][j])
-                        for v in Wjd:
-                            self.W[td, v] += Wjd[v]
+                self.stats.W.permute_rows(np.append(np.arange(offset), perm + offset))
+                if self.secondary_topic:
+                    self.stats.W0.permute_rows(perm)
+                if self.secondary_topic and self.shared_Z:
+                    self.M_star = self.M_star[perm]
+                    self.Z = self.Z[perm]
+        if self.psi_gem:
+            perm, relabel = self.s_slots.compact()
+        if self.psi_gem and perm is not None:
+            self.s_flat[:] = relabel[self.s_flat]
+            self.s_members.relabel(relabel)
+            self.stats.S.permute_cols(perm)
+            self.stats.W.permute_rows(np.append(np.arange(offset), perm + offset))
+            if self.secondary_topic:
+                self.stats.W0.permute_rows(perm)
+            if self.secondary_topic and self.shared_Z:
+                self.M_star = self.M_star[perm]
+                self.Z = self.Z[perm]
 
     ## Initialise from other topic model object
     def init_from_other(self, other):
@@ -299,34 +464,32 @@ class topic_model:
         if s is not None:
             if not self.command_level_topics:
                 raise TypeError('Command-level topics cannot be initialised if command_level_topics is not used.')
-            elif not isinstance(s, dict):
-                raise TypeError('The initial value for s should be a dictionary.')
+            elif not isinstance(s, dict) and not isinstance(s, np.ndarray):
+                raise TypeError('The initial value for s should be a dictionary or a flat np.ndarray.')
             else:
                 self.s = s
         if z is not None: 
             if not self.secondary_topic:
                 raise TypeError('Secondary topics cannot be initialised if secondary_topic is not used.')
-            elif not isinstance(z, dict):
-                raise TypeError('The initial value for z should be a dictionary.')
+            elif not isinstance(z, dict) and not isinstance(z, np.ndarray):
+                raise TypeError('The initial value for z should be a dictionary or a flat np.ndarray.')
             else:
                 self.z = z
         else:
             # Initialise all z's at random
             if self.secondary_topic:
-                self.z = {}
-                freqs = Counter()
-                for d in self.w:
-                    freqs += Counter(np.unique(reduce(lambda xs, ys: xs + ys, [list(self.w[d][j]) for j in self.w[d]])))
-                for d in self.w:
-                    self.z[d] = {}
-                    for j in self.w[d]:
-                        self.z[d][j] = np.zeros(self.M[d][j])
-                        for i in range(self.M[d][j]):
-                            f = freqs[self.w[d][j][i]] / self.D
-                            self.z[d][j][i] = int(np.random.choice(2, p=[f, 1-f]))
+                self.frequency_init_indicators()
         # Initialise counts
         self.init_counts()     
 
+    ## Initialise the indicators at random, with probability of a secondary word equal to its document frequency
+    def frequency_init_indicators(self):
+        # Number of sessions containing each word
+        pairs = np.unique(self.corpus.token_session * self.V + self.corpus.tokens)
+        freqs = np.bincount(pairs % self.V, minlength=self.V) / self.D
+        f = freqs[self.corpus.tokens]
+        self.z_flat = (self.rng.generator.random(self.corpus.n_tokens) >= f).astype(np.uint8)
+
     ## Initializes uniformly at random
     def random_init(self, K_init=None, H_init=None):
         if K_init is not None:
@@ -342,14 +505,11 @@ class topic_model:
             else:
                 H_init = int(np.copy(self.H))
         # Random initialisation
-        self.t = np.random.choice(K_init, size=self.D)
-        for d in range(self.D):
-            if self.command_level_topics:
-                self.s[d] = np.random.choice(H_init, size=len(self.w[d])).astype(int)
-            if self.secondary_topic:
-                self.z[d] = {}
-                for j in self.w[d]:
-                    self.z[d][j] = np.random.choice(2, size=self.M[d][j]).astype(int)
+        self.t = self.rng.generator.integers(K_init, size=self.D)
+        if self.command_level_topics:
+            self.s_flat = self.rng.generator.integers(H_init, size=self.corpus.n_commands)
+        if self.secondary_topic:
+            self.z_flat = self.rng.generator.integers(2, size=self.corpus.n_tokens, dtype=np.uint8)
         ## Initialise counts
         self.init_counts()   
 
@@ -399,7 +559,7 @@ class topic_model:
         topic_allocation = {}
         self.t = np.zeros(self.D, dtype=int)
         if self.command_level_topics:
-            self.s = {}
+            s = {}
         if self.secondary_topic:
             all_counter = Counter()
         topic_term = model.get_topics()
@@ -409,7 +569,7 @@ class topic_model:
             if not self.command_level_topics:
                 topic_allocation[d] = []
             else:
-                self.s[d] = np.zeros(self.N[d], dtype=int)
+                s[d] = np.zeros(self.N[d], dtype=int)
             for j in self.w[d]:
                 if self.command_level_topics:
                     topic_allocation[d,j] = []
@@ -422,7 +582,7 @@ class topic_model:
                     if self.secondary_topic:
                         all_counter += Counter(topic_allocation[d,j])
                     else:
-                        self.s[d][j] = int(Counter(topic_allocation[d,j]).most_common(1)[0][0])
+                        s[d][j] = int(Counter(topic_allocation[d,j]).most_common(1)[0][0])
             if not self.command_level_topics:
                 if self.secondary_topic:
                     all_counter += Counter(topic_allocation[d])
@@ -430,33 +590,33 @@ class topic_model:
                     self.t[d] = int(Counter(topic_allocation[d]).most_common(1)[0][0])
         # If secondary topics are used, find the most common topic
         if self.secondary_topic:
-            self.z = {}
+            z = {}
             secondary_t = int(all_counter.most_common(1)[0][0])
             for d in self.w:
-                self.z[d] = {}
+                z[d] = {}
                 if not self.command_level_topics:
                     if np.sum(topic_allocation[d] != secondary_t) > 0:
                         primary_t = int(Counter(topic_allocation[d][topic_allocation[d] != secondary_t]).most_common(1)[0][0])
                         self.t[d] = primary_t - (1 if primary_t > secondary_t else 0)
                     else:
-                        self.t[d] = np.random.choice(K_init)
+                        self.t[d] = self.rng.integer(K_init)
                 for j in self.w[d]:
                     if self.command_level_topics:
                         if np.sum(topic_allocation[d,j] != secondary_t) > 0:
                             primary_t = int(Counter(topic_allocation[d,j][topic_allocation[d,j] != secondary_t]).most_common(1)[0][0])
-                            self.s[d][j] = primary_t - (1 if primary_t > secondary_t else 0)
+                            s[d][j] = primary_t - (1 if primary_t > secondary_t else 0)
                         else:
-                            self.s[d][j] = np.random.choice(H_init)
-                    self.z[d][j] = np.array([int(np.argmax([topic_term[secondary_t,word2id[str(v)]], np.sum(np.delete(topic_term[:,word2id[str(v)]],secondary_t))])) for v in self.w[d][j]])  
-                    ## self.z[d][j] = np.array([int(np.argmax([topic_term[secondary_t,v], topic_term[primary_t,v]])) for v in self.w[d][j]])
+                            s[d][j] = self.rng.integer(H_init)
+                    z[d][j] = np.array([int(np.argmax([topic_term[secondary_t,word2id[str(v)]], np.sum(np.delete(topic_term[:,word2id[str(v)]],secondary_t))])) for v in self.w[d][j]])  
+                    ## z[d][j] = np.array([int(np.argmax([topic_term[secondary_t,v], topic_term[primary_t,v]])) for v in self.w[d][j]])
         # If command-level topics are used, repeat gensim
         if self.command_level_topics:
             # Convert words (command-level topics) into strings (gensim requirement)
             docs = []
             for d in self.w:
                 docs.append([])
-                for s in self.s[d]:
-                    docs[-1].append(str(s))
+                for h in s[d]:
+                    docs[-1].append(str(h))
             # Dictionary and corpus
             dictionary = Dictionary(docs); temp = dictionary[0]
             corpus = [dictionary.doc2bow(doc) for doc in docs]
@@ -469,9 +629,14 @@ class topic_model:
             # Estimate topics
             for d in self.w:
                 topic_allocation = []
-                for s in self.s[d]:
-                    topic_allocation = np.append(topic_allocation,np.argmax(topic_term[:,word2id[str(s)]]))
+                for h in s[d]:
+                    topic_allocation = np.append(topic_allocation,np.argmax(topic_term[:,word2id[str(h)]]))
                 self.t[d] = int(Counter(topic_allocation).most_common(1)[0][0])
+        # Store the topics and indicators in the flat arrays
+        if self.command_level_topics:
+            self.s = s
+        if self.secondary_topic:
+            self.z = z
         # Initialise counts
         self.init_counts()
 
@@ -492,46 +657,19 @@ class topic_model:
                 H_init = int(np.copy(self.H))
             if K_init > H_init:
                 raise ValueError('K_init must be smaller than H_init for initialising with spectral clustering.')
-        # Build co-occurrence matrix
-        cooccurrence_matrix = {}
-        for d in self.w:
-            if self.command_level_topics:
-                index = (self.N_cumsum[d-1] if d > 0 else 0)
-                for j in self.w[d]:
-                    cooccurrence_matrix[index+j] = Counter(self.w[d][j])
-            else:
-                cooccurrence_matrix[d] = Counter()
-                for j in self.w[d]:
-                    cooccurrence_matrix[d] += Counter(self.w[d][j])
-        # Obtain matrix
-        vals = []; rows = []; cols = []
-        for key in cooccurrence_matrix:
-            vals += list(cooccurrence_matrix[key].values())
-            rows += [key] * len(cooccurrence_matrix[key])
-            cols += list(cooccurrence_matrix[key].keys())
-        # Co-occurrence matrix
-        cooccurrence_matrix = coo_matrix((vals, (rows, cols)), shape=(self.N_cumsum[-1] if self.command_level_topics else self.D, self.V))
+        # Co-occurrence matrix (commands or sessions by words), duplicate entries are summed
+        rows = self.corpus.token_command if self.command_level_topics else self.corpus.token_session
+        cooccurrence_matrix = coo_matrix((np.ones(self.corpus.n_tokens), (rows, self.corpus.tokens)), shape=(self.corpus.n_commands if self.command_level_topics else self.D, self.V))
 		## Spectral decomposition of A
         U, S, _ = svds(cooccurrence_matrix.asfptype(), k=H_init if self.command_level_topics else K_init)
         kmod = KMeans(n_clusters=H_init if self.command_level_topics else K_init, random_state=random_state).fit(U[:,::-1] * (S[::-1] ** .5))
         if not self.command_level_topics:
             self.t = kmod.labels_
         else:
-            cooccurrence_matrix = {}
-            self.s[0] = kmod.labels_[:self.N_cumsum[0]]
-            cooccurrence_matrix[0] = Counter(self.s[0])
-            for d in range(1,self.D):
-                self.s[d] = kmod.labels_[self.N_cumsum[d-1]:self.N_cumsum[d]]
-                cooccurrence_matrix[d] = Counter(self.s[d])
-            # Obtain matrix
-            vals = []; rows = []; cols = []
-            for key in cooccurrence_matrix:
-                vals += list(cooccurrence_matrix[key].values())
-                rows += [key] * len(cooccurrence_matrix[key])
-                cols += list(cooccurrence_matrix[key].keys())
+            self.s_flat = np.array(kmod.labels_, dtype=int)
             if K_init > 1:
-                # Co-occurrence matrix
-                cooccurrence_matrix = coo_matrix((vals, (rows, cols)), shape=(self.D, H_init))#!changed from self.H
+                # Co-occurrence matrix (sessions by command-level topics)
+                cooccurrence_matrix = coo_matrix((np.ones(self.corpus.n_commands), (self.corpus.command_session, self.s_flat)), shape=(self.D, H_init))#!changed from self.H
                 ## Spectral decomposition
                 if K_init < H_init:
                     U, S, _ = svds(cooccurrence_matrix.asfptype(), k=K_init)
@@ -544,28 +682,47 @@ class topic_model:
                 self.t = np.zeros(self.D, dtype=int)
         # Initialise all z's at random
         if self.secondary_topic:
-            self.z = {}
-            freqs = Counter()
-            for d in self.w:
-                freqs += Counter(np.unique(reduce(lambda xs, ys: xs + ys, [list(self.w[d][j]) for j in self.w[d]])))
-            for d in self.w:
-                self.z[d] = {}
-                for j in self.w[d]:
-                    if random_z:
-                        self.z[d][j] = np.ones(self.M[d][j]) ## np.random.choice(2,size=self.M[d][j])
-                    else:
-                        self.z[d][j] = np.zeros(self.M[d][j])
-                        for i in range(self.M[d][j]):
-                            f = freqs[self.w[d][j][i]] / self.D
-                            self.z[d][j][i] = np.random.choice(2, p=[f, 1-f])      
+            if random_z:
+                self.z_flat = np.ones(self.corpus.n_tokens, dtype=np.uint8) ## np.random.choice(2,size=self.corpus.n_tokens)
+            else:
+                self.frequency_init_indicators()
         # Initialise counts
         self.init_counts()     
 
+    ## Distinct command-level topics in session d and their counts
+    def session_topic_counts(self, d):
+        return np.unique(self.s_flat[self.corpus.session_commands(d)], return_counts=True)
+
+    ## Distinct primary words in session d and their counts (from the cached bags of words), number of primary words and total number of words
+    def session_word_counts(self, d):
+        Wv, Wn = self.bow.get(d)
+        return Wv, Wn, self.bow.Z[d], self.bow.M[d]
+
+    ## Flat bags of a list of sessions: the bag of docs[r] is cols[offsets[r]:offsets[r+1]], ns[offsets[r]:offsets[r+1]] (counts of the command-level topics,
+    ## with the columns relative to topic_cols, or of the primary words), with the number of primary words Zs[r] and the total number of words Ms[r]
+    def session_bags(self, docs, topic_cols=None):
+        docs = np.asarray(docs, dtype=int)
+        if self.command_level_topics:
+            # Distinct (session, command-level topic) pairs of the commands of the sessions
+            commands = concatenate_ranges(self.corpus.session_offsets[docs], self.corpus.session_offsets[docs + 1])
+            col_index = np.zeros(self.stats.S.shape[1], dtype=int); col_index[topic_cols] = np.arange(len(topic_cols))
+            rows = np.repeat(np.arange(len(docs)), self.corpus.N[docs])
+            keys, ns = np.unique(rows * len(topic_cols) + col_index[self.s_flat[commands]], return_counts=True)
+            offsets = np.searchsorted(keys // len(topic_cols), np.arange(len(docs) + 1))
+            return offsets, keys % len(topic_cols), ns, np.zeros(len(docs), dtype=int), np.zeros(len(docs), dtype=int)
+        offsets, vs, ns = self.bow.gather(docs)
+        return offsets, vs, ns, self.bow.Z[docs], self.bow.M[docs]
+
+    ## Distinct primary words in command c (global command index) and their counts (from the cached bags of words), number of primary words and total number of words
+    def command_word_counts(self, c):
+        Wv, Wn = self.bow.get(c)
+        return Wv, Wn, self.bow.Z[c], self.bow.M[c]
+
    ## Resample session-level topics
     def resample_session_topics(self, size=1, indices=None):
         # Optional input: subset - list of integers in {0,1,...,D-1}
         if indices is None:
-            indices = np.random.choice(self.D, size=size)
+            indices = self.rng.generator.integers(self.D, size=size)
         # Keep in t_old self.t to check for changes afterwards
         t_old = np.copy(self.t)
         # Resample each document
@@ -573,135 +730,66 @@ class topic_model:
             td_old = self.t[d]
             # Remove counts
             self.T[td_old] -= 1
-            if self.lambda_gem:
-                del_told = (self.T[td_old] == 0)
-            if self.lambda_gem and del_told:
-                self.K -= 1
-                self.T = np.delete(self.T, td_old)
-                self.t[self.t >= td_old] -= 1
-            if self.lambda_gem:
-                self.T = np.append(self.T, 0)
             if self.command_level_topics:
-                Sd = Counter(self.s[d])
-                for h in Sd:
-                    self.S[td_old,h] -= Sd[h]
-                if self.lambda_gem and del_told:
-                    if np.sum(self.S[td_old]) != 0:
-                        raise ValueError('Sum of S must be 0.]')
-                    self.S = np.delete(self.S, td_old, axis=0)
-                if self.lambda_gem:
-                    self.S = np.append(self.S, np.zeros((1,self.H)), axis=0)
+                Sh, Sn = self.session_topic_counts(d)
+                self.stats.S.add(td_old, Sh, -Sn)
             else:
-                Wd = Counter()
-                if self.secondary_topic:
-                    Zd = 0
-                    if self.shared_Z:
-                        self.M_star[td_old] -= np.sum(self.M[d])
-                for j in self.w[d]:
-                    if self.secondary_topic:
-                        Zdj = self.z[d][j]
-                        Wd += Counter(self.w[d][j][Zdj == 1])
-                        if self.shared_Z:
-                            Z_partial = np.sum(Zdj)
-                            self.Z[td_old] -= Z_partial
-                            Zd += Z_partial
-                    else:
-                        Wd += Counter(self.w[d][j])
-                for v in Wd:
-                    self.W[td_old + (1 if self.secondary_topic else 0),v] -= Wd[v]
-                if self.lambda_gem and del_told:
-                    if np.sum(self.W[td_old + (1 if self.secondary_topic else 0)]) != 0:
-                        raise ValueError('Sum of W must be 0.')
-                    self.W = np.delete(self.W, td_old + (1 if self.secondary_topic else 0), axis=0)
-                    if self.secondary_topic and self.shared_Z:
-                        if self.M_star[td_old] != 0 or self.Z[td_old] != 0:
-                            raise ValueError('M_star and Z must be 0.')
-                        self.M_star = np.delete(self.M_star, td_old)
-                        self.Z = np.delete(self.Z, td_old)
-                if self.lambda_gem:
-                    self.W = np.append(self.W, np.zeros((1,self.V)), axis=0)
-                    if self.secondary_topic and self.shared_Z:
-                        self.M_star = np.append(self.M_star, 0)
-                        self.Z = np.append(self.Z, 0)
+                Wv, Wn, Zd, Md = self.session_word_counts(d)
+                if self.secondary_topic and self.shared_Z:
+                    self.M_star[td_old] -= Md
+                    self.Z[td_old] -= Zd
+                self.stats.W.add(td_old + (1 if self.secondary_topic else 0), Wv, -Wn)
+            if self.lambda_gem:
+                # Free the slot of the old topic if it is now empty, and obtain a slot for a new topic
+                if self.T[td_old] == 0:
+                    self.t_slots.release(td_old)
+                    self.K -= 1
+                t_new_slot = self.new_session_topic()
             # Calculate allocation probabilities
             if self.lambda_gem:
-                probs = np.log([self.gamma if t == 0 else t for t in self.T])
+                probs = np.log(np.where(self.T == 0, self.gamma, self.T))
             else:
-                probs = np.log(self.gamma + self.T)
+                probs = lookup_log(self.gamma, self.T)
             if self.command_level_topics:
-                if self.psi_gem:
-                    for h in Sd:
-                        probs += np.log([self.tau if s == 0 else s for s in self.S[:,h]])
-                        probs += np.sum(np.log(np.add.outer(self.S[:,h], np.arange(1, Sd[h]))), axis=1)
-                    probs -= np.sum(np.log(np.add.outer(self.tau + np.sum(self.S, axis=1), np.arange(np.sum(list(Sd.values()))))), axis=1)    
-                else:
-                    for h in Sd:
-                        if self.multivariate_hyperparameters:
-                            probs += np.sum(np.log(np.add.outer(self.tau[h] + self.S[:,h], np.arange(Sd[h]))), axis=1)
-                        else:
-                            probs += np.sum(np.log(np.add.outer(self.tau + self.S[:,h], np.arange(Sd[h]))), axis=1)
-                    probs -= np.sum(np.log(np.add.outer(np.sum(self.tau + self.S, axis=1), np.arange(np.sum(list(Sd.values()))))), axis=1)               
+                ## s | t components
+                probs += self.stats.S.logpredictive(Sh, Sn)
             else:
-                if self.secondary_topic:
-                    ## w | t,z components
-                    if self.phi_gem:
-                        for v in Wd:
-                            probs += np.log([self.eta if w == 0 else w for w in self.W[1:,v]])
-                            probs += np.sum(np.log(np.add.outer(self.W[1:,v], np.arange(1,Wd[v]))), axis=1)
-                        probs -= np.sum(np.log(np.add.outer(self.eta + np.sum(self.W[1:], axis=1), np.arange(np.sum(list(Wd.values()))))), axis=1)
-                    else:
-                        for v in Wd:
-                            if self.multivariate_hyperparameters:
-                                probs += np.sum(np.log(np.add.outer(self.eta[v] + self.W[1:,v], np.arange(Wd[v]))), axis=1)
-                            else:
-                                probs += np.sum(np.log(np.add.outer(self.eta + self.W[1:,v], np.arange(Wd[v]))), axis=1)
-                        probs -= np.sum(np.log(np.add.outer(np.sum(self.eta + self.W[1:], axis=1), np.arange(np.sum(list(Wd.values()))))), axis=1)
-                    if self.shared_Z:
-                        ## z | t components
-                        probs += np.sum(np.log(np.add.outer(self.alpha + self.Z, np.arange(Zd))), axis=1)
-                        probs += np.sum(np.log(np.add.outer(self.alpha0 + self.M_star - self.Z, np.arange(np.sum(self.M[d]) - Zd))), axis=1)
-                        probs -= np.sum(np.log(np.add.outer(self.alpha0 + self.alpha + self.M_star, np.arange(np.sum(self.M[d])))), axis=1)
-                else:
-                    if self.phi_gem:
-                        for v in Wd:
-                            probs += np.log([self.eta if w == 0 else w for w in self.W[:,v]])
-                            probs += np.sum(np.log(np.add.outer(self.W[:,v], np.arange(1,Wd[v]))), axis=1)
-                        probs -= np.sum(np.log(np.add.outer(self.eta + np.sum(self.W, axis=1), np.arange(np.sum(list(Wd.values()))))), axis=1)                        
-                    else:
-                        for v in Wd:
-                            if self.multivariate_hyperparameters:
-                                probs += np.sum(np.log(np.add.outer(self.eta[v] + self.W[:,v], np.arange(Wd[v]))), axis=1)
-                            else:
-                                probs += np.sum(np.log(np.add.outer(self.eta + self.W[:,v], np.arange(Wd[v]))), axis=1)
-                        probs -= np.sum(np.log(np.add.outer(np.sum(self.eta + self.W, axis=1), np.arange(np.sum(list(Wd.values()))))), axis=1)
+                ## w | t,z components (primary topics are stored in rows 1,...,K of W if secondary topics are used)
+                probs += self.stats.W.logpredictive(Wv, Wn, rows=slice(1 if self.secondary_topic else 0, None))
+                if self.secondary_topic and self.shared_Z:
+                    ## z | t components
+                    probs += lookup_log_rising(self.alpha, self.Z, Zd)
+                    probs += lookup_log_rising(self.alpha0, self.M_star - self.Z, Md - Zd)
+                    probs -= lookup_log_rising(self.alpha0 + self.alpha, self.M_star, Md)
+            if self.lambda_gem:
+                # Only the topics in use and one new topic can be sampled
+                unused = ~self.t_slots.active
+                unused[t_new_slot] = False
+                probs[unused] = -np.inf
             # Transform the probabilities
-            probs = np.exp(probs - logsumexp(probs))
-            # Resample session-level topic
-            td_new = np.random.choice(len(probs), p=probs)
+            log_probs = probs
+            # Resample session-level topic (inverse CDF on the unnormalised weights)
+            td_new = self.rng.log_categorical(log_probs)
             self.t[d] = td_new
+            self.t_members.move(d, td_new)
+            # Update the running log-likelihood (ratio of the unnormalised conditionals)
+            if self.track_ll:
+                self.loglik += log_probs[td_new] - log_probs[td_old]
             # Update counts
             self.T[td_new] += 1
             if self.command_level_topics:
-                for h in Sd:
-                    self.S[td_new,h] += Sd[h]
+                self.stats.S.add(td_new, Sh, Sn)
             else:
-                for v in Wd:
-                    self.W[td_new + (1 if self.secondary_topic else 0),v] += Wd[v]
+                self.stats.W.add(td_new + (1 if self.secondary_topic else 0), Wv, Wn)
                 if self.secondary_topic and self.shared_Z:
-                    self.M_star[td_new] += np.sum(self.M[d])
+                    self.M_star[td_new] += Md
                     self.Z[td_new] += Zd
-            if self.lambda_gem:
-                if td_new == self.K:
-                    self.K += 1
-                else:
-                    self.T = np.delete(self.T, -1)
-                    if self.command_level_topics:
-                        self.S = np.delete(self.S, -1, axis=0)
-                    else:
-                        self.W = np.delete(self.W, -1, axis=0)
-                        if self.secondary_topic and self.shared_Z:
-                            self.M_star = np.delete(self.M_star, -1)
-                            self.Z = np.delete(self.Z, -1)
+            if self.secondary_topic and not self.command_level_topics and td_new != td_old:
+                # Move the secondary words of the session
+                self.move_secondary_words(*self.bow.get_secondary(d), td_old, td_new)
+            if self.lambda_gem and td_new == t_new_slot:
+                self.t_slots.acquire()
+                self.K += 1
         # Check if t changed, and count +1 for the change in counter
         if self.count_changes and np.any(t_old != self.t):
             self.change_counter_t += 1
@@ -711,104 +799,67 @@ class topic_model:
         if not self.command_level_topics:
             raise TypeError('Command-level topics cannot be resampled if command_level_topics is not used.')
         if indices is None:
-            indices_d = np.random.choice(self.D, size=size)
+            indices_d = self.rng.generator.integers(self.D, size=size)
             indices_j = []
             for d in indices_d:
-                indices_j += [int(np.random.choice(self.N[d]))]
+                indices_j += [self.rng.integer(self.N[d])]
             indices = np.vstack((indices_j,indices_d)).T
         entry_count = 0
         for j, d in indices:
             td = self.t[d]
-            s_old = int(self.s[d][j])
-            self.S[td,s_old] -= 1
+            c = self.corpus.command_index(d, j)
+            s_old = int(self.s_flat[c])
+            self.stats.S.add(td, s_old, -1)
+            Wv, Wn, Zdj, Mc = self.command_word_counts(c)
+            if self.secondary_topic and self.shared_Z:
+                self.M_star[s_old] -= Mc
+                self.Z[s_old] -= Zdj
+            self.stats.W.add(s_old + (1 if self.secondary_topic else 0), Wv, -Wn)
             if self.psi_gem:
-                del_sold = (np.sum(self.S[:,s_old]) == 0)
-                if del_sold:
-                    self.S = np.delete(self.S, s_old, axis=1)
+                # Free the slot of the old topic if it is now empty, and obtain a slot for a new topic
+                if self.stats.S.col_totals[s_old] == 0:
+                    self.s_slots.release(s_old)
                     self.H -= 1
-                    for doc in self.s:
-                        self.s[doc][self.s[doc] >= s_old] -= 1
-                self.S = np.append(self.S, np.zeros((self.K,1)), axis=1)
-            if self.secondary_topic:
-                Zdj = self.z[d][j]
-                Wd = Counter(self.w[d][j][Zdj == 1])
-                if self.shared_Z:
-                    self.M_star[s_old] -= self.M[d][j]
-                    Zdj = int(np.sum(Zdj))
-                    self.Z[s_old] -= Zdj
-            else:
-                Wd = Counter(self.w[d][j])
-            for v in Wd:
-                self.W[s_old + (1 if self.secondary_topic else 0),v] -= Wd[v]
-            if self.psi_gem:
-                if del_sold:
-                    if np.sum(self.W[s_old + (1 if self.secondary_topic else 0)]) != 0:
-                        raise ValueError('Sum of W must be 0.')
-                    self.W = np.delete(self.W, s_old + (1 if self.secondary_topic else 0), axis=0)
-                    if self.secondary_topic and self.shared_Z:
-                        if self.M_star[s_old] != 0 or self.Z[s_old] != 0:
-                            raise ValueError('M_star and Z must be 0.')
-                        self.M_star = np.delete(self.M_star, s_old)
-                        self.Z = np.delete(self.Z, s_old)
-                self.W = np.append(self.W, np.zeros((1,self.V)), axis=0)
-                if self.secondary_topic and self.shared_Z:
-                    self.M_star = np.append(self.M_star, 0)
-                    self.Z = np.append(self.Z, 0)
+                s_new_slot = self.new_command_topic()
             # Calculate allocation probabilities
+            S_td = self.stats.S.rows(td)
             if self.psi_gem:
-                probs = np.log([self.tau if s == 0 else s for s in self.S[td]])
+                probs = np.log(np.where(S_td == 0, self.tau, S_td))
             else:
-                probs = np.log(self.tau + self.S[td])
-            if self.secondary_topic:
-                ## w | s,z components
-                if self.phi_gem:
-                    for v in Wd:
-                        probs += np.log([self.eta if w == 0 else w for w in self.W[1:,v]])
-                        probs += np.sum(np.log(np.add.outer(self.W[1:,v], np.arange(1,Wd[v]))), axis=1)
-                    probs -= np.sum(np.log(np.add.outer(self.eta + np.sum(self.W[1:], axis=1), np.arange(np.sum(list(Wd.values()))))), axis=1)
-                else:
-                    for v in Wd:
-                        probs += np.sum(np.log(np.add.outer(self.eta + self.W[1:,v], np.arange(Wd[v]))), axis=1)
-                    probs -= np.sum(np.log(np.add.outer(np.sum(self.eta + self.W[1:], axis=1), np.arange(np.sum(list(Wd.values()))))), axis=1)
-                if self.shared_Z:
-                    ## z | s components
-                    probs += np.sum(np.log(np.add.outer(self.alpha + self.Z, np.arange(Zdj))), axis=1)
-                    probs += np.sum(np.log(np.add.outer(self.alpha0 + self.M_star - self.Z, np.arange(self.M[d][j] - Zdj))), axis=1)
-                    probs -= np.sum(np.log(np.add.outer(self.alpha0 + self.alpha + self.M_star, np.arange(self.M[d][j]))), axis=1)
-            else:
-                if self.phi_gem:
-                    for v in Wd:
-                        probs += np.log([self.eta if w == 0 else w for w in self.W[:,v]])
-                        probs += np.sum(np.log(np.add.outer(self.W[:,v], np.arange(1,Wd[v]))), axis=1)
-                    probs -= np.sum(np.log(np.add.outer(self.eta + np.sum(self.W, axis=1), np.arange(np.sum(list(Wd.values()))))), axis=1) 
-                else:   
-                    for v in Wd:
-                        if self.multivariate_hyperparameters:
-                            probs += np.sum(np.log(np.add.outer(self.eta[v] + self.W[:,v], np.arange(Wd[v]))), axis=1)
-                        else:
-                            probs += np.sum(np.log(np.add.outer(self.eta + self.W[:,v], np.arange(Wd[v]))), axis=1)
-                    probs -= np.sum(np.log(np.add.outer(np.sum(self.eta + self.W, axis=1), np.arange(np.sum(list(Wd.values()))))), axis=1)
+                probs = lookup_log(self.tau, S_td)
+            ## w | s,z components (primary topics are stored in rows 1,...,H of W if secondary topics are used)
+            probs += self.stats.W.logpredictive(Wv, Wn, rows=slice(1 if self.secondary_topic else 0, None))
+            if self.secondary_topic and self.shared_Z:
+                ## z | s components
+                probs += lookup_log_rising(self.alpha, self.Z, Zdj)
+                probs += lookup_log_rising(self.alpha0, self.M_star - self.Z, Mc - Zdj)
+                probs -= lookup_log_rising(self.alpha0 + self.alpha, self.M_star, Mc)
+            if self.psi_gem:
+                # Only the topics in use and one new topic can be sampled
+                unused = ~self.s_slots.active
+                unused[s_new_slot] = False
+                probs[unused] = -np.inf
             # Transform the probabilities
-            probs = np.exp(probs - logsumexp(probs))
-            # Resample command-level topic
-            s_new = np.random.choice(len(probs), p=probs)
-            self.s[d][j] = s_new
+            log_probs = probs
+            # Resample command-level topic (inverse CDF on the unnormalised weights)
+            s_new = self.rng.log_categorical(log_probs)
+            self.s_flat[c] = s_new
+            self.s_members.move(c, s_new)
+            # Update the running log-likelihood
+            if self.track_ll:
+                self.loglik += log_probs[s_new] - log_probs[s_old]
             # Update counts
-            self.S[td,s_new] += 1
-            for v in Wd:
-                self.W[s_new + (1 if self.secondary_topic else 0),v] += Wd[v]
+            self.stats.S.add(td, s_new, 1)
+            self.stats.W.add(s_new + (1 if self.secondary_topic else 0), Wv, Wn)
             if self.secondary_topic and self.shared_Z:
-                self.M_star[s_new] += self.M[d][j]
+                self.M_star[s_new] += Mc
                 self.Z[s_new] += Zdj
-            if self.psi_gem:
-                if s_new == self.H:
-                    self.H += 1
-                else:
-                    self.S = np.delete(self.S, -1, axis=1)
-                    self.W = np.delete(self.W, -1, axis=0)
-                    if self.secondary_topic and self.shared_Z:
-                        self.M_star = np.delete(self.M_star, -1)
-                        self.Z = np.delete(self.Z, -1)
+            if self.secondary_topic and s_new != s_old:
+                # Move the secondary words of the command
+                self.move_secondary_words(*self.bow.get_secondary(c), s_old, s_new)
+            if self.psi_gem and s_new == s_new_slot:
+                self.s_slots.acquire()
+                self.H += 1
             # Keep counter for changed commands in docs
             if self.count_changes and (s_old != s_new) and (entry_count < 1):
                 entry_count += 1
@@ -819,54 +870,105 @@ class topic_model:
         if not self.secondary_topic:
             raise TypeError('Indicators cannot be resampled if secondary topic are not used.')
         if indices is None:
-            indices_d = np.random.choice(self.D, size=size)
+            indices_d = self.rng.generator.integers(self.D, size=size)
             indices_j = []; indices_i = []
             for d in indices_d:
-                indj = int(np.random.choice(self.N[d]))
+                indj = self.rng.integer(self.N[d])
                 indices_j += [indj]
-                indices_i += [int(np.random.choice(self.M[d][indj]))]
+                indices_i += [self.rng.integer(self.corpus.M[self.corpus.command_index(d, indj)])]
             indices = np.vstack((indices_i,indices_j,indices_d)).T
         entry_count = 0
         # Resample the primary-secondary topic indicators
         for i, j, d in indices:
-            v = int(self.w[d][j][i])
-            z_old = int(self.z[d][j][i])
+            # Position of the token in the packed corpus
+            c = self.corpus.command_index(d, j)
+            n = self.corpus.command_offsets[c] + i
+            v = int(self.corpus.tokens[n])
+            z_old = int(self.z_flat[n])
             if self.command_level_topics:
-                topic = self.s[d][j]
+                topic = self.s_flat[c]
             else:
                 topic = self.t[d]
             ## Index for Z
             topicz = np.copy(topic if self.shared_Z else d)
             self.Z[topicz] -= z_old
-            self.W[(topic+1) * z_old,v] -= 1
+            self.stats.W.add((topic+1) * z_old, v, -1)
             # Calculate allocation probabilities
             probs = np.zeros(2)
+            W1, W0 = self.stats.W.get([topic+1, 0], v)
             if self.phi_gem:
-                probs[1] = np.log(self.alpha + self.Z[topicz]) + np.log(self.eta if self.W[topic+1,v] == 0 else self.W[topic+1,v]) - np.log(np.sum(self.eta + self.W[topic+1]))
-                probs[0] = np.log(self.alpha0 + self.M_star[topicz] - 1 - self.Z[topicz]) + np.log(self.eta if self.W[0,v] == 0 else self.W[0,v]) - np.log(np.sum(self.eta + self.W[0]))
+                probs[1] = np.log(self.alpha + self.Z[topicz]) + np.log(self.eta if W1 == 0 else W1) - np.log(self.eta + self.stats.W.totals[topic+1])
+                probs[0] = np.log(self.alpha0 + self.M_star[topicz] - 1 - self.Z[topicz]) + np.log(self.eta if W0 == 0 else W0) - np.log(self.eta + self.stats.W.totals[0])
             else:
                 if self.multivariate_hyperparameters:
-                    probs[1] = np.log(self.alpha + self.Z[topicz]) + np.log(self.eta[v] + self.W[topic+1,v]) - np.log(np.sum(self.eta + self.W[topic+1]))
-                    probs[0] = np.log(self.alpha0 + self.M_star[topicz] - 1 - self.Z[topicz]) + np.log(self.eta[v] + self.W[0,v]) - np.log(np.sum(self.eta + self.W[0]))
+                    probs[1] = np.log(self.alpha + self.Z[topicz]) + np.log(self.eta[v] + W1) - np.log(np.sum(self.eta) + self.stats.W.totals[topic+1])
+                    probs[0] = np.log(self.alpha0 + self.M_star[topicz] - 1 - self.Z[topicz]) + np.log(self.eta[v] + W0) - np.log(np.sum(self.eta) + self.stats.W.totals[0])
                 else:
-                    probs[1] = np.log(self.alpha + self.Z[topicz]) + np.log(self.eta + self.W[topic+1,v]) - np.log(np.sum(self.eta + self.W[topic+1]))
-                    probs[0] = np.log(self.alpha0 + self.M_star[topicz] - 1 - self.Z[topicz]) + np.log(self.eta + self.W[0,v]) - np.log(np.sum(self.eta + self.W[0]))
-            probs = np.exp(probs - logsumexp(probs))
+                    probs[1] = lookup_log(self.alpha, self.Z[topicz]) + lookup_log(self.eta, W1) - lookup_log(self.eta * self.V, self.stats.W.totals[topic+1])
+                    probs[0] = lookup_log(self.alpha0, self.M_star[topicz] - 1 - self.Z[topicz]) + lookup_log(self.eta, W0) - lookup_log(self.eta * self.V, self.stats.W.totals[0])
+            log_probs = probs
             # Resample z
-            z_new = np.random.choice(range(2), p=probs)
-            self.z[d][j][i] = z_new
+            z_new = self.rng.log_categorical(log_probs)
+            self.z_flat[n] = z_new
+            # Update the running log-likelihood
+            if self.track_ll:
+                self.loglik += log_probs[z_new] - log_probs[z_old]
+            if z_new != z_old:
+                self.bow.flip(n, z_new - z_old)
+                self.stats.W0.add(topic, v, z_old - z_new)
             # Update counts
             self.Z[topicz] += z_new
-            self.W[(topic + 1) * z_new, v] += 1
+            self.stats.W.add((topic + 1) * z_new, v, 1)
             # Counter for z changes in docs
             if self.count_changes and (z_old != z_new) and (entry_count < 1):
                 entry_count += 1
                 self.change_counter_z += 1
 
+    ## Resample all the primary-secondary topic indicators in a single sweep (compiled if numba is available, otherwise a python loop on the flat arrays)
+    def sweep_indicators(self, order=None):
+        # Optional input: order - array of token indices (default: all tokens in random order)
+        if not self.secondary_topic:
+            raise TypeError('Indicators cannot be resampled if secondary topic are not used.')
+        if order is None:
+            order = self.rng.generator.permutation(self.corpus.n_tokens)
+        if self.count_backend == 'sparse':
+            # The kernel works on the dense array of W: with the sparse backend, the indicators are resampled one at a time in the same order
+            c = self.corpus.token_command[order]; d = self.corpus.command_session[c]
+            self.resample_indicators(indices=np.vstack((order - self.corpus.command_offsets[c], c - self.corpus.session_offsets[d], d)).T)
+            return
+        uniforms = self.rng.uniforms(len(order))
+        z_old = self.z_flat[order]
+        # Topic and index for Z of each token
+        if self.command_level_topics:
+            token_topic = self.s_flat[self.corpus.token_command]
+        else:
+            token_topic = self.t[self.corpus.token_session]
+        token_group = token_topic if self.shared_Z else self.corpus.token_session
+        # Word prior as a V-dimensional vector (the GEM prior adds a single eta to the row totals)
+        eta = self.eta * np.ones(self.V) if np.ndim(self.eta) == 0 else np.asarray(self.eta, dtype=float)
+        eta_sum = float(self.eta) if self.phi_gem else float(np.sum(eta))
+        # The kernel updates the counts and the row totals of W in place (moving a word between rows leaves the column totals unchanged)
+        changes, delta_ll = indicator_sweep(np.asarray(order), self.corpus.tokens, token_topic, token_group, self.z_flat, self.W, self.stats.W.totals, self.Z, self.M_star,
+                                    eta, eta_sum, float(self.alpha), float(self.alpha0), bool(self.phi_gem),
+                                    self.bow.token_entry, self.bow.token_unit, self.bow.counts1, self.bow.Z, uniforms)
+        self.stats.W.dirty[:] = True
+        # Secondary words of the topics for the changed indicators
+        changed = order[self.z_flat[order] != z_old]
+        self.stats.W0.add_at(token_topic[changed], self.corpus.tokens[changed], 1 - 2 * self.z_flat[changed].astype(int))
+        # Each token is removed from and added back to W
+        self.stats.W.n_updates += 2 * len(order)
+        if self.track_ll:
+            self.loglik += delta_ll
+        # Counter for z changes
+        if self.count_changes and changes > 0:
+            self.change_counter_z += 1
+
     ## Split-merge move for session-level topics
-    def split_merge_session(self, random_allocation=False):
+    def split_merge_session(self, random_allocation=False, restricted_scans=0):
+        # Optional input: random_allocation - if True, the split proposal is a uniform random allocation of the sessions (instead of a sequential allocation)
+        #                 restricted_scans - if positive, number of intermediate restricted Gibbs scans of the launch state (Jain and Neal), and the proposal is a final restricted scan
         # Randomly choose two documents
-        d, d_prime = np.random.choice(self.D, size=2, replace=False)
+        d, d_prime = self.rng.generator.choice(self.D, size=2, replace=False)
         # Propose a split or merge move according to the sampled values
         boundary = False
         if self.t[d] == self.t[d_prime]:
@@ -885,458 +987,357 @@ class topic_model:
                 boundary = True
         # Check if the proposed move is not at the boundary
         if not boundary:
-            # Preprocessing for split / merge move
+            # Row of W corresponding to each session-level topic
+            offset = 1 if self.secondary_topic else 0
+            shared = self.secondary_topic and self.shared_Z
+            # Type of the counts for z (the counts are offset by the prior if initialised from another model)
+            z_dtype = self.Z.dtype if shared else int
+            if self.command_level_topics:
+                # Columns of S for the command-level topics in use (the free slots are excluded with a GEM prior)
+                cols = np.where(self.s_slots.active)[0] if self.psi_gem else np.arange(self.H)
+            # Sessions in the proposal other than d and d_prime (in the order of the sequential allocation)
             if split:
-                # Split move
-                indices = np.where(self.t == t)[0]
-                indices = indices[np.logical_and(indices != d, indices != d_prime)]
-                T_prop = np.ones(2)
-                if self.command_level_topics:
-                    S_prop = np.zeros((2,self.H))
-                    Q = Counter(self.s[d])
-                    for h in Q:
-                        S_prop[0,h] = Q[h]
-                    Q = Counter(self.s[d_prime]) 
-                    for h in Q:
-                        S_prop[1,h] = Q[h]
-                else:
-                    W_prop = np.zeros((2,self.V))
-                    if self.secondary_topic:
-                        M_ast_prop = np.zeros(2)
-                        Z_prop = np.zeros(2)
-                    for j in self.w[d]:
-                        Q = Counter(self.w[d][j] if not self.secondary_topic else self.w[d][j][self.z[d][j] == 1])
-                        for v in Q:
-                            W_prop[0,v] += Q[v]
-                        if self.secondary_topic:
-                            M_ast_prop[0] += self.M[d][j]
-                            Z_prop[0] += np.sum(self.z[d][j])
-                    for j in self.w[d_prime]:
-                        Q = Counter(self.w[d_prime][j] if not self.secondary_topic else self.w[d_prime][j][self.z[d_prime][j] == 1])
-                        for v in Q:
-                            W_prop[1,v] += Q[v]
-                        if self.secondary_topic:
-                            M_ast_prop[1] += self.M[d_prime][j]
-                            Z_prop[1] += np.sum(self.z[d_prime][j])
-                if random_allocation:
-                    t_prop = np.random.choice(2,size=len(indices))
-                    T_prop[0] += np.sum(t_prop); T_prop[1] = np.sum(1-t_prop)
-                    if self.command_level_topics:
-                        for doc in indices[np.array(t_prop,dtype=bool)]:
-                            Q = Counter(self.s[doc])
-                            for h in Q:
-                                S_prop[0,h] += Q[h]
-                        for doc in indices[np.logical_not(t_prop)]:
-                            Q = Counter(self.s[doc])
-                            for h in Q:
-                                S_prop[1,h] += Q[h]
-                    else:
-                        for doc in indices[np.logical(t_prop, dtype=bool)]:
-                            for j in self.w[doc]:
-                                Q = Counter(self.w[doc][j] if not self.secondary_topic else self.w[doc][j][self.z[doc][j] == 1])
-                                for v in Q:
-                                    W_prop[0,v] += Q[v]
-                                if self.secondary_topic:
-                                    M_ast_prop[0] += self.M[doc][j]
-                                    Z_prop[0] += np.sum(self.z[doc][j])
-                        for doc in indices[np.logical_not(t_prop)]:
-                            for j in self.w[doc]:
-                                Q = Counter(self.w[doc][j] if not self.secondary_topic else self.w[doc][j][self.z[doc][j] == 1])
-                                for v in Q:
-                                    W_prop[1,v] += Q[v]
-                                if self.secondary_topic:
-                                    M_ast_prop[1] += self.M[doc][j]
-                                    Z_prop[1] += np.sum(self.z[doc][j])
+                indices = self.t_members.members(t)
             else:
-                # Merge move
-                indices = np.where(np.logical_or(self.t == t, self.t == t_ast))[0]
-                indices = indices[np.logical_and(indices != d, indices != d_prime)]
+                indices = np.sort(np.append(self.t_members.members(t), self.t_members.members(t_ast)))
+            indices = indices[np.logical_and(indices != d, indices != d_prime)]
+            if not random_allocation and restricted_scans == 0:
+                indices = self.rng.generator.permutation(indices)
+            # Flat bags of d, d_prime and the other sessions: columns of the counts (command-level topics or words) and counts
+            docs = np.append([d, d_prime], indices)
+            bag_offsets, bag_cols, bag_ns, Zs, Ms = self.session_bags(docs, cols if self.command_level_topics else None)
+            bag_rows = np.repeat(np.arange(len(docs)), np.diff(bag_offsets))
+            n_cols = len(cols) if self.command_level_topics else self.V
+            prior = self.tau if self.command_level_topics else self.eta
+            ## Counts of the two rows of the proposal for an allocation of the sessions in docs (-1 for the sessions not allocated)
+            def allocate(alloc):
+                entries = alloc[bag_rows] >= 0
+                C = np.bincount(alloc[bag_rows][entries] * n_cols + bag_cols[entries], weights=bag_ns[entries], minlength=2*n_cols).reshape(2, n_cols).astype(int)
+                Z_alloc = np.bincount(alloc[alloc >= 0], weights=Zs[alloc >= 0], minlength=2).astype(z_dtype)
+                M_ast_alloc = np.bincount(alloc[alloc >= 0], weights=Ms[alloc >= 0], minlength=2).astype(z_dtype)
+                return np.bincount(alloc[alloc >= 0], minlength=2), C, M_ast_alloc, Z_alloc
+            # Launch state: d and d_prime in separate rows
+            launch = np.full(len(docs), -1); launch[:2] = [0, 1]
+            if split:
+                if random_allocation and restricted_scans == 0:
+                    # Split move: the proposal is a uniform random allocation
+                    t_prop = self.rng.generator.integers(2, size=len(indices))
+                    launch[2:] = t_prop
+                # Split move: the proposal is built from the launch state
+                T_prop, C_prop, M_ast_prop, Z_prop = allocate(launch)
+            else:
+                # Merge move: the proposal is the union of the two topics, the launch state is used for the reverse split
                 T_prop = np.array([self.T[t] + self.T[t_ast],0])
-                T_temp = np.ones(2)
+                C_prop = np.zeros((2,n_cols), dtype=int)
                 if self.command_level_topics:
-                    S_prop = np.zeros((2,self.H)); S_prop[0] = self.S[t] + self.S[t_ast]
-                    S_temp = np.zeros((2,self.H))
-                    Q = Counter(self.s[d])
-                    for h in Q:
-                        S_temp[0,h] = Q[h]
-                    Q = Counter(self.s[d_prime])
-                    for h in Q:
-                        S_temp[1,h] = Q[h]
+                    C_prop[0] = np.sum(self.stats.S.rows([t, t_ast])[:,cols], axis=0)
+                else:
+                    C_prop[0] = np.sum(self.stats.W.rows([t + offset, t_ast + offset]), axis=0)
+                    if shared:
+                        M_ast_prop = np.zeros(2, dtype=z_dtype); M_ast_prop[0] = self.M_star[t] + self.M_star[t_ast]
+                        Z_prop = np.zeros(2, dtype=z_dtype); Z_prop[0] = self.Z[t] + self.Z[t_ast]
+            ## Allocation of the bag r between the two rows: unnormalised log-probabilities (with the bag removed from the counts) and update of the counts
+            bag_totals = np.bincount(bag_rows, weights=bag_ns, minlength=len(docs)).astype(int)
+            logpredictive = bounded_logpredictive(prior, n_cols, int(np.sum(bag_ns)))
+            log_T = lookup_log(self.gamma, np.arange(len(docs) + 1)) if np.ndim(self.gamma) == 0 else None
+            def weights(r):
+                ## s | t components or w | t,z components
+                probs = log_T[T_alloc] if log_T is not None else lookup_log(self.gamma, T_alloc)
+                probs = probs + logpredictive(C_alloc, bag_cols[bag_offsets[r]:bag_offsets[r+1]], bag_ns[bag_offsets[r]:bag_offsets[r+1]], C_totals)
+                if shared:
+                    ## z | t components
+                    probs += lookup_log_rising(self.alpha, Z_alloc, Zs[r])
+                    probs += lookup_log_rising(self.alpha0, M_ast_alloc - Z_alloc, Ms[r] - Zs[r])
+                    probs -= lookup_log_rising(self.alpha0 + self.alpha, M_ast_alloc, Ms[r])
+                return probs
+            def update(r, row, sign):
+                T_alloc[row] += sign
+                C_alloc[row,bag_cols[bag_offsets[r]:bag_offsets[r+1]]] += sign * bag_ns[bag_offsets[r]:bag_offsets[r+1]]
+                C_totals[row] += sign * bag_totals[r]
+                if shared:
+                    M_ast_alloc[row] += sign * Ms[r]
+                    Z_alloc[row] += sign * Zs[r]
+            # Calculate proposal probability
+            if restricted_scans > 0:
+                # Launch state (Jain and Neal): uniform random allocation of the other sessions, updated by the intermediate restricted Gibbs scans
+                launch[2:] = self.rng.generator.integers(2, size=len(indices))
+                T_alloc, C_alloc, M_ast_alloc, Z_alloc = allocate(launch)
+                C_totals = np.sum(C_alloc, axis=1)
+                for _ in range(restricted_scans):
+                    self.restricted_scan(len(docs), launch, weights, update)
+                if split:
+                    # Split move: the proposal is a final restricted Gibbs scan from the launch state
+                    probs_proposal = self.restricted_scan(len(docs), launch, weights, update)
+                    t_prop = launch[2:]
+                    T_prop = T_alloc; C_prop = C_alloc; M_ast_prop = M_ast_alloc; Z_prop = Z_alloc
                 else:
-                    W_prop = np.zeros((2,self.V)); W_prop[0] = self.W[t + (1 if self.secondary_topic else 0)] + self.W[t_ast + (1 if self.secondary_topic else 0)]
-                    W_temp = np.zeros((2,self.V))
-                    for j in self.w[d]:
-                        Q = Counter(self.w[d][j] if not self.secondary_topic else self.w[d][j][self.z[d][j] == 1])
-                        for v in Q:
-                            W_temp[0,v] += Q[v] 
-                    for j in self.w[d_prime]:    
-                        Q = Counter(self.w[d_prime][j] if not self.secondary_topic else self.w[d_prime][j][self.z[d_prime][j] == 1])
-                        for v in Q:
-                            W_temp[1,v] += Q[v] 
-                    if self.secondary_topic and self.shared_Z:
-                        M_ast_prop = np.zeros(2); M_ast_prop[0] = self.M_star[t] + self.M_star[t_ast]
-                        Z_prop = np.zeros(2); Z_prop[0] = self.Z[t] + self.Z[t_ast]
-                        M_ast_temp = np.zeros(2); Z_temp = np.zeros(2)
-                        for j in self.w[d]:
-                            M_ast_temp[0] += self.M[d][j]
-                            Z_temp[0] += np.sum(self.z[d][j])
-                        for j in self.w[d_prime]: ##self.tau + self.S[d_prime]:
-                            M_ast_temp[1] += self.M[d_prime][j]
-                            Z_temp[1] += np.sum(self.z[d_prime][j])
-            # Caclulate proposal probability
-            if not random_allocation:
+                    # Merge move: probability of the current split under a final restricted Gibbs scan from the launch state
+                    probs_proposal = self.restricted_scan(len(docs), launch, weights, update, target=np.append([0, 1], self.t[indices] != self.t[d]).astype(int))
+            elif not random_allocation:
                 probs_proposal = 0
-                indices = np.random.choice(indices,size=len(indices),replace=False)
+                # Counts used for the sequential allocation (the launch state is used for the reverse split of a merge)
                 if split:
-                    t_prop = []
-                for doc in indices:
-                    if self.command_level_topics:
-                        Sd = Counter(self.s[doc])
-                    else:
-                        Wd = Counter()
-                        if self.secondary_topic:
-                            Zd = 0
-                        for j in self.w[doc]: ## self.tau + self.S[doc]:
-                            if self.secondary_topic:
-                                Zdj = self.z[doc][j]
-                                Wd += Counter(self.w[doc][j][Zdj == 1])
-                                Z_partial = np.sum(Zdj)
-                                Zd += Z_partial
-                            else:
-                                Wd += Counter(self.w[doc][j])
+                    t_prop = np.zeros(len(indices), dtype=int)
+                    T_alloc = T_prop; C_alloc = C_prop; M_ast_alloc = M_ast_prop; Z_alloc = Z_prop
+                else:
+                    T_alloc, C_alloc, M_ast_alloc, Z_alloc = allocate(launch)
+                C_totals = np.sum(C_alloc, axis=1)
+                for r in range(2, len(docs)):
                     # Calculate allocation probabilities
-                    if split:
-                        probs = np.log(self.gamma + T_prop)
-                        if self.command_level_topics:
-                            for h in Sd:
-                                probs += np.sum(np.log(np.add.outer(self.tau + S_prop[:,h], np.arange(Sd[h]))), axis=1)
-                            probs -= np.sum(np.log(np.add.outer(np.sum(self.tau + S_prop, axis=1), np.arange(np.sum(list(Sd.values()))))), axis=1)               
-                        else:
-                            ## w | t,z components
-                            for v in Wd:
-                                probs += np.sum(np.log(np.add.outer(self.eta + W_prop[:,v], np.arange(Wd[v]))), axis=1)
-                            probs -= np.sum(np.log(np.add.outer(np.sum(self.eta + W_prop, axis=1), np.arange(np.sum(list(Wd.values()))))), axis=1)
-                            if self.secondary_topic and self.shared_Z:
-                                ## z | t components
-                                probs += np.sum(np.log(np.add.outer(self.alpha + Z_prop, np.arange(Zd))), axis=1)
-                                probs += np.sum(np.log(np.add.outer(self.alpha0 + M_ast_prop - Z_prop, np.arange(np.sum(self.M[doc]) - Zd))), axis=1)
-                                probs -= np.sum(np.log(np.add.outer(self.alpha0 + self.alpha + M_ast_prop, np.arange(np.sum(self.M[doc])))), axis=1)
-                    else:
-                        probs = np.log(self.gamma + T_temp)
-                        if self.command_level_topics:
-                            for h in Sd:
-                                probs += np.sum(np.log(np.add.outer(self.tau + S_temp[:,h], np.arange(Sd[h]))), axis=1)
-                            probs -= np.sum(np.log(np.add.outer(np.sum(self.tau + S_temp, axis=1), np.arange(np.sum(list(Sd.values()))))), axis=1)               
-                        else:
-                            ## w | t,z components
-                            for v in Wd:
-                                probs += np.sum(np.log(np.add.outer(self.eta + W_temp[:,v], np.arange(Wd[v]))), axis=1)
-                            probs -= np.sum(np.log(np.add.outer(np.sum(self.eta + W_temp, axis=1), np.arange(np.sum(list(Wd.values()))))), axis=1)
-                            if self.secondary_topic and self.shared_Z:
-                                ## z | t components
-                                probs += np.sum(np.log(np.add.outer(self.alpha + Z_temp, np.arange(Zd))), axis=1)
-                                probs += np.sum(np.log(np.add.outer(self.alpha0 + M_ast_temp - Z_temp, np.arange(np.sum(self.M[doc]) - Zd))), axis=1)
-                                probs -= np.sum(np.log(np.add.outer(self.alpha0 + self.alpha + M_ast_temp, np.arange(np.sum(self.M[doc])))), axis=1)
-                    # Transform the probabilities
-                    probs = np.exp(probs - logsumexp(probs))
+                    probs = weights(r)
                     # Resample
-                    td_new = np.random.choice(2, p=probs)
+                    td_new = self.rng.log_categorical(probs)
                     if split:
-                        t_prop += [td_new]
+                        t_prop[r-2] = td_new
                     # Calculate Q's for the MH ratio
-                    probs_proposal += np.log(probs[td_new])
-                    if split:
-                        # Update counts
-                        T_prop[td_new] += 1
-                        if self.command_level_topics:
-                            for h in Sd:
-                                S_prop[td_new,h] += Sd[h]
-                        else:
-                            for v in Wd:
-                                W_prop[td_new,v] += Wd[v]
-                            if self.secondary_topic and self.shared_Z:
-                                M_ast_prop[td_new] += np.sum(self.M[doc])
-                                Z_prop[td_new] += Zd
-                    else:
-                        T_temp[td_new] += 1
-                        if self.command_level_topics:
-                            for h in Sd:
-                                S_prop[td_new,h] += Sd[h]
-                        else:
-                            for v in Wd:
-                                W_temp[td_new,v] += Wd[v]
-                            if self.secondary_topic and self.shared_Z:
-                                M_ast_temp[td_new] += np.sum(self.M[doc])
-                                Z_temp[td_new] += Zd
+                    probs_proposal += probs[td_new] - np.logaddexp(probs[0], probs[1])
+                    # Update counts
+                    update(r, td_new, 1)
             else:
                 probs_proposal = -len(indices) * np.log(2)
             # Calculate the Metropolis-Hastings acceptance ratio
             t_indices = np.array([t,t_ast])
-            acceptance_ratio = np.sum(loggamma(self.gamma + T_prop)) - np.sum(loggamma(self.gamma + self.T[t_indices]))
+            acceptance_ratio = np.sum(lookup_loggamma(self.gamma, T_prop)) - np.sum(lookup_loggamma(self.gamma, self.T[t_indices]))
             if self.command_level_topics:
-                acceptance_ratio += np.sum(loggamma(self.tau + S_prop)) - np.sum(loggamma(self.tau + self.S[t_indices,:]))
-                acceptance_ratio -= np.sum(loggamma(np.sum(self.tau + S_prop, axis=1))) - np.sum(loggamma(np.sum(self.tau + self.S[t_indices], axis=1)))
+                tau_sum = self.tau * len(cols) if np.ndim(self.tau) == 0 else np.sum(self.tau)
+                acceptance_ratio += np.sum(lookup_loggamma(self.tau, C_prop)) - np.sum(lookup_loggamma(self.tau, self.stats.S.rows(t_indices)[:,cols]))
+                acceptance_ratio -= np.sum(lookup_loggamma(tau_sum, np.sum(C_prop, axis=1))) - np.sum(lookup_loggamma(tau_sum, self.stats.S.totals[t_indices]))
             else:
-                acceptance_ratio += np.sum(loggamma(self.eta + W_prop)) - np.sum(loggamma(self.eta + self.W[t_indices + (1 if self.secondary_topic else 0)]))
-                acceptance_ratio -= np.sum(loggamma(np.sum(self.eta + W_prop, axis=1))) - np.sum(loggamma(np.sum(self.eta + self.W[t_indices + (1 if self.secondary_topic else 0)], axis=1)))
-                if self.secondary_topic and self.shared_Z:
-                    acceptance_ratio += np.sum(loggamma(self.alpha + Z_prop)) + np.sum(loggamma(self.alpha0 + M_ast_prop - Z_prop))
-                    acceptance_ratio -= np.sum(loggamma(self.alpha + self.alpha0 + M_ast_prop))
-                    acceptance_ratio -= np.sum(loggamma(self.alpha + self.Z[t_indices])) + np.sum(loggamma(self.alpha0 + self.M_star[t_indices] - self.Z[t_indices]))
-                    acceptance_ratio += np.sum(loggamma(self.alpha + self.alpha0 + self.M_star[t_indices]))            
+                eta_sum = self.eta * self.V if np.ndim(self.eta) == 0 else np.sum(self.eta)
+                acceptance_ratio += np.sum(lookup_loggamma(self.eta, C_prop)) - np.sum(lookup_loggamma(self.eta, self.stats.W.rows(t_indices + offset)))
+                acceptance_ratio -= np.sum(lookup_loggamma(eta_sum, np.sum(C_prop, axis=1))) - np.sum(lookup_loggamma(eta_sum, self.stats.W.totals[t_indices + offset]))
+                if shared:
+                    acceptance_ratio += np.sum(lookup_loggamma(self.alpha, Z_prop)) + np.sum(lookup_loggamma(self.alpha0, M_ast_prop - Z_prop))
+                    acceptance_ratio -= np.sum(lookup_loggamma(self.alpha + self.alpha0, M_ast_prop))
+                    acceptance_ratio -= np.sum(lookup_loggamma(self.alpha, self.Z[t_indices])) + np.sum(lookup_loggamma(self.alpha0, self.M_star[t_indices] - self.Z[t_indices]))
+                    acceptance_ratio += np.sum(lookup_loggamma(self.alpha + self.alpha0, self.M_star[t_indices]))
             if split:
                 acceptance_ratio -= probs_proposal
             else:
                 acceptance_ratio += probs_proposal
             # Accept / reject using Metropolis-Hastings
-            accept = (-np.random.exponential(1) < acceptance_ratio)
+            accept = self.rng.accept(acceptance_ratio)
             # Update if move is accepted
             if accept:
+                if self.track_ll:
+                    # Terms of the log-likelihood affected by the move
+                    terms = {'t_topics': t_indices}
+                    if self.command_level_topics:
+                        terms['s_topics'] = t_indices
+                    else:
+                        terms['w_rows'] = t_indices + offset
+                        if shared:
+                            terms['z_groups'] = t_indices
+                    ll_old = self.loglik_terms(**terms)
                 if self.count_changes: 
                     # Count +1 for change in values in t due to accept move
                     self.change_counter_t += 1
                 if split:
                     self.t[d_prime] = t_ast
-                    self.t[indices[np.array(t_prop) == 0]] = t
-                    self.t[indices[np.array(t_prop) == 1]] = t_ast
+                    self.t[indices[t_prop == 0]] = t
+                    self.t[indices[t_prop == 1]] = t_ast
                 else:
                     self.t[indices] = t
                     self.t[d] = t; self.t[d_prime] = t
+                self.t_members.move_many(docs, self.t[docs])
+                if self.secondary_topic and not self.command_level_topics:
+                    self.update_secondary_words(t, t_ast, split, self.corpus.sessions_tokens(docs[self.t[docs] == t_ast]))
                 self.T[t] = T_prop[0]; self.T[t_ast] = T_prop[1]
                 if self.command_level_topics:
-                    self.S[t] = S_prop[0]; self.S[t_ast] = S_prop[1]
+                    S_rows = np.zeros((2,self.stats.S.shape[1]), dtype=int); S_rows[:,cols] = C_prop
+                    self.stats.S.set_rows(t_indices, S_rows)
                 else:
-                    self.W[t + (1 if self.secondary_topic else 0)] = W_prop[0]; self.W[t_ast + (1 if self.secondary_topic else 0)] = W_prop[1] 
-                    if self.secondary_topic and self.shared_Z:
+                    self.stats.W.set_rows(t_indices + offset, C_prop)
+                    if shared:
                         self.M_star[t] = M_ast_prop[0]; self.M_star[t_ast] = M_ast_prop[1]
                         self.Z[t] = Z_prop[0]; self.Z[t_ast] = Z_prop[1]
+                if self.track_ll:
+                    self.loglik += self.loglik_terms(**terms) - ll_old
         ## Return acceptance status for the move
         try:
             return accept
         except:
             return None
 
-    ## Split-merge move for session-level topics
-    def split_merge_command(self, random_allocation=False):
+    ## Split-merge move for command-level topics
+    def split_merge_command(self, random_allocation=False, restricted_scans=0):
+        # Optional input: random_allocation, restricted_scans - see split_merge_session
         if not self.command_level_topics:
             raise TypeError('Command-level topics cannot be resampled if command_level_topics is not used.')
-        indices_int = np.random.choice(self.N_cumsum[-1], size=2, replace=False)
-        ## First index
-        d = np.argmax(self.N_cumsum0[np.logical_not(indices_int[0] < self.N_cumsum0)])
-        j = indices_int[0] - self.N_cumsum0[d]
-        ## Second index
-        d_prime = np.argmax(self.N_cumsum0[np.logical_not(indices_int[1] < self.N_cumsum0)])
-        j_prime = indices_int[1] - self.N_cumsum0[d_prime]
+        # Randomly choose two commands (global command indices in the packed corpus)
+        c, c_prime = self.rng.generator.choice(self.corpus.n_commands, size=2, replace=False)
+        d = self.corpus.command_session[c]; d_prime = self.corpus.command_session[c_prime]
         # Propose a split or merge move according to the sampled values & check boundary conditions
         boundary = False
-        if self.s[d][j] == self.s[d_prime][j_prime]:
-            if np.sum(np.sum(self.S,axis=0) == 0) == 0:
+        if self.s_flat[c] == self.s_flat[c_prime]:
+            if np.sum(self.stats.S.col_totals == 0) == 0:
                 boundary = True
             else:
                 split = True
-                s = self.s[d][j]
-                s_ast = np.min(np.where(np.sum(self.S,axis=0) == 0)[0])
+                s = self.s_flat[c]
+                s_ast = np.min(np.where(self.stats.S.col_totals == 0)[0])
         else:
-            if np.sum(np.sum(self.S,axis=0) == 0) < self.H:
+            if np.sum(self.stats.S.col_totals == 0) < self.H:
                 split = False
-                s = np.min([self.s[d][j],self.s[d_prime][j_prime]])
-                s_ast = np.max([self.s[d][j],self.s[d_prime][j_prime]])
+                s = np.min([self.s_flat[c],self.s_flat[c_prime]])
+                s_ast = np.max([self.s_flat[c],self.s_flat[c_prime]])
             else:
                 boundary = True
         # Check if the proposed move is not at the boundary, otherwise do not execute anything
         if not boundary:
-            # Preprocessing for split / merge move
+            # Row of W corresponding to each command-level topic
+            offset = 1 if self.secondary_topic else 0
+            shared = self.secondary_topic and self.shared_Z
+            # Type of the counts for z (the counts are offset by the prior if initialised from another model)
+            z_dtype = self.Z.dtype if shared else int
+            # Commands in the two topics (excluding c and c_prime), in random order
             if split:
-                # Split move
-                indices = {} 
-                for doc in self.s:
-                    if np.sum(self.s[doc] == s) > 0:
-                        indices[doc] = np.where(self.s[doc] == s)[0]
-                indices[d] = indices[d][indices[d] != j]
-                if len(indices[d]) == 0:
-                    del indices[d]
-                indices[d_prime] = indices[d_prime][indices[d_prime] != j_prime]
-                if len(indices[d_prime]) == 0:
-                    del indices[d_prime]
-                # Shuffle indices
-                indices_d = np.random.choice(list(indices.keys()), size=len(indices), replace=False)
-                indices_s = {}
-                for doc in indices_d:
-                    indices_s[doc] = np.random.choice(indices[doc], size=len(indices[doc]), replace=False)
-                # Proposals
-                s_prop = {}
-                W_prop = np.zeros((2,self.V), dtype=int)
-                S_prop = np.zeros((2,self.K))
-                if self.secondary_topic and self.shared_Z:
-                    M_ast_prop = np.zeros(2)
-                    Z_prop = np.zeros(2)
-                # Add starting commands
-                S_prop[0,self.t[d]] += 1
-                S_prop[1,self.t[d_prime]] += 1
-                # Add words
-                Wjd = Counter(self.w[d][j])
-                for v in Wjd:
-                    W_prop[0,v] += Wjd[v]
-                if self.secondary_topic and self.shared_Z:
-                    M_ast_prop[0] = self.M[d][j]
-                    Z_prop[0] = np.sum(self.z[d][j]) 
-                Wjd = Counter(self.w[d_prime][j_prime])
-                for v in Wjd:
-                    W_prop[1,v] += Wjd[v]
-                if self.secondary_topic and self.shared_Z:
-                    M_ast_prop[1] = self.M[d_prime][j_prime]
-                    Z_prop[1] = np.sum(self.z[d_prime][j_prime]) 
-                # If the allocation is random, the entire vector can be calculated
-                if random_allocation:
-                    for doc in indices_d:
-                        allocation = np.random.choice(2,size=len(indices_s[doc]))
-                        s_prop[doc] = allocation
-                        S_prop[0,self.t[doc]] += np.sum(1-allocation)
-                        S_prop[1,self.t[doc]] += np.sum(allocation)
-                        for command in range(len(indices_s[doc])):
-                            inds = indices_s[doc][command]
-                            if allocation[command] == 0:
-                                if self.secondary_topic and self.shared_Z:    
-                                    M_ast_prop[0] += self.M[doc][inds] 
-                                    Z_prop[0] += np.sum(self.z[doc][inds])
-                                Q = Counter(self.w[doc][inds][self.z[doc][inds] == 1] if self.secondary_topic else self.w[doc][inds])
-                                for v in Q:
-                                    W_prop[0,v] += Q[v]
-                            else:
-                                if self.secondary_topic and self.shared_Z: 
-                                    M_ast_prop[1] += self.M[doc][inds]
-                                    Z_prop[1] += np.sum(self.z[doc][inds])
-                                Q = Counter(self.w[doc][inds][self.z[doc][inds] == 1] if self.secondary_topic else self.w[doc][inds])
-                                for v in Q:
-                                    W_prop[1,v] += Q[v]
+                indices = self.s_members.members(s)
             else:
-                # Merge move
-                indices = {} 
-                for doc in self.s:
-                    indices[doc] = np.where(np.logical_or(self.s[doc] == s, self.s[doc] == s_ast))[0]
-                indices[d] = indices[d][indices[d] != j]
-                indices[d_prime] = indices[d_prime][indices[d_prime] != j_prime]
-                # Shuffle indices
-                indices_d = np.random.choice(list(indices.keys()), size=len(indices), replace=False)
-                indices_s = {}
-                for doc in indices_d:
-                    indices_s[doc] = np.random.choice(indices[doc], size=len(indices[doc]), replace=False)
-                # Proposal quantities
-                S_prop = np.zeros((2,self.K)); S_prop[0] = self.S[:,s] + self.S[:,s_ast]
-                S_temp = np.zeros((2,self.K)); S_temp[0,self.t[d]] = 1; S_temp[1,self.t[d_prime]] = 1
-                W_prop = np.zeros((2,self.V)); W_prop[0] = self.W[s + (1 if self.secondary_topic else 0)] + self.W[s_ast + (1 if self.secondary_topic else 0)]
-                W_temp = np.zeros((2,self.V))
-                Q = Counter(self.w[d][j] if not self.secondary_topic else self.w[d][j][self.z[d][j] == 1])
-                for v in Q:
-                    W_temp[0,v] = Q[v]                    
-                Q = Counter(self.w[d_prime][j_prime] if not self.secondary_topic else self.w[d_prime][j_prime][self.w[d_prime][j_prime] == 1])
-                for v in Q:
-                    W_temp[1,v] = Q[v]
-                if self.secondary_topic and self.shared_Z:
-                    M_ast_prop = np.zeros(2); M_ast_prop[0] = self.M_star[s] + self.M_star[s_ast]
-                    Z_prop = np.zeros(2); Z_prop[0] = self.Z[s] + self.Z[s_ast]
-                    M_ast_temp = np.zeros(2); Z_temp = np.zeros(2)
-                    M_ast_temp[0] += self.M[d][j]
-                    Z_temp[0] += np.sum(self.z[d][j])
-                    M_ast_temp[1] += self.M[d_prime][j_prime]
-                    Z_temp[1] += np.sum(self.z[d_prime][j_prime])
-            # Caclulate proposal probability
-            if not random_allocation:
+                indices = np.sort(np.append(self.s_members.members(s), self.s_members.members(s_ast)))
+            indices = indices[np.logical_and(indices != c, indices != c_prime)]
+            if restricted_scans == 0:
+                indices = self.rng.generator.permutation(indices)
+            # Flat bags of the primary words of c, c_prime and the other commands, and session-level topic of each command
+            commands = np.append([c, c_prime], indices)
+            bag_offsets, bag_cols, bag_ns = self.bow.gather(commands)
+            bag_rows = np.repeat(np.arange(len(commands)), np.diff(bag_offsets))
+            Zs = self.bow.Z[commands]; Ms = self.bow.M[commands]
+            tds = self.t[self.corpus.command_session[commands]]
+            n_T = len(self.T)
+            ## Counts of the two rows of the proposal for an allocation of the commands (-1 for the commands not allocated)
+            def allocate(alloc):
+                items = alloc >= 0; entries = alloc[bag_rows] >= 0
+                S_alloc = np.bincount(alloc[items] * n_T + tds[items], minlength=2*n_T).reshape(2, n_T)
+                W_alloc = np.bincount(alloc[bag_rows][entries] * self.V + bag_cols[entries], weights=bag_ns[entries], minlength=2*self.V).reshape(2, self.V).astype(int)
+                M_ast_alloc = np.bincount(alloc[items], weights=Ms[items], minlength=2).astype(z_dtype)
+                Z_alloc = np.bincount(alloc[items], weights=Zs[items], minlength=2).astype(z_dtype)
+                return S_alloc, W_alloc, M_ast_alloc, Z_alloc
+            # Launch state: c and c_prime in separate rows
+            launch = np.full(len(commands), -1); launch[:2] = [0, 1]
+            if split:
+                if random_allocation and restricted_scans == 0:
+                    # Split move: the proposal is a uniform random allocation
+                    s_prop = self.rng.generator.integers(2, size=len(indices))
+                    launch[2:] = s_prop
+                # Split move: the proposal is built from the launch state
+                S_prop, W_prop, M_ast_prop, Z_prop = allocate(launch)
+            else:
+                # Merge move: the proposal is the union of the two topics, the launch state is used for the reverse split
+                S_prop = np.zeros((2,n_T), dtype=int); S_prop[0] = np.sum(self.stats.S.columns([s, s_ast]), axis=1)
+                W_prop = np.zeros((2,self.V), dtype=int); W_prop[0] = np.sum(self.stats.W.rows([s + offset, s_ast + offset]), axis=0)
+                if shared:
+                    M_ast_prop = np.zeros(2, dtype=z_dtype); M_ast_prop[0] = self.M_star[s] + self.M_star[s_ast]
+                    Z_prop = np.zeros(2, dtype=z_dtype); Z_prop[0] = self.Z[s] + self.Z[s_ast]
+            ## Allocation of the command r between the two rows: unnormalised log-probabilities (with the command removed from the counts) and update of the counts
+            bag_totals = np.bincount(bag_rows, weights=bag_ns, minlength=len(commands)).astype(int)
+            logpredictive = bounded_logpredictive(self.eta, self.V, int(np.sum(bag_ns)))
+            log_S = lookup_log(self.tau, np.arange(len(commands) + 1)) if np.ndim(self.tau) == 0 else None
+            def weights(r):
+                ## s | t components and w | s,z components
+                probs = log_S[S_alloc[:,tds[r]]] if log_S is not None else lookup_log(self.tau, S_alloc[:,tds[r]])
+                probs = probs + logpredictive(W_alloc, bag_cols[bag_offsets[r]:bag_offsets[r+1]], bag_ns[bag_offsets[r]:bag_offsets[r+1]], W_totals)
+                if shared:
+                    ## z | s components
+                    probs += lookup_log_rising(self.alpha, Z_alloc, Zs[r])
+                    probs += lookup_log_rising(self.alpha0, M_ast_alloc - Z_alloc, Ms[r] - Zs[r])
+                    probs -= lookup_log_rising(self.alpha0 + self.alpha, M_ast_alloc, Ms[r])
+                return probs
+            def update(r, row, sign):
+                S_alloc[row,tds[r]] += sign
+                W_alloc[row,bag_cols[bag_offsets[r]:bag_offsets[r+1]]] += sign * bag_ns[bag_offsets[r]:bag_offsets[r+1]]
+                W_totals[row] += sign * bag_totals[r]
+                if shared:
+                    M_ast_alloc[row] += sign * Ms[r]
+                    Z_alloc[row] += sign * Zs[r]
+            # Calculate proposal probability
+            if restricted_scans > 0:
+                # Launch state (Jain and Neal): uniform random allocation of the other commands, updated by the intermediate restricted Gibbs scans
+                launch[2:] = self.rng.generator.integers(2, size=len(indices))
+                S_alloc, W_alloc, M_ast_alloc, Z_alloc = allocate(launch)
+                W_totals = np.sum(W_alloc, axis=1)
+                for _ in range(restricted_scans):
+                    self.restricted_scan(len(commands), launch, weights, update)
+                if split:
+                    # Split move: the proposal is a final restricted Gibbs scan from the launch state
+                    probs_proposal = self.restricted_scan(len(commands), launch, weights, update)
+                    s_prop = launch[2:]
+                    S_prop = S_alloc; W_prop = W_alloc; M_ast_prop = M_ast_alloc; Z_prop = Z_alloc
+                else:
+                    # Merge move: probability of the current split under a final restricted Gibbs scan from the launch state
+                    probs_proposal = self.restricted_scan(len(commands), launch, weights, update, target=np.append([0, 1], self.s_flat[indices] != self.s_flat[c]).astype(int))
+            elif not random_allocation:
                 probs_proposal = 0
-                for doc in indices_d:
-                    td = self.t[doc]
+                # Counts used for the sequential allocation (the launch state is used for the reverse split of a merge)
+                if split:
+                    s_prop = np.zeros(len(indices), dtype=int)
+                    S_alloc = S_prop; W_alloc = W_prop; M_ast_alloc = M_ast_prop; Z_alloc = Z_prop
+                else:
+                    S_alloc, W_alloc, M_ast_alloc, Z_alloc = allocate(launch)
+                W_totals = np.sum(W_alloc, axis=1)
+                for r in range(2, len(commands)):
+                    # Calculate allocation probabilities
+                    probs = weights(r)
+                    # Resample
+                    sjd_new = self.rng.log_categorical(probs)
                     if split:
-                        s_prop[doc] = []
-                    for command in indices_s[doc]:
-                        if self.secondary_topic:
-                            Zjd = np.sum(self.z[doc][command])
-                            Wjd = Counter(self.w[doc][command][self.z[doc][command] == 1])
-                        else:
-                            Wjd = Counter(self.w[doc][command])
-                        # Calculate allocation probabilities
-                        if split:
-                            probs = np.log(self.tau + S_prop[:,td])
-                            for v in Wjd:
-                                probs += np.sum(np.log(np.add.outer(self.eta + W_prop[:,v], np.arange(Wjd[v]))), axis=1)
-                            probs -= np.sum(np.log(np.add.outer(np.sum(self.eta + W_prop, axis=1), np.arange(np.sum(list(Wjd.values()))))), axis=1)
-                            if self.secondary_topic and self.shared_Z:
-                                probs += np.sum(np.log(np.add.outer(self.alpha + Z_prop, np.arange(Zjd))), axis=1)
-                                probs += np.sum(np.log(np.add.outer(self.alpha0 + M_ast_prop - Z_prop, np.arange(self.M[doc][command] - Zjd))), axis=1)
-                                probs -= np.sum(np.log(np.add.outer(self.alpha0 + self.alpha + M_ast_prop, np.arange(self.M[doc][command]))), axis=1)              
-                        else:
-                            probs = np.log(self.tau + S_temp[:,td])
-                            for v in Wjd:
-                                probs += np.sum(np.log(np.add.outer(self.eta + W_temp[:,v], np.arange(Wjd[v]))), axis=1)
-                            probs -= np.sum(np.log(np.add.outer(np.sum(self.eta + W_temp, axis=1), np.arange(np.sum(list(Wjd.values()))))), axis=1)
-                            if self.secondary_topic and self.shared_Z:
-                                probs += np.sum(np.log(np.add.outer(self.alpha + Z_temp, np.arange(Zjd))), axis=1)
-                                probs += np.sum(np.log(np.add.outer(self.alpha0 + M_ast_temp - Z_temp, np.arange(self.M[doc][command] - Zjd))), axis=1)
-                                probs -= np.sum(np.log(np.add.outer(self.alpha0 + self.alpha + M_ast_temp, np.arange(self.M[doc][command]))), axis=1)                                         
-                        # Transform the probabilities
-                        probs = np.exp(probs - logsumexp(probs))
-                        # Resample
-                        sjd_new = np.random.choice(2, p=probs)
-                        if split:
-                            s_prop[doc] += [sjd_new]
-                        # Calculate Q's for the MH ratio
-                        probs_proposal += np.log(probs[sjd_new])
-                        if split:
-                            # Update counts
-                            S_prop[sjd_new,td] += 1
-                            for v in Wjd:
-                                W_prop[sjd_new,v] += Wjd[v]
-                            if self.secondary_topic and self.shared_Z:
-                                M_ast_prop[sjd_new] += self.M[doc][command]
-                                Z_prop[sjd_new] += Zjd
-                        else:
-                            S_temp[sjd_new,td] += 1
-                            for v in Wjd:
-                                W_temp[sjd_new,v] += Wjd[v]
-                                if self.secondary_topic and self.shared_Z:
-                                    M_ast_temp[sjd_new] += self.M[doc][command]
-                                    Z_temp[sjd_new] += Zjd
+                        s_prop[r-2] = sjd_new
+                    # Calculate Q's for the MH ratio
+                    probs_proposal += probs[sjd_new] - np.logaddexp(probs[0], probs[1])
+                    # Update counts
+                    update(r, sjd_new, 1)
             else:
-                probs_proposal = -(np.sum(S_prop)-2) * np.log(2)
+                probs_proposal = -len(indices) * np.log(2)
             # Calculate the Metropolis-Hastings acceptance ratio
             s_indices = np.array([s,s_ast])
-            acceptance_ratio = np.sum(loggamma(self.gamma + S_prop))
-            acceptance_ratio -= np.sum(loggamma(self.gamma + self.S[:,s_indices]))
-            acceptance_ratio += np.sum(loggamma(self.eta + W_prop))
-            acceptance_ratio -= np.sum(loggamma(self.eta + self.W[s_indices + (1 if self.secondary_topic else 0)]))
-            acceptance_ratio -= np.sum(loggamma(np.sum(self.eta + W_prop, axis=1)))
-            acceptance_ratio += np.sum(loggamma(np.sum(self.eta + self.W[s_indices + (1 if self.secondary_topic else 0)], axis=1)))
-            if self.secondary_topic and self.shared_Z:
-                acceptance_ratio += np.sum(loggamma(self.alpha + Z_prop)) + np.sum(loggamma(self.alpha0 + M_ast_prop - Z_prop))
-                acceptance_ratio -= np.sum(loggamma(self.alpha + self.alpha0 + M_ast_prop))
-                acceptance_ratio -= np.sum(loggamma(self.alpha + self.Z[s_indices])) + np.sum(loggamma(self.alpha0 + self.M_star[s_indices] - self.Z[s_indices]))
-                acceptance_ratio += np.sum(loggamma(self.alpha + self.alpha0 + self.M_star[s_indices]))
+            eta_sum = self.eta * self.V if np.ndim(self.eta) == 0 else np.sum(self.eta)
+            acceptance_ratio = np.sum(lookup_loggamma(self.tau, S_prop))
+            acceptance_ratio -= np.sum(lookup_loggamma(self.tau, self.stats.S.columns(s_indices)))
+            acceptance_ratio += np.sum(lookup_loggamma(self.eta, W_prop))
+            acceptance_ratio -= np.sum(lookup_loggamma(self.eta, self.stats.W.rows(s_indices + offset)))
+            acceptance_ratio -= np.sum(lookup_loggamma(eta_sum, np.sum(W_prop, axis=1)))
+            acceptance_ratio += np.sum(lookup_loggamma(eta_sum, self.stats.W.totals[s_indices + offset]))
+            if shared:
+                acceptance_ratio += np.sum(lookup_loggamma(self.alpha, Z_prop)) + np.sum(lookup_loggamma(self.alpha0, M_ast_prop - Z_prop))
+                acceptance_ratio -= np.sum(lookup_loggamma(self.alpha + self.alpha0, M_ast_prop))
+                acceptance_ratio -= np.sum(lookup_loggamma(self.alpha, self.Z[s_indices])) + np.sum(lookup_loggamma(self.alpha0, self.M_star[s_indices] - self.Z[s_indices]))
+                acceptance_ratio += np.sum(lookup_loggamma(self.alpha + self.alpha0, self.M_star[s_indices]))
             if split:
                 acceptance_ratio -= probs_proposal
             else:
                 acceptance_ratio += probs_proposal
             # Accept / reject using Metropolis-Hastings
-            accept = (-np.random.exponential(1) < acceptance_ratio)
+            accept = self.rng.accept(acceptance_ratio)
             # Update if move is accepted
             if accept:
+                if self.track_ll:
+                    # Terms of the log-likelihood affected by the move
+                    terms = {'s_topics': np.arange(self.stats.S.shape[0]), 'w_rows': s_indices + offset}
+                    if shared:
+                        terms['z_groups'] = s_indices
+                    ll_old = self.loglik_terms(**terms)
                 if self.count_changes:
                     # Count +1 for change in values in s due to accept move
                     self.change_counter_s += 1
                 if split:
-                    self.s[d][j] = s
-                    self.s[d_prime][j_prime] = s_ast
-                    for doc in indices_d: 
-                        self.s[doc][indices_s[doc][np.logical_not(s_prop[doc])]] = s
-                        self.s[doc][indices_s[doc][np.array(s_prop[doc], dtype=bool)]] = s_ast
+                    self.s_flat[c] = s
+                    self.s_flat[c_prime] = s_ast
+                    self.s_flat[indices[s_prop == 0]] = s
+                    self.s_flat[indices[s_prop == 1]] = s_ast
                 else:
-                    self.s[d][j] = s
-                    self.s[d_prime][j_prime] = s
-                    for doc in indices_d:
-                        self.s[doc][indices_s[doc]] = s
-                self.S[:,s] = S_prop[0]; self.S[:,s_ast] = S_prop[1]
-                self.W[s + (1 if self.secondary_topic else 0)] = W_prop[0]; self.W[s_ast + (1 if self.secondary_topic else 0)] = W_prop[1] 
+                    self.s_flat[c] = s
+                    self.s_flat[c_prime] = s
+                    self.s_flat[indices] = s
+                self.s_members.move_many(commands, self.s_flat[commands])
                 if self.secondary_topic:
+                    self.update_secondary_words(s, s_ast, split, self.corpus.commands_tokens(commands[self.s_flat[commands] == s_ast]))
+                self.stats.S.set_cols(s_indices, S_prop)
+                self.stats.W.set_rows(s_indices + offset, W_prop)
+                if shared:
                     self.M_star[s] = M_ast_prop[0]; self.M_star[s_ast] = M_ast_prop[1]
                     self.Z[s] = Z_prop[0]; self.Z[s_ast] = Z_prop[1]
+                if self.track_ll:
+                    self.loglik += self.loglik_terms(**terms) - ll_old
         ## Return acceptance status for the move
         try:
             return accept
@@ -1345,79 +1346,211 @@ class topic_model:
 
     ## MH step for label switching issue with z
     def MH_label_z(self):
-        ## Pre-allocate proposed rows of W
-        W_k_prop = np.zeros(shape=self.V, dtype=int) # Counter for topic drawn - Primary topic
-        W_0_prop = np.zeros(shape=self.V, dtype=int) # Counter for topic drawn - Secondary topic
-        Wjd = Counter(); Wjd0 = Counter()
         if not self.command_level_topics:
             ## Draw a session/document topic
-            index_k = np.random.choice(np.where(self.T > 0)[0])
-            # Keep index of docs with topic index_k
-            index_d = np.where(self.t == index_k)[0]
-            for d in index_d:
-                for j in range(self.N[d]):
-                    z_prop = 1 - self.z[d][j]
-                    # Primary topics
-                    Wjd += Counter(self.w[d][j][z_prop == 1]) # Update counter for W after label switch proposal
-                    # Secondary topics
-                    Wjd0 += Counter(self.w[d][j][z_prop == 0])
-            ## Update the proposal vectors
-            for v in Wjd:
-                W_k_prop[v] += Wjd[v]       
-            for v in Wjd0:
-                W_0_prop[v] += Wjd0[v]
-            ## Update W_0_prop
-            W_0_prop = self.W[0] - W_k_prop + W_0_prop
+            index_k = self.rng.generator.choice(np.where(self.T > 0)[0])
+            # Sessions with topic index_k
+            units = self.t_members.members(index_k)
+        else:
+            # Draw a command topic (from existing topics)
+            list_unique = np.where(self.stats.S.col_totals > 0)[0]
+            index_k = list_unique[self.rng.integer(len(list_unique))]
+            # Commands with topic index_k
+            units = self.s_members.members(index_k)
+        ## Proposed rows of W: the primary words of the topic become secondary words and vice versa (the new primary row is the row of W0 of the topic)
+        W_k_prop = np.copy(self.stats.W0.rows(index_k))
+        W_k, W_0 = self.stats.W.rows([index_k + 1, 0])
+        W_0_prop = W_0 - W_k_prop + W_k
+        ## Calculate acceptance ratio   
+        MH_ratio = lookup_logB(self.eta, W_k_prop) + lookup_logB(self.eta, W_0_prop)
+        MH_ratio -= lookup_logB(self.eta, W_k) + lookup_logB(self.eta, W_0)
+        if self.shared_Z:
             Z_k_prop = self.M_star[index_k] - self.Z[index_k] # Update counter for Z     
-            ## Calculate acceptance ratio   
-            MH_ratio = logB(self.eta + W_k_prop) + logB(self.eta + W_0_prop) + logB(np.array([self.alpha + Z_k_prop, self.alpha0 + self.M_star[index_k] - Z_k_prop]))
-            MH_ratio -= logB(self.eta + self.W[index_k + 1]) + logB(self.eta + self.W[0]) + logB(np.array([self.alpha + self.Z[index_k], self.alpha0 + self.M_star[index_k] - self.Z[index_k]]))
-            # Accept / reject
-            accept = (-np.random.exponential(1) < MH_ratio)
-            if accept:
-                for d in index_d:
-                    for j in range(self.N[d]):
-                        self.z[d][j] = 1 - self.z[d][j]
+            # The total M_star is unchanged, so only the numerators of the beta functions differ
+            MH_ratio += lookup_loggamma(self.alpha, Z_k_prop) + lookup_loggamma(self.alpha0, self.M_star[index_k] - Z_k_prop)
+            MH_ratio -= lookup_loggamma(self.alpha, self.Z[index_k]) + lookup_loggamma(self.alpha0, self.M_star[index_k] - self.Z[index_k])
+        else:
+            # Session-specific counters for Z: only the sessions with words in the topic are affected (the primary words of each unit become secondary and vice versa)
+            unit_session = units if not self.command_level_topics else self.corpus.command_session[units]
+            docs, inverse = np.unique(unit_session, return_inverse=True)
+            Z_d_prop = self.Z[docs] + np.bincount(inverse, weights=self.bow.M[units] - 2 * self.bow.Z[units], minlength=len(docs)).astype(int)
+            MH_ratio += np.sum(lookup_loggamma(self.alpha, Z_d_prop) + lookup_loggamma(self.alpha0, self.M_star[docs] - Z_d_prop))
+            MH_ratio -= np.sum(lookup_loggamma(self.alpha, self.Z[docs]) + lookup_loggamma(self.alpha0, self.M_star[docs] - self.Z[docs]))
+        # Accept / reject
+        accept = self.rng.accept(MH_ratio)
+        if accept:
+            if self.track_ll:
+                terms = {'w_rows': [0, index_k + 1], 'z_groups': [index_k] if self.shared_Z else docs}
+                ll_old = self.loglik_terms(**terms)
+            # Flip the indicators of all the tokens of the topic
+            members = self.corpus.commands_tokens(units) if self.command_level_topics else self.corpus.sessions_tokens(units)
+            z_members = self.z_flat[members].astype(int)
+            self.z_flat[members] = 1 - z_members
+            self.bow.flip(members, 1 - 2 * z_members)
+            if self.shared_Z:
                 self.Z[index_k] = Z_k_prop
-                self.W[index_k+1] = W_k_prop
-                self.W[0] = W_0_prop
+            else:
+                self.Z[docs] = Z_d_prop
+            self.stats.W.set_rows([index_k + 1, 0], [W_k_prop, W_0_prop])
+            self.stats.W0.set_rows([index_k], [W_k])
+            if self.track_ll:
+                self.loglik += self.loglik_terms(**terms) - ll_old
+        return accept
+
+    ## Systematic scan: resample every session topic, command topic and indicator once, then run the split-merge and label switching moves
+    def systematic_sweep(self, random_scan=True, sweep_z=False, n_split_merge=1, n_label_switch=1, random_allocation=False, restricted_scans=0):
+        # Optional input: random_scan - if True, the variables are visited in a random order, otherwise in corpus order
+        #                 n_split_merge, n_label_switch - number of split-merge and label switching moves per sweep
+        #                 random_allocation, restricted_scans - proposals of the split-merge moves (see split_merge_session)
+        # Output: list of (move, acceptance) pairs for the split-merge moves
+        moves = []
+        # Session-level topics
+        order = self.rng.generator.permutation(self.D) if random_scan else np.arange(self.D)
+        self.resample_session_topics(indices=order)
+        if not self.lambda_gem and not self.phi_gem and not self.multivariate_hyperparameters:
+            for _ in range(n_split_merge):
+                moves += [('split_merge_session', self.split_merge_session(random_allocation=random_allocation, restricted_scans=restricted_scans))]
+        # Command-level topics
+        if self.command_level_topics:
+            order = self.rng.generator.permutation(self.corpus.n_commands) if random_scan else np.arange(self.corpus.n_commands)
+            d = self.corpus.command_session[order]
+            self.resample_command_topics(indices=np.vstack((order - self.corpus.session_offsets[d], d)).T)
+            if not self.psi_gem and not self.phi_gem and not self.multivariate_hyperparameters:
+                for _ in range(n_split_merge):
+                    moves += [('split_merge_command', self.split_merge_command(random_allocation=random_allocation, restricted_scans=restricted_scans))]
+        # Primary-secondary indicators
+        if self.secondary_topic:
+            order = self.rng.generator.permutation(self.corpus.n_tokens) if random_scan else np.arange(self.corpus.n_tokens)
+            if sweep_z:
+                self.sweep_indicators(order=order)
+            else:
+                c = self.corpus.token_command[order]
+                d = self.corpus.command_session[c]
+                self.resample_indicators(indices=np.vstack((order - self.corpus.command_offsets[c], c - self.corpus.session_offsets[d], d)).T)
+            for _ in range(n_label_switch):
+                self.MH_label_z()
+        return moves
+
+    ## State of the chain as a dictionary of arrays (copies): topics and indicators, counts, slots of the GEM priors, hyperparameters, running log-likelihood and random state
+    def get_state(self):
+        state = {'corpus': np.array([self.D, self.corpus.n_commands, self.corpus.n_tokens, self.V]), 'K': np.array(self.K), 'H': np.array(self.H), 't': np.copy(self.t), 'T': np.copy(self.T),
+                    'W': np.copy(self.stats.W.counts), 'multivariate_hyperparameters': np.array(self.multivariate_hyperparameters)}
+        for name in ['gamma', 'tau', 'eta', 'alpha', 'alpha0']:
+            state[name] = np.array(getattr(self, name))
+        if self.command_level_topics:
+            state['s_flat'] = np.copy(self.s_flat)
+            state['S'] = np.copy(self.stats.S.counts)
+        if self.secondary_topic:
+            state['z_flat'] = np.copy(self.z_flat)
+            state['Z'] = np.copy(self.Z)
+            state['M_star'] = np.copy(self.M_star)
+        # The order of the stacks of free slots determines the labels of the new topics
+        if self.lambda_gem:
+            state['t_active'] = np.copy(self.t_slots.active)
+            state['t_free'] = np.array(self.t_slots.free, dtype=int)
+        if self.psi_gem:
+            state['s_active'] = np.copy(self.s_slots.active)
+            state['s_free'] = np.array(self.s_slots.free, dtype=int)
+        if self.loglik is not None:
+            state['loglik'] = np.array(self.loglik)
+        bit_state, block, pos = self.rng.get_state()
+        state['rng_state'] = json_array(bit_state)
+        state['rng_block'] = block
+        state['rng_pos'] = np.array(pos)
+        return state
+
+    ## Restore the state of the chain from the output of get_state
+    def set_state(self, state):
+        if not np.array_equal(state['corpus'], [self.D, self.corpus.n_commands, self.corpus.n_tokens, self.V]):
+            raise ValueError('The state does not match the corpus of the model.')
+        # Hyperparameters (scalars are restored as Python numbers)
+        for name in ['gamma', 'tau', 'eta', 'alpha', 'alpha0']:
+            setattr(self, name, state[name].item() if state[name].ndim == 0 else np.copy(state[name]))
+        self.multivariate_hyperparameters = bool(state['multivariate_hyperparameters'])
+        self.K = int(state['K']); self.H = int(state['H'])
+        self.t = state['t'].astype(int)
+        S = None; Z = None; M_star = None
+        if self.command_level_topics:
+            self.s_flat = state['s_flat'].astype(int)
+            S = state['S']
+        if self.secondary_topic:
+            self.z_flat = state['z_flat'].astype(np.uint8)
+            self.bow.set_indicators(self.z_flat)
+            Z = np.copy(state['Z']); M_star = np.copy(state['M_star'])
+            # Secondary words of each topic (not stored, they are obtained from the labels and the indicators)
+            topics = self.s_flat[self.corpus.token_command] if self.command_level_topics else self.t[self.corpus.token_session]
+            W0 = np.zeros(shape=(state['W'].shape[0] - 1, self.V), dtype=int)
+            np.add.at(W0, (topics[self.z_flat == 0], self.corpus.tokens[self.z_flat == 0]), 1)
         else:
-            # Draw a command topic (from existing topics)
-            list_unique = np.where(self.S.sum(axis=0) > 0)[0] # [np.unique(val) for key,val in self.s.items()] # list of lists of unique command topics in docs
-            # index_s = np.random.choice(np.unique([x for l in list_unique for x in l])) # random draw from list of unique command topics accross all docs
-            index_s = np.random.choice(list_unique)
-            for d in range(self.D):
-                for j in range(self.N[d]):
-                    if self.s[d][j] == index_s:
-                        z_prop = 1 - self.z[d][j]
-                        # Primary topics
-                        Wjd += Counter(self.w[d][j][z_prop == 1]) # Update counter for W after label switch proposal
-                        # Secondary topics
-                        Wjd0 += Counter(self.w[d][j][z_prop == 0])
-            for v in Wjd:
-                W_k_prop[v] += Wjd[v]
-            for v in Wjd0:
-                W_0_prop[v] += Wjd0[v]
-            ## Proposed values
-            W_0_prop = self.W[0] - W_k_prop + W_0_prop
-            Z_s_prop = self.M_star[index_s] - self.Z[index_s] # Update counter for Z           
-            ## Caculate acceptance ratio
-            MH_ratio = logB(self.eta + W_k_prop) + logB(self.eta + W_0_prop) + logB(np.array([self.alpha + Z_s_prop, self.alpha0 + self.M_star[index_s] - Z_s_prop]))
-            MH_ratio -= logB(self.eta + self.W[index_s + 1]) + logB(self.eta + self.W[0]) + logB(np.array([self.alpha + self.Z[index_s], self.alpha0 + self.M_star[index_s] - self.Z[index_s]]))
-            ## Accept / reject
-            accept = (-np.random.exponential(1) < MH_ratio)
-            if accept:
-                self.Z[index_s] = Z_s_prop
-                self.W[index_s+1] = W_k_prop
-                self.W[0] = W_0_prop
-                for d in range(self.D):
-                    for j in range(self.N[d]):
-                        if self.s[d][j] == index_s:
-                            self.z[d][j] = 1 - self.z[d][j]
+            W0 = None
+        # The counts are restored as stored (not recomputed), so that the capacity and the slots of the GEM priors are unchanged
+        self.stats = sufficient_statistics(T=np.copy(state['T']), W=state['W'], S=S, Z=Z, M_star=M_star, W0=W0, gamma=self.gamma, tau=self.tau, eta=self.eta, alpha=self.alpha, alpha0=self.alpha0,
+                                            lambda_gem=self.lambda_gem, psi_gem=self.psi_gem, phi_gem=self.phi_gem, backend=self.count_backend, dtype=self.count_dtype)
+        if self.lambda_gem:
+            self.t_slots = topic_slots(state['t_active'], capacity=len(state['t_active']))
+            self.t_slots.free = [int(k) for k in state['t_free']]
+        if self.psi_gem:
+            self.s_slots = topic_slots(state['s_active'], capacity=len(state['s_active']))
+            self.s_slots.free = [int(k) for k in state['s_free']]
+        self.init_members()
+        self.loglik = float(state['loglik']) if 'loglik' in state else None
+        self.rng.set_state(from_json_array(state['rng_state']), state['rng_block'], state['rng_pos'])
+
+    ## Number of entries of the count matrices S and W updated so far (used by the instrumentation of the moves)
+    def count_updates(self):
+        return self.stats.W.n_updates + (self.stats.S.n_updates if self.command_level_topics else 0)
+
+    ## Total of the change counters of t, s and z (see count_changes in MCMC)
+    def count_label_changes(self):
+        return self.change_counter_t + (self.change_counter_s if self.command_level_topics else 0) + (self.change_counter_z if self.secondary_topic else 0)
+
+    ## Quantities monitored by the convergence diagnostics: running log-likelihood and number of occupied topics
+    def convergence_values(self):
+        values = {'loglik': self.loglik, 'K': self.K if self.lambda_gem else int(np.sum(self.T > 0))}
+        if self.command_level_topics:
+            values['H'] = self.H if self.psi_gem else int(np.sum(self.stats.S.col_totals > 0))
+        return values
+
+    ## Metrics of the progress reports: running log-likelihood (if tracked) and number of topics (for the GEM priors)
+    def progress_metrics(self):
+        return {'loglik': self.loglik if self.track_ll else None, 'K': self.K if self.lambda_gem else None, 'H': self.H if self.psi_gem else None}
 
     ## Runs MCMC chain
     def MCMC(self, iterations, burnin=0, size=1, verbose=True, calculate_ll=False, random_allocation=False, jupy_out=False, count_changes = False,
-            return_t=True, return_s=False, return_z=False, return_change_t=False, return_change_s=False, return_change_z=False, thinning=1, track_moves=False):
+            return_t=True, return_s=False, return_z=False, return_change_t=False, return_change_s=False, return_change_z=False, thinning=1, track_moves=False, sweep_z=False,
+            sweep=False, random_scan=True, n_split_merge=1, n_label_switch=1, ll_check=1000, trace=None, checkpoint=None, checkpoint_every=1000, resume_state=None, progress=None, instrument=False, convergence=None, adapt_moves=False, coclustering=None, restricted_scans=0, ll_strict=False):
+        # Arguments of the chain (stored in the checkpoints and used by resume)
+        mcmc_args = {key: value for key, value in locals().items() if key not in ['self', 'resume_state', 'progress']}
+        if isinstance(trace, trace_sink):
+            mcmc_args['trace'] = trace.path
+        if isinstance(convergence, convergence_monitor):
+            mcmc_args['convergence'] = convergence.args
+        # Optional input: trace - directory (or trace_sink) where the samples of t, s and z are written in chunks instead of being kept in memory (read with trace_reader)
+        #                 sweep_z - if True, each z move resamples all the indicators with the compiled kernel (see sweep_indicators)
+        #                 sweep - if True, each iteration is a full systematic scan (see systematic_sweep), and burnin, iterations and thinning count sweeps
+        #                 ll_check - number of iterations between full recomputations of the running log-likelihood (0 for no checks): a discrepancy
+        #                     (e.g. floating-point drift) gives a warning and the running log-likelihood is reset to the recomputed value
+        #                 ll_strict - if True, a discrepancy found by the check raises a ValueError instead
+        #                 checkpoint - file where the state of the chain is written every checkpoint_every iterations (in the background), so that it can be continued with resume
+        #                 resume_state - state loaded from a checkpoint by resume (the chain continues from the iteration after the checkpoint)
+        #                 instrument - if True, the calls, latencies, acceptance and updated counts of each move are recorded and returned in out['instrumentation'] (see move_profile)
+        #                 convergence - convergence_monitor (or dictionary of its arguments, e.g. {'min_ess': 400, 'max_rhat': 1.01, 'max_seconds': 3600}): the chain stops
+        #                     when the online effective sample size and split-R-hat of the log-likelihood and of the number of occupied topics meet the thresholds,
+        #                     or when the wall-clock budget is exhausted; the diagnostics and the reason of the stop are returned in out['convergence']
+        #                 adapt_moves - if True (or a dictionary of arguments of move_scheduler), the move probabilities are adapted during the burnin
+        #                     to maximise the changes of the state per CPU-second and frozen afterwards; the final probabilities are returned in out['moves_probs'].
+        #                     The CPU times vary between runs, so the chain is not reproducible for a given seed: use adapt_moves={'rate': 'calls'}
+        #                     to adapt on the changes per call of each move instead when the chain must be reproducible
+        #                 coclustering - list of variables ('t' and/or 's', or True for both) whose posterior similarity matrix is accumulated online from the stored samples
+        #                     (see coclustering_counts), returned in out['coclustering'] and used by estimate_t and estimate_s without storing the samples;
+        #                     the memory is one entry for each pair of sessions (or commands) in the same topic in some sample, about D^2 / K entries for D sessions in K topics
+        #                 restricted_scans - number of intermediate restricted Gibbs scans of the launch state of the split-merge moves (Jain and Neal, see split_merge_session);
+        #                     the acceptance of the moves is returned with track_moves (or instrument)
+        #                 progress - progress_monitor for the progress and metrics reports (if None and verbose is True, reports are printed or displayed if jupy_out is True)
+        if checkpoint is not None and (not isinstance(checkpoint_every, int) or checkpoint_every < 1):
+            raise ValueError('checkpoint_every must be a positive integer.')
+        if not isinstance(restricted_scans, (int, np.integer)) or restricted_scans < 0:
+            raise ValueError('restricted_scans must be a non-negative integer.')
         # Moves
         moves = ['t']
         moves_probs = [5]
@@ -1434,145 +1567,363 @@ class topic_model:
             moves += ['z', 'label_switch_z']
             moves_probs += [5, 0.1]
         moves_probs /= np.sum(moves_probs)
+        moves_cdf = np.cumsum(moves_probs)
+        ## Without numba, the sweep of the indicators runs the kernel as a python loop
+        if sweep_z and self.secondary_topic and not numba_available:
+            warnings.warn('numba is not installed: sweep_z runs the indicator kernel uncompiled, which is much slower than compiled ' +
+                          '(but still faster per token than resample_indicators).')
+        ## Adaptive move probabilities (during the burnin only)
+        scheduler = None
+        if adapt_moves and not sweep:
+            scheduler = move_scheduler(moves, moves_probs, **(adapt_moves if isinstance(adapt_moves, dict) else {}))
         ## If moves are tracked, define a vector for the set of moves
         if track_moves:
             moves_all = []; moves_accept = []
-        ## Marginal posterior
+        ## Marginal posterior (updated incrementally by the moves)
         if calculate_ll:
             ll = []
+        self.track_ll = calculate_ll or convergence is not None
+        if self.track_ll and resume_state is None:
+            self.loglik = self.marginal_loglikelihood()
         ## Return output
         Q = int(iterations // thinning)
-        if return_t:
-            t_out = np.zeros((Q,self.D),dtype=int)
-        if return_s and self.command_level_topics:
-            s_out = {}
-            for d in range(self.D):
-                s_out[d] = np.zeros((Q,self.N[d]),dtype=int)
-        if return_z and self.secondary_topic:
-            z_out = {}
-            for d in range(self.D):
-                z_out[d] = {}
-                for j in range(self.N[d]):
-                    z_out[d][j] = np.zeros((Q,self.M[d][j]),dtype=int)
+        if trace is not None:
+            ## Samples written to disk (only the variables that are returned)
+            returned = [name for name, flag in [('t', return_t), ('s', return_s and self.command_level_topics), ('z', return_z and self.secondary_topic)] if flag]
+            if resume_state is not None:
+                # The samples stored after the checkpoint are overwritten
+                sink = trace_sink(trace if isinstance(trace, str) else trace.path, self.corpus, variables=returned, n_samples=int(resume_state['trace_samples']))
+            else:
+                sink = trace if isinstance(trace, trace_sink) else trace_sink(trace, self.corpus, variables=returned)
+            return_t = return_t and 't' in sink.variables
+            return_s = return_s and 's' in sink.variables
+            return_z = return_z and 'z' in sink.variables
+        else:
+            if return_t:
+                t_out = np.zeros((Q,self.D),dtype=int)
+            if return_s and self.command_level_topics:
+                s_out = np.zeros((Q,self.corpus.n_commands),dtype=int)
+            if return_z and self.secondary_topic:
+                # Bit-packed samples of z (one bit per token)
+                z_out = np.zeros((Q,(self.corpus.n_tokens + 7) // 8),dtype=np.uint8)
+        ## Online co-clustering counts of the stored samples
+        if coclustering is True:
+            coclustering = ['t', 's']
+        cocluster = {}
+        for name in (coclustering or []):
+            if name not in ['t', 's']:
+                raise ValueError('coclustering must be a list of variables t and s.')
+            if name == 't':
+                cocluster['t'] = coclustering_counts(self.D)
+            elif self.command_level_topics:
+                cocluster['s'] = coclustering_counts(self.corpus.n_commands)
         # Return of counters
         # Create counters of changes in t,s,z among iterations
         if not isinstance(count_changes, bool):
             raise TypeError('fixed_V must be True or False.')
-        self.count_changes = count_changes
+        # The adaptation of the move probabilities uses the change counters
+        self.count_changes = count_changes or bool(adapt_moves)
         if self.count_changes:
             self.change_counter_t = 0
             if self.command_level_topics:
                 self.change_counter_s = 0
             if self.secondary_topic:
                 self.change_counter_z = 0
-        if return_change_t and self.count_changes:
+        if return_change_t and count_changes:
             change_t_out = np.zeros(Q,dtype=int)
-        if return_change_s and self.command_level_topics and self.count_changes:
+        if return_change_s and self.command_level_topics and count_changes:
             change_s_out = np.zeros(Q,dtype=int)
-        if return_change_z and self.secondary_topic and self.count_changes:
+        if return_change_z and self.secondary_topic and count_changes:
             change_z_out = np.zeros(Q,dtype=int)
-        for it in range(iterations+burnin):
+        ## Outputs and counters accumulated before the checkpoint
+        start = 0
+        if resume_state is not None:
+            start = int(resume_state['iteration'])
+            if track_moves:
+                moves_all = [str(m) for m in resume_state['moves']]
+                moves_accept = [None if a < 0 else bool(a) for a in resume_state['acceptance_moves']]
+            if calculate_ll:
+                ll = [float(x) for x in resume_state['ll']]
+            if trace is None:
+                if return_t:
+                    t_out[:] = resume_state['t_out']
+                if return_s and self.command_level_topics:
+                    s_out[:] = resume_state['s_out']
+                if return_z and self.secondary_topic:
+                    z_out[:] = resume_state['z_out']
+            if self.count_changes:
+                self.change_counter_t = int(resume_state['change_counter_t'])
+                if self.command_level_topics:
+                    self.change_counter_s = int(resume_state['change_counter_s'])
+                if self.secondary_topic:
+                    self.change_counter_z = int(resume_state['change_counter_z'])
+            if return_change_t and count_changes:
+                change_t_out[:] = resume_state['change_t_out']
+            if return_change_s and self.command_level_topics and count_changes:
+                change_s_out[:] = resume_state['change_s_out']
+            if return_change_z and self.secondary_topic and count_changes:
+                change_z_out[:] = resume_state['change_z_out']
+            for name, counts in cocluster.items():
+                counts.set_state({key: resume_state['coclustering_' + name + '_' + key] for key in ['data', 'indices', 'indptr', 'samples']})
+        ## Online convergence diagnostics of the samples after the burnin
+        diagnostics = None
+        if convergence is not None:
+            diagnostics = convergence if isinstance(convergence, convergence_monitor) else convergence_monitor(**convergence)
+            diagnostics.start(['loglik', 'K'] + (['H'] if self.command_level_topics else []))
+            if resume_state is not None:
+                diagnostics.set_state(from_json_array(resume_state['convergence']))
+        if scheduler is not None and resume_state is not None:
+            scheduler.set_state({name: resume_state['scheduler_' + name] for name in ['probs', 'calls', 'seconds', 'changes']})
+            moves_cdf = scheduler.cdf
+        writer = None if checkpoint is None else checkpoint_writer(checkpoint)
+        monitor = default_monitor(progress, verbose, jupy_out)
+        if monitor is not None:
+            monitor.start(iterations, burnin, first=start)
+            # Variables updated by a systematic sweep, excluding the split-merge moves (see systematic_sweep)
+            sweep_updates = self.D + (self.corpus.n_commands if self.command_level_topics else 0) + (self.corpus.n_tokens + n_label_switch if self.secondary_topic else 0)
+        if instrument:
+            profile = move_profile()
+        last = iterations + burnin - 1
+        for it in range(start, iterations+burnin):
             # Sample move
-            move = np.random.choice(moves, p=moves_probs)
+            move = 'sweep' if sweep else moves[self.rng.categorical_cdf(moves_cdf)]
+            if instrument:
+                start_time = time.perf_counter(); start_updates = self.count_updates()
+            adapting = scheduler is not None and it < burnin
+            if adapting:
+                start_cpu = time.thread_time(); start_changes = self.count_label_changes()
             # Do move
-            if move == 't':
+            a = None
+            if move == 'sweep':
+                a = self.systematic_sweep(random_scan=random_scan, sweep_z=sweep_z, n_split_merge=n_split_merge, n_label_switch=n_label_switch, random_allocation=random_allocation, restricted_scans=restricted_scans)
+                if track_moves:
+                    moves_all += [m for m, _ in a]
+                    moves_accept += [acc for _, acc in a]
+            elif move == 't':
                 self.resample_session_topics(size=size)
             elif move == 's':
                 self.resample_command_topics(size=size)
             elif move == 'z':
-                self.resample_indicators(size=size)
+                if sweep_z:
+                    self.sweep_indicators()
+                else:
+                    self.resample_indicators(size=size)
             elif move == 'split_merge_session':
-                a = self.split_merge_session(random_allocation=random_allocation)
+                a = self.split_merge_session(random_allocation=random_allocation, restricted_scans=restricted_scans)
                 if track_moves:
                     moves_all += [move]
                     moves_accept += [a]
             elif move == 'split_merge_command':
-                a = self.split_merge_command(random_allocation=random_allocation)
+                a = self.split_merge_command(random_allocation=random_allocation, restricted_scans=restricted_scans)
                 if track_moves:
                     moves_all += [move]
                     moves_accept += [a]
             else:
-                self.MH_label_z()
+                a = self.MH_label_z()
+            if adapting:
+                # Labels changed by the move, plus one for an accepted proposal
+                scheduler.record(move, time.thread_time() - start_cpu, changes=self.count_label_changes() - start_changes + int(a is not None and bool(a)))
+                if scheduler.due():
+                    moves_cdf = scheduler.adapt()
+            if instrument:
+                profile.record(move_names[move], time.perf_counter() - start_time, touched=self.count_updates() - start_updates)
+                if move == 'sweep':
+                    for m, acc in a:
+                        profile.record_acceptance(m, acc)
+                else:
+                    profile.record_acceptance(move_names[move], a)
+            # Periodic consistency check of the running log-likelihood
+            if self.track_ll and ll_check > 0 and (it + 1) % ll_check == 0:
+                loglik = self.marginal_loglikelihood(cached=False)
+                if not np.isclose(self.loglik, loglik, rtol=1e-8, atol=1e-6):
+                    message = 'The running log-likelihood (' + str(self.loglik) + ') does not match the marginal log-likelihood (' + str(loglik) + ') at iteration ' + str(it + 1)
+                    if ll_strict:
+                        raise ValueError(message + '.')
+                    warnings.warn(message + ' (difference ' + str(self.loglik - loglik) + '): the running log-likelihood is reset.')
+                self.loglik = loglik
             if calculate_ll:
-                ll += [self.marginal_loglikelihood()]
-            # Print progression
-            if verbose:
-                if it < burnin:
-                    if jupy_out:
-                        clear_output(wait=True)
-                        display('Burnin: ' + str(it+1) + ' / ' + str(burnin)) 
-                    else:
-                        print('\rBurnin: ', str(it+1), ' / ', str(burnin), sep='', end=' ', flush=True)
-                elif it == burnin and burnin > 0:
-                    if jupy_out:
-                        clear_output(wait=True)
-                        display('Progression: ' + str(it-burnin+1) + ' / ' + str(iterations)) 
-                    else:
-                        print('\nProgression: ', str(it-burnin+1), ' / ', str(iterations), sep='', end=' ', flush=True)
+                ll += [self.loglik]
+            # Progress report (rate-limited), with the number of variables updated by the move
+            if monitor is not None:
+                if move == 'sweep':
+                    updates = sweep_updates + len(a)
+                elif move == 'z' and sweep_z:
+                    updates = self.corpus.n_tokens
                 else:
-                    if jupy_out:
-                        clear_output(wait=True)
-                        display('Progression: ' + str(it-burnin+1) + ' / ' + str(iterations))         
-                    else:
-                        print('\rProgression: ', str(it-burnin+1), ' / ', str(iterations), sep='', end=' ', flush=True)
+                    updates = size if move in ['t', 's', 'z'] else 1
+                if monitor.due(it, updates):
+                    monitor.report(it, **self.progress_metrics())
             ## Store output
             if it >= burnin and (it - burnin) % thinning == 0:
                 q = (it - burnin) // thinning
-                if return_t:
-                    t_out[q] = np.copy(self.t)
-                if return_s and self.command_level_topics:
-                    for d in range(self.D):
-                        s_out[d][q] = np.copy(self.s[d])
-                if return_z and self.secondary_topic:
-                    for d in range(self.D):
-                        for j in range(self.N[d]):
-                            z_out[d][j][q] = np.copy(self.z[d][j])
-                if return_change_t and self.count_changes:
+                if self.lambda_gem or self.psi_gem:
+                    self.compact_topics()
+                if trace is not None:
+                    if return_t:
+                        sink.append('t', self.t)
+                    if return_s and self.command_level_topics:
+                        sink.append('s', self.s_flat)
+                    if return_z and self.secondary_topic:
+                        sink.append('z', self.z_flat)
+                else:
+                    if return_t:
+                        t_out[q] = np.copy(self.t)
+                    if return_s and self.command_level_topics:
+                        s_out[q] = self.s_flat
+                    if return_z and self.secondary_topic:
+                        z_out[q] = np.packbits(self.z_flat, bitorder='little')
+                if 't' in cocluster:
+                    cocluster['t'].add(self.t)
+                if 's' in cocluster:
+                    cocluster['s'].add(self.s_flat)
+                if return_change_t and count_changes:
                     change_t_out[q] = np.copy(self.change_counter_t)
                     self.change_counter_t = 0 
-                if return_change_s and self.command_level_topics and self.count_changes:
+                if return_change_s and self.command_level_topics and count_changes:
                     change_s_out[q] = np.copy(self.change_counter_s)
                     self.change_counter_s = 0 
-                if return_change_z and self.secondary_topic and self.count_changes:
+                if return_change_z and self.secondary_topic and count_changes:
                     change_z_out[q] = np.copy(self.change_counter_z)
                     self.change_counter_z = 0 
+            ## Convergence-based stopping (before the checkpoint, so that a chain resumed from a checkpoint has passed its checks)
+            if diagnostics is not None:
+                if it >= burnin:
+                    diagnostics.add(self.convergence_values())
+                if diagnostics.check() is not None:
+                    last = it
+                    break
+            ## Checkpoint (the arrays are copied here and written by a background thread)
+            if writer is not None and (it + 1) % checkpoint_every == 0:
+                state = self.get_state()
+                state['mcmc_args'] = json_array(mcmc_args)
+                state['iteration'] = np.array(it + 1)
+                if track_moves:
+                    state['moves'] = np.array(moves_all, dtype=str)
+                    state['acceptance_moves'] = np.array([-1 if a is None else int(a) for a in moves_accept], dtype=np.int8)
+                if calculate_ll:
+                    state['ll'] = np.array(ll)
+                if trace is not None:
+                    sink.flush()
+                    state['trace_samples'] = np.array(max(0, (it - burnin) // thinning + 1))
+                else:
+                    if return_t:
+                        state['t_out'] = np.copy(t_out)
+                    if return_s and self.command_level_topics:
+                        state['s_out'] = np.copy(s_out)
+                    if return_z and self.secondary_topic:
+                        state['z_out'] = np.copy(z_out)
+                if self.count_changes:
+                    state['change_counter_t'] = np.array(self.change_counter_t)
+                    if self.command_level_topics:
+                        state['change_counter_s'] = np.array(self.change_counter_s)
+                    if self.secondary_topic:
+                        state['change_counter_z'] = np.array(self.change_counter_z)
+                if return_change_t and count_changes:
+                    state['change_t_out'] = np.copy(change_t_out)
+                if return_change_s and self.command_level_topics and count_changes:
+                    state['change_s_out'] = np.copy(change_s_out)
+                if return_change_z and self.secondary_topic and count_changes:
+                    state['change_z_out'] = np.copy(change_z_out)
+                if diagnostics is not None:
+                    state['convergence'] = json_array(diagnostics.get_state())
+                if scheduler is not None:
+                    for name, value in scheduler.get_state().items():
+                        state['scheduler_' + name] = value
+                for name, counts in cocluster.items():
+                    for key, value in counts.get_state().items():
+                        state['coclustering_' + name + '_' + key] = value
+                writer.write(state)
+        if writer is not None:
+            writer.close()
+        if monitor is not None:
+            monitor.finish(last, **self.progress_metrics())
+            if progress is None:
+                monitor.close()
         ## Output
+        self.track_ll = False
+        if self.lambda_gem or self.psi_gem:
+            self.compact_topics()
         out = {}
         if track_moves:
             out['moves'] = moves_all
             out['acceptance_moves'] = moves_accept
         if calculate_ll:
             out['loglik'] = ll
-        if return_t:
-            out['t'] = t_out
-        if return_s and self.command_level_topics:
-            out['s'] = s_out
-        if return_z and self.secondary_topic:
-            out['z'] = z_out
-        if return_change_t and self.count_changes:
+        if instrument:
+            out['instrumentation'] = profile.summary()
+        if scheduler is not None:
+            out['moves_probs'] = scheduler.summary()
+        if diagnostics is not None:
+            out['convergence'] = diagnostics.summary()
+            if diagnostics.stopped is not None:
+                # Only the samples stored before the stop are returned
+                Q = 0 if last < burnin else (last - burnin) // thinning + 1
+                if trace is None:
+                    if return_t:
+                        t_out = t_out[:Q]
+                    if return_s and self.command_level_topics:
+                        s_out = s_out[:Q]
+                    if return_z and self.secondary_topic:
+                        z_out = z_out[:Q]
+                if return_change_t and count_changes:
+                    change_t_out = change_t_out[:Q]
+                if return_change_s and self.command_level_topics and count_changes:
+                    change_s_out = change_s_out[:Q]
+                if return_change_z and self.secondary_topic and count_changes:
+                    change_z_out = change_z_out[:Q]
+        if trace is not None:
+            ## Samples on disk: the sink is closed if it was created here, and a reader is returned
+            if isinstance(trace, trace_sink):
+                sink.flush()
+            else:
+                sink.close()
+            out['trace'] = trace_reader(sink.path)
+        else:
+            if return_t:
+                out['t'] = t_out
+            ## Flat traces are returned as dictionaries of views (d -> Q x N[d] and d -> j -> Q x M[d][j]), z is unpacked when a session is accessed
+            if return_s and self.command_level_topics:
+                out['s'] = {d: s_out[:,self.corpus.session_commands(d)] for d in range(self.D)}
+            if return_z and self.secondary_topic:
+                out['z'] = packed_indicators(z_out, self.corpus)
+        if len(cocluster) > 0:
+            out['coclustering'] = cocluster
+        if return_change_t and count_changes:
             out['change_t_counter'] = change_t_out
-        if return_change_s and self.command_level_topics and self.count_changes:
+        if return_change_s and self.command_level_topics and count_changes:
             out['change_s_counter'] = change_s_out
-        if return_change_z and self.secondary_topic and self.count_changes:
+        if return_change_z and self.secondary_topic and count_changes:
             out['change_z_counter'] = change_z_out
         ## Return output
         return out
+
+    ## Continue a chain from a checkpoint written by MCMC
+    def resume(self, checkpoint):
+        """
+        Restore the state of the chain from a checkpoint and run the remaining iterations of MCMC, with the same arguments.
+        The model must be created with the same corpus and arguments as the model of the checkpoint: the output is identical to the output of the uninterrupted chain.
+        Input: checkpoint: Checkpoint file written by MCMC
+        Output: Output of MCMC (for all the iterations, including those before the checkpoint)
+        """
+        state = load_checkpoint(checkpoint)
+        self.set_state(state)
+        return self.MCMC(**from_json_array(state['mcmc_args']), resume_state=state)
     
     ## Resample lambda distribution from posterior Dirichlet conditional on the counts T
     def resample_lambda(self):
-        self.lam = np.random.dirichlet(self.gamma + self.T)
+        self.lam = self.rng.generator.dirichlet(self.gamma + self.T)
     
     ## Resample phi distribution from posterior Dirichlet conditional on the counts W
     def resample_phi(self):
         self.phi = {}
         for k in range(self.K if self.command_level_topics else self.H):
-            self.phi[k] = np.random.dirichlet(self.eta + self.W[k])
+            self.phi[k] = self.rng.generator.dirichlet(self.eta + self.stats.W.rows(k))
     
     ## Resample psi distribution from posterior Dirichlet conditional on the counts S
     def resample_psi(self):
         self.psi = {}
         for h in range(self.H):
-            self.psi[h] = np.random.dirichlet(self.tau + self.S[h])
+            self.psi[h] = self.rng.generator.dirichlet(self.tau + self.stats.S.rows(h))
 
     ## Resample session topics simply from a categorical distribution with probabilities based on lambda and phi
     def resample_session_topics_uncollapsed(self, size=0):
@@ -1582,7 +1933,7 @@ class topic_model:
         ## If size is not zero, sample session indices
         if size != 0:
             ## Random sample of indices from the list of documents
-            indices = np.random.choice(self.D if self.command_level_topics else self.H, size=size, replace=False)
+            indices = self.rng.generator.choice(self.D if self.command_level_topics else self.H, size=size, replace=False)
         ## Resample session topics
         for d in indices if size != 0 else range(self.D if self.command_level_topics else self.H):
             log_p = np.log(self.lam)
@@ -1592,7 +1943,7 @@ class topic_model:
                         log_p[k] += np.log(self.psi[k][self.s[d][j]])
                     else:
                         log_p[k] += np.sum([np.log(self.phi[k][w]) for w in self.W[d][j]])
-            self.t[d] = np.random.multinomial(1, np.exp(log_p - logsumexp(log_p)))
+            self.t[d] = self.rng.generator.multinomial(1, np.exp(log_p - logsumexp(log_p)))
 
     ## Resample command topics simply from a categorical distribution with probabilities based on psi and phi
     def resample_command_topics_uncollapsed(self, size=0):
@@ -1601,17 +1952,18 @@ class topic_model:
             raise ValueError('Size must be a positive integer.')
         ## If size is not zero, sample session indices
         if size != 0:
-            indices = np.random.choice(self.D, size=size, replace=False)
+            indices = self.rng.generator.choice(self.D, size=size, replace=False)
         for d in indices if size != 0 else range(self.D):
             for j in range(self.N[d]):
                 log_p = np.log(self.psi[self.s[d][j]])
                 for h in range(self.H):
                     log_p[h] += np.sum([np.log(self.phi[h][w]) for w in self.W[d][j]])
-                self.s[d][j] = np.random.multinomial(1, np.exp(log_p - logsumexp(log_p)))
+                self.s[d][j] = self.rng.generator.multinomial(1, np.exp(log_p - logsumexp(log_p)))
 
     ## Runs uncollapsed MCMC chain
     def uncollapsed_MCMC(self, iterations, burnin=0, size=1, verbose=True, calculate_ll=False, jupy_out=False,
-            return_t=True, return_s=False, thinning=1):
+            return_t=True, return_s=False, thinning=1, progress=None):
+        # Optional input: progress - progress_monitor for the progress and metrics reports (see MCMC)
         # Moves
         moves = ['t','lambda','phi']
         moves_probs = [1]
@@ -1621,6 +1973,7 @@ class topic_model:
         if self.secondary_topic:
             raise ValueError('Secondary topics are not supported in the uncollapsed MCMC.')
         moves_probs /= np.sum(moves_probs)
+        moves_cdf = np.cumsum(moves_probs)
         ## Marginal posterior
         if calculate_ll:
             ll = []
@@ -1629,9 +1982,7 @@ class topic_model:
         if return_t:
             t_out = np.zeros((Q,self.D),dtype=int)
         if return_s and self.command_level_topics:
-            s_out = {}
-            for d in range(self.D):
-                s_out[d] = np.zeros((Q,self.N[d]),dtype=int)
+            s_out = np.zeros((Q,self.corpus.n_commands),dtype=int)
         ## Start by resampling lambda, phi, psi and theta based on current counts, using conjugacy
         self.resample_lambda()
         self.resample_phi()
@@ -1639,10 +1990,13 @@ class topic_model:
             self.resample_psi()
         if self.secondary_topic:
             self.resample_theta()
+        monitor = default_monitor(progress, verbose, jupy_out)
+        if monitor is not None:
+            monitor.start(iterations, burnin)
         ## Iterate over the MCMC chain
         for it in range(iterations+burnin):
             # Sample move
-            move = np.random.choice(moves, p=moves_probs)
+            move = moves[self.rng.categorical_cdf(moves_cdf)]
             # Do move
             if move == 't':
                 self.resample_session_topics_uncollapsed()
@@ -1656,34 +2010,20 @@ class topic_model:
                 self.resample_psi()
             if calculate_ll:
                 ll += [self.marginal_loglikelihood()]
-            # Print progression
-            if verbose:
-                if it < burnin:
-                    if jupy_out:
-                        clear_output(wait=True)
-                        display('Burnin: ' + str(it+1) + ' / ' + str(burnin)) 
-                    else:
-                        print('\rBurnin: ', str(it+1), ' / ', str(burnin), sep='', end=' ', flush=True)
-                elif it == burnin and burnin > 0:
-                    if jupy_out:
-                        clear_output(wait=True)
-                        display('Progression: ' + str(it-burnin+1) + ' / ' + str(iterations)) 
-                    else:
-                        print('\nProgression: ', str(it-burnin+1), ' / ', str(iterations), sep='', end=' ', flush=True)
-                else:
-                    if jupy_out:
-                        clear_output(wait=True)
-                        display('Progression: ' + str(it-burnin+1) + ' / ' + str(iterations))         
-                    else:
-                        print('\rProgression: ', str(it-burnin+1), ' / ', str(iterations), sep='', end=' ', flush=True)
+            # Progress report (rate-limited), with the number of variables updated by the move (all the topics of t or s, or a vector of probabilities)
+            if monitor is not None and monitor.due(it, {'t': self.D, 's': self.corpus.n_commands}.get(move, 1)):
+                monitor.report(it, loglik=ll[-1] if calculate_ll else None)
             ## Store output
             if it >= burnin and (it - burnin) % thinning == 0:
                 q = (it - burnin) // thinning
                 if return_t:
                     t_out[q] = np.copy(self.t)
                 if return_s and self.command_level_topics:
-                    for d in range(self.D):
-                        s_out[d][q] = np.copy(self.s[d])
+                    s_out[q] = self.s_flat
+        if monitor is not None:
+            monitor.finish(iterations + burnin - 1, loglik=ll[-1] if calculate_ll and len(ll) > 0 else None)
+            if progress is None:
+                monitor.close()
         ## Output
         out = {}
         if calculate_ll:
@@ -1691,6 +2031,6 @@ class topic_model:
         if return_t:
             out['t'] = t_out
         if return_s and self.command_level_topics:
-            out['s'] = s_out
+            out['s'] = {d: s_out[:,self.corpus.session_commands(d)] for d in range(self.D)}
         ## Return output
         return out
\ No newline at end of file
@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+import numpy as np
+
+class topic_slots:
+
+    # Capacity-based bookkeeping for the topics of a nonparametric (GEM) prior.
+    # The count arrays of the model are preallocated with a number of slots larger than the number of topics:
+    # each topic occupies a slot, the slots in use are marked in the boolean mask active, and the free slots are kept in a stack.
+    # Creating or deleting a topic only changes the mask and the stack, and topic labels are slot ids, so they never need to be relabelled.
+    # The count arrays are grown (doubling the capacity) only when no free slot is left, and compaction relabels the topics as 0,...,K-1.
+    # Required input: active - boolean array (or list) with the slots in use; capacity - total number of slots (at least the length of active)
+
+    def __init__(self, active, capacity=None):
+        active = np.array(active, dtype=bool)
+        if capacity is None:
+            capacity = 2 * max(len(active), 1)
+        if capacity < len(active):
+            raise ValueError('The capacity must be at least the number of slots provided.')
+        self.active = np.zeros(capacity, dtype=bool)
+        self.active[:len(active)] = active
+        # Stack of free slots (the smallest free slot is at the top)
+        self.free = [int(k) for k in np.where(~self.active)[0][::-1]]
+
+    ## Total number of slots
+    @property
+    def capacity(self):
+        return len(self.active)
+
+    ## Number of slots in use
+    @property
+    def n_active(self):
+        return int(np.sum(self.active))
+
+    ## Slot that would be used by a new topic (None if all the slots are in use)
+    def peek(self):
+        return self.free[-1] if len(self.free) > 0 else None
+
+    ## Mark the top free slot as used and return it
+    def acquire(self):
+        k = self.free.pop()
+        self.active[k] = True
+        return k
+
+    ## Mark slot k as free
+    def release(self, k):
+        if not self.active[k]:
+            raise ValueError('Slot ' + str(k) + ' is not in use.')
+        self.active[k] = False
+        self.free.append(k)
+
+    ## Increase the capacity (the new slots are free)
+    def grow(self, capacity=None):
+        old = self.capacity
+        if capacity is None:
+            capacity = 2 * max(old, 1)
+        if capacity <= old:
+            raise ValueError('The new capacity must be larger than the current capacity.')
+        self.active = np.append(self.active, np.zeros(capacity - old, dtype=bool))
+        self.free = list(range(capacity - 1, old - 1, -1)) + self.free
+
+    ## Relabel the slots in use as 0,...,K-1 (preserving their order)
+    def compact(self):
+        # Output: perm - old slot of each new slot (slots in use first); relabel - new slot of each old slot
+        #         (both None if the slots in use are already 0,...,K-1, and only the stack of free slots is reset)
+        n = self.n_active
+        if np.all(self.active[:n]):
+            self.free = list(range(self.capacity - 1, n - 1, -1))
+            return None, None
+        perm = np.append(np.where(self.active)[0], np.where(~self.active)[0])
+        relabel = np.zeros(self.capacity, dtype=int)
+        relabel[perm] = np.arange(self.capacity)
+        self.active[:] = False
+        self.active[:n] = True
+        self.free = list(range(self.capacity - 1, n - 1, -1))
+        return perm, relabel
+
+## Pad an array with zeros along an axis up to a given length
+def pad_slots(x, length, axis=0):
+    """
+    Pad a count array with zeros along one axis.
+    Inputs: x: Count array; length: New length of the axis; axis: Axis to pad
+    Output: Padded array (with the same dtype as x)
+    """
+    pad = [(0, 0)] * np.ndim(x)
+    pad[axis] = (0, length - x.shape[axis])
+    return np.pad(x, pad)
@@ -0,0 +1,194 @@
+#! /usr/bin/env python3
+import os
+import json
+import numpy as np
+from collections.abc import Mapping
+from .corpus import packed_corpus
+
+# On-disk storage for the MCMC traces of t, s and z.
+# Each variable is stored in a raw binary file (one row for each stored sample), with the ragged s and z flattened against the offsets of the packed corpus:
+# a sample of t has D entries, a sample of s has one entry per command and a sample of z has one entry per token.
+# The samples are buffered and written in chunks by trace_sink, and read back through memory maps by trace_reader,
+# so that only the requested iterations and sessions are loaded.
+
+## Default storage type of each variable (z is bit-packed)
+trace_dtypes = {'t': 'int32', 's': 'int32', 'z': 'uint8'}
+
+## Unpack the entries start, ..., stop-1 from bit-packed arrays
+def unpack_range(packed, start, stop):
+    """
+    Unpack a range of binary entries from arrays packed with np.packbits(..., bitorder='little') along the last axis.
+    Inputs: packed: Packed array (... x bytes); start, stop: Range of the entries to unpack
+    Output: Array of the entries (... x (stop - start)), as uint8
+    """
+    bits = np.unpackbits(packed[..., start // 8:(stop + 7) // 8], axis=-1, bitorder='little')
+    return bits[..., start % 8:start % 8 + stop - start]
+
+class packed_indicators(Mapping):
+
+    # Bit-packed trace of the indicators z, with the dictionary view (d -> j -> samples x M[d][j]) of the unpacked trace.
+    # Each sample uses one bit per token: the entries of a session are unpacked only when the session is accessed.
+    # Required input: packed - samples of z packed with np.packbits(..., bitorder='little') (... x bytes); corpus - packed_corpus
+
+    def __init__(self, packed, corpus):
+        self.packed = packed
+        self.session_offsets = corpus.session_offsets
+        self.command_offsets = corpus.command_offsets
+        self.n_tokens = int(corpus.command_offsets[-1])
+
+    def __len__(self):
+        return len(self.session_offsets) - 1
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    ## Unpacked samples of the commands of session d
+    def __getitem__(self, d):
+        if d not in range(len(self)):
+            raise KeyError(d)
+        offsets = self.command_offsets[self.session_offsets[d]:self.session_offsets[d+1]+1]
+        bits = unpack_range(self.packed, offsets[0], offsets[-1])
+        return {j: bits[..., offsets[j] - offsets[0]:offsets[j+1] - offsets[0]] for j in range(len(offsets) - 1)}
+
+    ## Unpacked samples of all the tokens (flat)
+    def flat(self):
+        return unpack_range(self.packed, 0, self.n_tokens)
+
+class trace_sink:
+
+    # Writer of the traces to a directory, with one file for each variable (name.bin), the corpus offsets (offsets.npz) and the metadata (meta.json).
+    # Required input: path - directory for the traces (created if it does not exist); corpus - packed_corpus (or dictionary of dictionaries of words)
+    # Optional input: variables - variables to store; chunk_size - number of samples buffered before each write; dtypes - storage type of each variable;
+    #                 n_samples - if provided, the first n_samples stored samples are kept and the new samples are appended after them (used to resume a chain)
+
+    def __init__(self, path, corpus, variables=['t', 's', 'z'], chunk_size=100, dtypes=None, n_samples=None):
+        corpus = packed_corpus(corpus)
+        if not isinstance(chunk_size, int) or chunk_size < 1:
+            raise ValueError('chunk_size must be a positive integer.')
+        for name in variables:
+            if name not in trace_dtypes:
+                raise ValueError('The variables must be t, s or z.')
+        self.path = path
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+        np.savez(os.path.join(path, 'offsets.npz'), session_offsets=corpus.session_offsets, command_offsets=corpus.command_offsets)
+        # Number of entries of each sample (z is stored with one bit per token)
+        self.n_entries = {'t': corpus.D, 's': corpus.n_commands, 'z': corpus.n_tokens}
+        widths = {'t': corpus.D, 's': corpus.n_commands, 'z': (corpus.n_tokens + 7) // 8}
+        dtypes = dict(trace_dtypes, **({} if dtypes is None else dtypes))
+        self.meta = {'variables': {name: {'width': int(widths[name]), 'dtype': np.dtype(dtypes[name]).str, 'entries': int(self.n_entries[name]), 'packed': name == 'z'}
+                                        for name in variables}}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+        # Chunk buffers, number of buffered samples and open files
+        self.buffers = {name: np.zeros((chunk_size, widths[name]), dtype=dtypes[name]) for name in variables}
+        self.n_buffered = {name: 0 for name in variables}
+        if n_samples is None:
+            self.files = {name: open(os.path.join(path, name + '.bin'), 'wb') for name in variables}
+            self.n_written = {name: 0 for name in variables}
+        else:
+            # Samples written after n_samples (e.g. after the last checkpoint of an interrupted chain) are discarded
+            self.files = {}
+            for name in variables:
+                self.files[name] = open(os.path.join(path, name + '.bin'), 'r+b')
+                self.files[name].truncate(n_samples * self.buffers[name].shape[1] * self.buffers[name].itemsize)
+                self.files[name].seek(0, os.SEEK_END)
+            self.n_written = {name: n_samples for name in variables}
+
+    ## Variables stored by the sink
+    @property
+    def variables(self):
+        return list(self.buffers)
+
+    ## Add a sample of a variable (flat array aligned to the sessions, commands or tokens)
+    def append(self, name, x):
+        self.buffers[name][self.n_buffered[name]] = np.packbits(x, bitorder='little') if self.meta['variables'][name]['packed'] else x
+        self.n_buffered[name] += 1
+        if self.n_buffered[name] == self.chunk_size:
+            self.flush(name)
+
+    ## Write the buffered samples (of all the variables if name is None)
+    def flush(self, name=None):
+        for v in (self.variables if name is None else [name]):
+            if self.n_buffered[v] > 0:
+                self.buffers[v][:self.n_buffered[v]].tofile(self.files[v])
+                self.files[v].flush()
+                self.n_written[v] += self.n_buffered[v]
+                self.n_buffered[v] = 0
+
+    ## Write the remaining samples and close the files
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+class trace_reader:
+
+    # Reader of the traces written by trace_sink. The files are memory-mapped: slicing by iteration and/or session only reads the requested entries.
+    # The number of samples is obtained from the size of the files, so traces of interrupted chains can also be read.
+    # Required input: path - directory of the traces
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        offsets = np.load(os.path.join(path, 'offsets.npz'))
+        self.session_offsets = offsets['session_offsets']
+        self.command_offsets = offsets['command_offsets']
+        self.D = len(self.session_offsets) - 1
+
+    ## Variables stored in the traces
+    @property
+    def variables(self):
+        return list(self.meta['variables'])
+
+    ## Number of stored samples of a variable
+    def n_samples(self, name):
+        info = self.meta['variables'][name]
+        return os.path.getsize(os.path.join(self.path, name + '.bin')) // (info['width'] * np.dtype(info['dtype']).itemsize)
+
+    ## Memory map of the samples of a variable (Q x width)
+    def memmap(self, name):
+        if name not in self.meta['variables']:
+            raise KeyError('The variable ' + name + ' is not stored in the traces.')
+        info = self.meta['variables'][name]
+        Q = self.n_samples(name)
+        if Q == 0:
+            return np.zeros((0, info['width']), dtype=info['dtype'])
+        return np.memmap(os.path.join(self.path, name + '.bin'), dtype=info['dtype'], mode='r', shape=(Q, info['width']))
+
+    ## Range of entries of a variable corresponding to session d
+    def session_range(self, name, d):
+        if name == 't':
+            return d, d + 1
+        elif name == 's':
+            return self.session_offsets[d], self.session_offsets[d+1]
+        else:
+            return self.command_offsets[self.session_offsets[d]], self.command_offsets[self.session_offsets[d+1]]
+
+    ## Read a range of entries of the samples of a variable (unpacking the bits if the variable is packed)
+    def read(self, name, iterations, start, stop):
+        trace = self.memmap(name)
+        if self.meta['variables'][name].get('packed', False):
+            # Only the bytes containing the entries are read
+            first = start // 8
+            return unpack_range(np.array(trace[iterations, first:(stop + 7) // 8]), start - 8 * first, stop - 8 * first)
+        return np.array(trace[iterations, start:stop])
+
+    ## Samples of a variable for a range of iterations and an optional session
+    def get(self, name, iterations=slice(None), session=None):
+        """
+        Read the samples of a variable.
+        Inputs: name: Variable (t, s or z); iterations: Stored samples to read (slice, index or array of indices);
+                session: Session d to read (all the sessions if None)
+        Output: Array with one row per sample: D entries for t, and the flat entries of the commands (for s) or tokens (for z) of the session(s)
+        """
+        start, stop = (0, self.meta['variables'][name].get('entries', self.meta['variables'][name]['width'])) if session is None else self.session_range(name, session)
+        return self.read(name, iterations, start, stop)
+
+    ## Samples of the command-level topic (s) or of the indicators (z) of command j in session d
+    def command(self, name, d, j, iterations=slice(None)):
+        c = self.session_offsets[d] + j
+        if name == 's':
+            return self.read(name, iterations, c, c + 1)[..., 0]
+        return self.read(name, iterations, self.command_offsets[c], self.command_offsets[c+1])
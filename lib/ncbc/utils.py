@@ -137,6 +137,190 @@ def logB(vec):
     out -= loggamma(np.sum(vec))
     return out
 
+## Computes the logarithm of the rising factorial a (a+1) ... (a+n-1) using log-gamma differences
+def log_rising_factorial(a, n):
+    """
+    Compute the logarithm of the rising factorial a (a+1) ... (a+n-1), elementwise.
+    Inputs: a: Positive base (scalar or array); n: Non-negative integer length (scalar or array, broadcast against a)
+    Output: Logarithm of the rising factorial (0 when n=0)
+    """
+    return loggamma(np.add(a, n)) - loggamma(a)
+
+## Lookup table of f(a + n) for a fixed scalar a and the integers n = 0, 1, ..., grown on demand
+class shifted_table:
+
+    # The values are computed once for each n and extended (doubling the size) up to the largest n requested.
+    # Required input: a - scalar shift; Optional input: func - function to tabulate (loggamma or np.log), size - initial size
+
+    def __init__(self, a, func=loggamma, size=256):
+        self.a = a
+        self.func = func
+        self.values = np.real(func(a + np.arange(size)))
+
+    ## Extend the table to include n = 0, ..., size-1
+    def grow(self, size):
+        size = max(size, 2 * len(self.values))
+        self.values = np.append(self.values, np.real(self.func(self.a + np.arange(len(self.values), size))))
+
+    ## Values of f(a + n) for an integer array n
+    def __getitem__(self, n):
+        n_max = (np.max(n) if np.size(n) > 0 else 0) if np.ndim(n) > 0 else n
+        if n_max >= len(self.values):
+            self.grow(n_max + 1)
+        return self.values[n]
+
+## Tables of loggamma(a + n) and log(a + n), keyed by function and shift (the oldest tables are dropped beyond max_tables)
+lookup_tables = {}
+max_tables = 64
+
+## Obtain the lookup table of a function with a given shift
+def get_table(a, func=loggamma):
+    key = (func.__name__, float(a))
+    if key not in lookup_tables:
+        if len(lookup_tables) >= max_tables:
+            del lookup_tables[next(iter(lookup_tables))]
+        lookup_tables[key] = shifted_table(float(a), func=func)
+    return lookup_tables[key]
+
+## Check if f(a + n) can be obtained from a lookup table (scalar shift and non-negative integer counts)
+def use_table(a, n):
+    n = np.asarray(n)
+    return np.ndim(a) == 0 and n.dtype.kind in 'iu' and (n.size == 0 or np.min(n) >= 0)
+
+## Computes loggamma(a + n) for integer counts n, using a lookup table for scalar a
+def lookup_loggamma(a, n):
+    """
+    Compute loggamma(a + n) elementwise, with the values read from a lookup table when a is a scalar and n is a non-negative integer array.
+    Inputs: a: Shift (scalar or array); n: Counts (scalar or array)
+    Output: loggamma(a + n) (real part)
+    """
+    if use_table(a, n):
+        return get_table(a)[n]
+    return np.real(loggamma(np.add(a, n)))
+
+## Computes log(a + n) for integer counts n, using a lookup table for scalar a
+def lookup_log(a, n):
+    """
+    Compute log(a + n) elementwise, with the values read from a lookup table when a is a scalar and n is a non-negative integer array.
+    Inputs: a: Shift (scalar or array); n: Counts (scalar or array)
+    Output: log(a + n)
+    """
+    if use_table(a, n):
+        return get_table(a, func=np.log)[n]
+    return np.log(np.add(a, n))
+
+## Computes the logarithm of the rising factorial (a+k) (a+k+1) ... (a+k+n-1) for integer k and n, using lookup tables for scalar a
+def lookup_log_rising(a, k, n):
+    """
+    Compute the logarithm of the rising factorial (a+k) (a+k+1) ... (a+k+n-1), elementwise.
+    Inputs: a: Shift (scalar or array); k: Counts added to the shift; n: Non-negative integer length (broadcast against k)
+    Output: Logarithm of the rising factorial (0 when n=0)
+    """
+    if use_table(a, k) and use_table(a, n):
+        table = get_table(a)
+        return table[np.add(k, n)] - table[k]
+    return log_rising_factorial(np.add(a, k), n)
+
+## Computes the logarithm of the multivariate beta function of prior + counts, using a lookup table for a scalar prior
+def lookup_logB(prior, counts):
+    """
+    Compute logB(prior + counts) for a vector of counts.
+    Inputs: prior: Scalar or vector hyperparameter; counts: Vector of counts
+    Output: Logarithm of the multivariate beta function
+    """
+    if use_table(prior, counts):
+        return np.sum(get_table(prior)[counts]) - lookup_loggamma(prior * len(counts), np.sum(counts))
+    return logB(prior + counts)
+
+## Log-predictive terms of a bag of words for each row of a count matrix (collapsed Dirichlet-multinomial or GEM prior)
+def bag_logpredictive(counts, vs, ns, prior, totals=None, gem=False, columns=None):
+    """
+    Compute, for each row of a count matrix, the log-probability of adding a bag of words under a collapsed prior.
+    Inputs: counts: Count matrix (rows x V); vs, ns: Distinct words in the bag and their counts; prior: Scalar or V-dimensional hyperparameter;
+            totals: Row totals of counts (computed if not provided); gem: If True, new words in a row have weight prior (GEM prior), otherwise the prior is a Dirichlet;
+            columns: Columns vs of the counts, if already gathered (counts is then only used for its shape)
+    Output: Vector of log-predictive terms (one for each row)
+    """
+    # Gather the columns of the words in the bag
+    sub = counts[:, vs] if columns is None else columns
+    if totals is None:
+        totals = np.sum(counts, axis=1)
+    n = np.sum(ns)
+    if gem:
+        # Words already in the row contribute rising factorials of the counts, new words contribute log(prior) + log((n-1)!)
+        new = (sub == 0)
+        out = np.sum(np.where(new, np.log(prior) + lookup_loggamma(0, ns), lookup_log_rising(0, np.where(new, 1, sub), ns)), axis=1)
+        out -= lookup_log_rising(prior, totals, n)
+    else:
+        if np.ndim(prior) > 0:
+            out = np.sum(log_rising_factorial(prior[vs] + sub, ns), axis=1)
+            out -= log_rising_factorial(np.sum(prior) + totals, n)
+        else:
+            # Scalar prior: the rising factorials are read from the lookup tables for integer counts
+            out = np.sum(lookup_log_rising(prior, sub, ns), axis=1)
+            out -= lookup_log_rising(prior * counts.shape[1], totals, n)
+    return out
+
+## Log-predictive terms of bags of words for count matrices with bounded counts (used by the restricted allocations of the split-merge moves)
+def bounded_logpredictive(prior, n_cols, n_max):
+    """
+    Build a function computing bag_logpredictive(counts, vs, ns, prior, totals=totals) (Dirichlet prior) when the counts and the row totals never exceed n_max.
+    For a scalar prior, the values of loggamma are read once from the lookup tables, so each call only indexes two arrays.
+    Inputs: prior: Scalar or V-dimensional hyperparameter; n_cols: Number of columns of the counts; n_max: Largest count or row total
+    Output: Function (counts, vs, ns, totals) -> vector of log-predictive terms (one for each row)
+    """
+    if np.ndim(prior) > 0:
+        return lambda counts, vs, ns, totals: bag_logpredictive(counts, vs, ns, prior, totals=totals)
+    loggamma_counts = lookup_loggamma(prior, np.arange(n_max + 1))
+    loggamma_totals = lookup_loggamma(prior * n_cols, np.arange(n_max + 1))
+    def logpredictive(counts, vs, ns, totals):
+        sub = counts[:, vs]
+        out = np.sum(loggamma_counts[sub + ns] - loggamma_counts[sub], axis=1)
+        return out - (loggamma_totals[totals + np.sum(ns)] - loggamma_totals[totals])
+    return logpredictive
+
+## Log-marginal likelihood of each row of a count matrix under a collapsed prior (Dirichlet-multinomial or GEM)
+def logmarginal_rows(counts, prior, gem=False):
+    """
+    Compute the log-marginal likelihood of the counts in each row of a count matrix, with the probabilities integrated out.
+    Inputs: counts: Count matrix (rows x V); prior: Scalar or V-dimensional hyperparameter; gem: If True, GEM prior, otherwise the prior is a Dirichlet
+    Output: Vector of log-marginal likelihoods (one for each row, 0 for empty rows)
+    """
+    counts = np.atleast_2d(counts)
+    totals = np.sum(counts, axis=1)
+    if gem:
+        out = np.sum(counts > 0, axis=1) * np.log(prior) + loggamma(prior) - lookup_loggamma(prior, totals)
+        out += np.sum(lookup_loggamma(0, np.where(counts > 0, counts, 1)), axis=1)
+    elif np.ndim(prior) == 0:
+        # Scalar prior: the log-gamma terms of the counts are read from the lookup tables
+        V = counts.shape[1]
+        out = np.sum(lookup_loggamma(prior, counts), axis=1) - lookup_loggamma(prior * V, totals)
+        out -= V * loggamma(prior) - loggamma(prior * V)
+    else:
+        prior = np.broadcast_to(prior, counts.shape[1])
+        out = np.sum(loggamma(prior + counts), axis=1) - loggamma(np.sum(prior) + totals)
+        out -= np.sum(loggamma(prior)) - loggamma(np.sum(prior))
+    return out
+
+## Log-marginal likelihood of a row of a count matrix from its non-zero entries (collapsed Dirichlet-multinomial or GEM prior)
+def logmarginal_entries(cols, counts, n_cols, prior, gem=False):
+    """
+    Compute the log-marginal likelihood of a row of counts stored sparsely, with the probabilities integrated out (same value as logmarginal_rows).
+    Inputs: cols, counts: Columns and values of the non-zero counts in the row; n_cols: Number of columns; prior: Scalar or n_cols-dimensional hyperparameter;
+            gem: If True, GEM prior, otherwise the prior is a Dirichlet
+    Output: Log-marginal likelihood of the row (0 for an empty row)
+    """
+    total = np.sum(counts)
+    if gem:
+        return len(counts) * np.log(prior) + loggamma(prior) - lookup_loggamma(prior, total) + np.sum(lookup_loggamma(0, counts))
+    # Only the non-zero counts contribute to the ratio of the gamma functions of the columns
+    if np.ndim(prior) == 0:
+        out = np.sum(lookup_loggamma(prior, counts)) - len(counts) * loggamma(prior)
+        return out - lookup_loggamma(prior * n_cols, total) + loggamma(prior * n_cols)
+    prior_sum = np.sum(prior)
+    out = np.sum(loggamma(prior[cols] + counts) - loggamma(prior[cols]))
+    return out - loggamma(prior_sum + total) + loggamma(prior_sum)
+
 ## Adjusted Rand Index for t
 def ari_t(t_true, t_est):
 	return ari(t_true, t_est)
@@ -163,34 +347,42 @@ def F1_Z(z_true, z_est):
 ## Estimate communities using hierarchical clustering on the posterior similarity matrix
 def estimate_t(q,m,K,linkage='average'):
     import numpy as np
-    ## Scaled posterior similarity matrix
-    psm = np.zeros((m.D,m.D))
-    for i in range(q['t'].shape[0]):
-        psm += np.equal.outer(q['t'][i],q['t'][i])
-    ## Posterior similarity matrix (estimate)
-    psm /= q['t'].shape[0]
-    ## Clustering based on posterior similarity matrix (hierarchical clustering)
-    cluster_model = AgglomerativeClustering(n_clusters=K, metric='precomputed', linkage=linkage) 
-    clust = cluster_model.fit_predict(1-psm)
+    ## Posterior similarity matrix accumulated during MCMC (see coclustering in topic_model.MCMC)
+    if 't' in q.get('coclustering', {}):
+        clust = q['coclustering']['t'].estimate(K, linkage=linkage)
+    else:
+        ## Scaled posterior similarity matrix
+        psm = np.zeros((m.D,m.D))
+        for i in range(q['t'].shape[0]):
+            psm += np.equal.outer(q['t'][i],q['t'][i])
+        ## Posterior similarity matrix (estimate)
+        psm /= q['t'].shape[0]
+        ## Clustering based on posterior similarity matrix (hierarchical clustering)
+        cluster_model = AgglomerativeClustering(n_clusters=K, metric='precomputed', linkage=linkage) 
+        clust = cluster_model.fit_predict(1-psm)
     return clust
 
 ## Estimate communities using hierarchical clustering on the posterior similarity matrix
 def estimate_s(q,m,K,linkage='average'):
     import numpy as np
-    ## Scaled posterior similarity matrix
-    for i in range(m.D):
-        try:
-            v = np.hstack((v, q['s'][i]))
-        except:
-            v = q['s'][i]
-    psm = np.zeros((v.shape[1], v.shape[1]))
-    for i in range(v.shape[0]):
-        psm += np.equal.outer(v[i], v[i])
-    ## Posterior similarity matrix (estimate)
-    psm /= v.shape[0]
-    ## Clustering based on posterior similarity matrix (hierarchical clustering)
-    cluster_model = AgglomerativeClustering(n_clusters=K, metric='precomputed', linkage=linkage) 
-    clust = cluster_model.fit_predict(1-psm)
+    ## Posterior similarity matrix accumulated during MCMC (see coclustering in topic_model.MCMC)
+    if 's' in q.get('coclustering', {}):
+        clust = q['coclustering']['s'].estimate(K, linkage=linkage)
+    else:
+        ## Scaled posterior similarity matrix
+        for i in range(m.D):
+            try:
+                v = np.hstack((v, q['s'][i]))
+            except:
+                v = q['s'][i]
+        psm = np.zeros((v.shape[1], v.shape[1]))
+        for i in range(v.shape[0]):
+            psm += np.equal.outer(v[i], v[i])
+        ## Posterior similarity matrix (estimate)
+        psm /= v.shape[0]
+        ## Clustering based on posterior similarity matrix (hierarchical clustering)
+        cluster_model = AgglomerativeClustering(n_clusters=K, metric='precomputed', linkage=linkage) 
+        clust = cluster_model.fit_predict(1-psm)
     nn = 0
     clust_dict = {}
     for i in range(m.D):